@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Batch NFT trait analysis for the image library
+
+Walks generated_images/ and uploads/ (or the directories given), runs trait
+analysis over every image in a process pool and writes an NFT metadata
+sidecar next to each image (`dragon.png` -> `dragon.png.json`).
+
+Re-runs are incremental. A manifest records each image's size, mtime,
+content hash and trait schema version. Images that haven't changed are
+skipped without being read, and images whose bytes are unchanged are
+skipped after hashing. Bump traits.VERSION (or pass --force) to re-derive
+the whole collection after a schema change.
+
+Examples:
+    python analyze_library.py
+    python analyze_library.py generated_images --workers 8
+    python analyze_library.py --force
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import traits
+
+DEFAULT_DIRECTORIES = ['generated_images', 'uploads']
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif'}
+MANIFEST_NAME = '.traits_manifest.json'
+SIDECAR_SUFFIX = '.json'
+
+# Save the manifest after this many results so an interrupted run loses little work
+MANIFEST_FLUSH_EVERY = 50
+
+
+def iter_images(directory):
+    """Yield image paths under a directory, recursively"""
+    stack = [directory]
+    while stack:
+        current = stack.pop()
+        try:
+            entries = list(os.scandir(current))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append(entry.path)
+            elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                yield entry
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_json_atomic(path, data):
+    """Write JSON through a temp file so readers never see a partial file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def analyze_file(path, previous_hash):
+    """
+    Worker: hash an image and, if its content changed, analyze it
+
+    Args:
+        path (str): Image path
+        previous_hash (str): Content hash from the last run, or None
+
+    Returns:
+        tuple: (path, content hash, trait document or None if unchanged)
+    """
+    with open(path, 'rb') as f:
+        image_data = f.read()
+    digest = traits.content_hash(image_data)
+    if digest == previous_hash:
+        return path, digest, None
+    return path, digest, traits.analyze_image_bytes(image_data, digest=digest)
+
+
+def sidecar_path(image_path):
+    return image_path + SIDECAR_SUFFIX
+
+
+def plan(directory, manifest, force):
+    """
+    Decide which images need work
+
+    Returns:
+        tuple: (list of (path, previous hash) to process, number skipped outright)
+    """
+    todo, skipped = [], 0
+    for entry in iter_images(directory):
+        stat = entry.stat()
+        previous = manifest.get(os.path.relpath(entry.path, directory))
+        # A previous result is only reusable if it matches the current schema and its sidecar is still there
+        reusable = (
+            not force
+            and previous is not None
+            and previous.get('schema') == traits.VERSION
+            and os.path.exists(sidecar_path(entry.path))
+        )
+        if reusable and previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+            skipped += 1
+            continue
+        # Touched but possibly identical bytes: the worker compares hashes before analyzing
+        todo.append((entry.path, previous.get('content_hash') if reusable else None))
+    return todo, skipped
+
+
+def run(directories, workers=None, force=False):
+    """
+    Analyze every image under the given directories
+
+    Returns:
+        dict: Counts of analyzed, unchanged, skipped and failed images
+    """
+    totals = {'analyzed': 0, 'unchanged': 0, 'skipped': 0, 'failed': 0}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for directory in directories:
+            if not os.path.isdir(directory):
+                print(f"Skipping {directory}: not a directory")
+                continue
+
+            manifest_path = os.path.join(directory, MANIFEST_NAME)
+            manifest = load_manifest(manifest_path)
+            todo, skipped = plan(directory, manifest, force)
+            totals['skipped'] += skipped
+            print(f"{directory}: {len(todo)} to check, {skipped} unchanged since last run")
+
+            futures = {pool.submit(analyze_file, path, previous_hash): path for path, previous_hash in todo}
+            pending_flush = 0
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    _, digest, trait_document = future.result()
+                except Exception as e:
+                    print(f"Error analyzing {path}: {str(e)}")
+                    totals['failed'] += 1
+                    continue
+
+                if trait_document is None:
+                    totals['unchanged'] += 1
+                else:
+                    name = os.path.splitext(os.path.basename(path))[0]
+                    # Same URL shape as save_image_with_metadata: /<directory>/<file>
+                    relative = os.path.relpath(path, directory).replace(os.sep, '/')
+                    image_url = f"/{os.path.basename(os.path.normpath(directory))}/{relative}"
+                    write_json_atomic(sidecar_path(path), traits.erc721_metadata(trait_document, name, image_url))
+                    totals['analyzed'] += 1
+
+                stat = os.stat(path)
+                manifest[os.path.relpath(path, directory)] = {
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'content_hash': digest,
+                    'schema': traits.VERSION
+                }
+                pending_flush += 1
+                if pending_flush >= MANIFEST_FLUSH_EVERY:
+                    write_json_atomic(manifest_path, manifest)
+                    pending_flush = 0
+
+            write_json_atomic(manifest_path, manifest)
+    return totals
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write NFT metadata sidecars for every image in the library")
+    parser.add_argument('directories', nargs='*', default=DEFAULT_DIRECTORIES,
+                        help="Directories to scan (default: generated_images uploads)")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--force', action='store_true', help="Re-analyze every image")
+    args = parser.parse_args(argv)
+
+    started = time.time()
+    totals = run(args.directories, workers=args.workers, force=args.force)
+    print(f"Done in {time.time() - started:.1f}s: {totals['analyzed']} analyzed, "
+          f"{totals['unchanged']} unchanged, {totals['skipped']} skipped, {totals['failed']} failed")
+    return 1 if totals['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,39 +1,68 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Blueprint, Flask, Response, current_app, redirect, request, jsonify, send_file, send_from_directory, stream_with_context
 from flask_cors import CORS
-import validators
 import os
-import requests
 import base64
+import export
+import gallery
+import idempotency
+import janitor
+import job_queue
 from werkzeug.utils import secure_filename
-from dotenv import load_dotenv
-from venice_api import VeniceAPI
+import metadata_store
+import metrics
+import phash
+import profiling
+import scheduler
+import settings
+import stage_timer
+import storage
+import tasks
+import traits
+from image_artifact import ImageArtifact
+from venice_api import CircuitOpenError, VeniceAPI
 import uuid
-import json
-from PIL import Image
-from io import BytesIO
+import time
 
-# Load environment variables
-load_dotenv()
-
-# Initialize Flask app
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
-CORS(app)  # Enable CORS for all routes
+# Heavy dependencies (validators, requests, httpx, Pillow) are imported where
+# they are used so worker processes start fast; see test_startup.py
 
 # Configure upload folder
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
-# Create uploads directory if it doesn't exist
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# All routes live on a blueprint so the application factory can build
+# as many independent app instances as it needs (tests, preloading servers)
+api = Blueprint('api', __name__)
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-@app.route('/api/drawing', methods=['POST'])
+def _find_near_duplicate(image_data):
+    """
+    Look an uploaded image up in the perceptual-hash index
+    
+    Args:
+        image_data (bytes): Raw image file bytes
+        
+    Returns:
+        tuple: (perceptual hash or None if the image can't be hashed,
+                {'content_hash', 'distance'} of the closest match or None)
+    """
+    try:
+        with stage_timer.stage('phash'):
+            value = phash.dhash_bytes(image_data)
+            match = phash.get_index().nearest(value, settings.DUPLICATE_DISTANCE)
+    except Exception as e:
+        print(f"Error hashing upload: {str(e)}")
+        return None, None
+    if match is None:
+        return value, None
+    distance, digest = match
+    return value, {'content_hash': digest, 'distance': distance}
+
+@api.route('/api/drawing', methods=['POST'])
 def submit_drawing():
     """
     Endpoint to accept a child's drawing submission
@@ -59,6 +88,7 @@ def submit_drawing():
             }), 400
         
         # Validate imageUrl is a valid URL
+        import validators
         if not validators.url(data['imageUrl']):
             return jsonify({
                 'success': False,
@@ -86,6 +116,14 @@ def submit_drawing():
                 'error': "Animal must be a non-empty string."
             }), 400
         
+        metadata_store.record_safely(
+            'drawing',
+            holdjar_id=data['holdjarID'],
+            name=data['name'],
+            subject=data['animal'],
+            source_url=data['imageUrl']
+        )
+        
         # If all validations pass, return success response
         return jsonify({
             'success': True,
@@ -135,49 +173,246 @@ def submit_drawing():
             'error': "Animal field is required"
         }), 400
     
+    image_data = file.read()
+    file.seek(0)
+    
+    # Check the perceptual-hash index for near-duplicates of earlier submissions
+    image_hash, duplicate = None, None
+    if settings.DUPLICATE_POLICY != 'off':
+        image_hash, duplicate = _find_near_duplicate(image_data)
+        if duplicate and settings.DUPLICATE_POLICY == 'reject':
+            return jsonify({
+                'success': False,
+                'error': "This drawing is too similar to one that was already submitted.",
+                'duplicate_of': duplicate
+            }), 409
+    
     # Save the file
     filename = secure_filename(file.filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
     file.save(file_path)
+    storage.offload(storage.storage_key(UPLOAD_FOLDER, filename), file_path)
+    janitor.JANITOR.track(file_path)
+    
+    digest = traits.content_hash(image_data)
+    if image_hash is not None:
+        phash.get_index().add(image_hash, digest)
+    
+    metadata_store.record_safely(
+        'drawing',
+        holdjar_id=holdjarID,
+        name=name,
+        subject=animal,
+        content_hash=digest,
+        file_path=file_path
+    )
+    
+    response_data = {
+        'name': name,
+        'holdjarID': holdjarID,
+        'animal': animal,
+        'filename': filename,
+        'file_path': file_path
+    }
+    if duplicate:
+        response_data['duplicate_of'] = duplicate
     
     # Return success response with file info
     return jsonify({
         'success': True,
         'message': "Drawing uploaded successfully",
-        'data': {
-            'name': name,
-            'holdjarID': holdjarID,
-            'animal': animal,
-            'filename': filename,
-            'file_path': file_path
-        }
+        'data': response_data
     }), 201
 
-@app.route('/')
+@api.route('/')
 def index():
     return send_from_directory('static', 'index.html')
 
-@app.route('/<path:path>')
+@api.route('/<path:path>')
 def static_file(path):
     return send_from_directory('static', path)
 
-@app.route('/transform', methods=['GET'])
+@api.route('/transform', methods=['GET'])
 def transform_page():
     return send_from_directory('static', 'transform.html')
 
-@app.route('/text-to-image', methods=['GET'])
+@api.route('/text-to-image', methods=['GET'])
 def text_to_image_page():
     return send_from_directory('static', 'text_to_image.html')
 
-@app.route('/static/<path:filename>')
+@api.route('/static/<path:filename>')
 def serve_static(filename):
     return send_from_directory('static', filename)
 
-@app.route('/api/status', methods=['GET'])
+def _serve_stored(directory, filename):
+    """Serve a local copy, or redirect to object storage when another node wrote the file"""
+    path = os.path.join(directory, filename)
+    if not os.path.isfile(path):
+        url = storage.remote_url(storage.storage_key(os.path.basename(directory), filename))
+        if url:
+            return redirect(url)
+    else:
+        # Last access drives the retention janitor's LRU eviction
+        janitor.JANITOR.touch(path)
+    return send_from_directory(directory, filename)
+
+@api.route('/api/items/<int:item_id>/pin', methods=['POST', 'DELETE'])
+def pin_item(item_id):
+    """
+    Exempt an item's image from retention eviction (POST) or release it (DELETE)
+    
+    Request body (JSON, optional, POST only):
+    - reason: 'pinned' (the default and only accepted value); minted images are
+      pinned when they are generated and can't be unpinned
+    """
+    item = metadata_store.STORE.get(item_id)
+    if item is None or not item['file_path']:
+        return jsonify({
+            'success': False,
+            'error': "Item not found or has no stored image."
+        }), 404
+    
+    if request.method == 'DELETE':
+        if not janitor.JANITOR.unpin(item['file_path']):
+            return jsonify({
+                'success': False,
+                'error': "Minted images can't be unpinned."
+            }), 409
+        return jsonify({'success': True, 'data': {'id': item_id, 'pinned': None}})
+    
+    reason = (request.get_json(silent=True) or {}).get('reason', 'pinned')
+    if reason != 'pinned':
+        return jsonify({
+            'success': False,
+            'error': "reason must be 'pinned'; minted images are pinned when they are generated."
+        }), 400
+    try:
+        janitor.JANITOR.pin(item['file_path'], reason)
+    except FileNotFoundError:
+        return jsonify({
+            'success': False,
+            'error': "The item's image is no longer stored on this node."
+        }), 404
+    
+    return jsonify({
+        'success': True,
+        'data': {'id': item_id, 'pinned': janitor.JANITOR.pinned(item['file_path'])}
+    })
+
+@api.route('/generated_images/<path:filename>')
+def serve_generated_image(filename):
+    return _serve_stored('generated_images', filename)
+
+@api.route('/uploads/<path:filename>')
+def serve_upload(filename):
+    return _serve_stored(current_app.config['UPLOAD_FOLDER'], filename)
+
+@api.route('/api/gallery/<holdjar_id>', methods=['GET'])
+def holdjar_gallery(holdjar_id):
+    """
+    A holdjarID's uploads and generated images, newest first
+    
+    Query parameters:
+    - limit: page size (default 24, max 100)
+    - cursor: next_cursor from the previous page
+    
+    Pages carry an ETag; polling with If-None-Match returns 304 until the
+    page changes.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', gallery.DEFAULT_PAGE_SIZE)), 1), gallery.MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'error': "limit must be an integer."
+        }), 400
+    
+    try:
+        result = gallery.page(holdjar_id, limit=limit, cursor=request.args.get('cursor'))
+    except gallery.InvalidCursor as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 400
+    
+    if request.if_none_match.contains(result['etag']):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify({
+            'success': True,
+            'holdjarID': holdjar_id,
+            'items': result['items'],
+            'next_cursor': result['next_cursor']
+        })
+    response.set_etag(result['etag'])
+    # Always revalidate, so new items show up on the next poll
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@api.route('/api/export', methods=['GET'])
+def export_collection():
+    """
+    Stream a collection's images with ERC-721 metadata
+    
+    Query parameters:
+    - holdjarID: only this wallet's items (default: the whole collection)
+    - format: 'zip' (default) or 'ndjson'
+    - after: resume after this item id
+    - images: '0' to leave images out of an NDJSON export
+    """
+    export_format = request.args.get('format', 'zip').lower()
+    if export_format not in export.FORMATS:
+        return jsonify({
+            'success': False,
+            'error': f"format must be one of: {', '.join(export.FORMATS)}"
+        }), 400
+    
+    try:
+        after = int(request.args.get('after', 0))
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'error': "after must be an item id."
+        }), 400
+    
+    holdjar_id = request.args.get('holdjarID')
+    chunks = export.stream(
+        export_format,
+        holdjar_id=holdjar_id,
+        after=after,
+        image_base=request.host_url,
+        include_images=request.args.get('images', '1') != '0'
+    )
+    
+    name = secure_filename(f"kryptokids_{holdjar_id or 'collection'}_after_{after}.{export_format}")
+    mimetype = 'application/zip' if export_format == 'zip' else 'application/x-ndjson'
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{name}"'
+    })
+
+@api.route('/api/thumbnails/<int:item_id>', methods=['GET'])
+def item_thumbnail(item_id):
+    """JPEG thumbnail of a gallery item (generated on first request)"""
+    path = gallery.thumbnail_path(item_id)
+    if path is None:
+        return jsonify({
+            'success': False,
+            'error': "No image for that item."
+        }), 404
+    # Thumbnails are keyed by content hash, so they can be cached indefinitely
+    return send_file(os.path.abspath(path), mimetype='image/jpeg', max_age=31536000)
+
+@api.route('/api/status', methods=['GET'])
 def api_status():
-    """API status endpoint"""
+    """
+    API status endpoint
+    
+    Includes an operational snapshot (pool usage, in-flight calls, latency
+    percentiles, errors, circuit state, memory) read from counters that are
+    maintained as requests run, so it is cheap enough to poll frequently.
+    """
     # Check if Venice API key is available
-    venice_key = os.getenv('VENICE_API_KEY')
+    venice_key = settings.VENICE_API_KEY
     key_status = "available" if venice_key else "missing"
     
     # If key is available, show the first few characters (safely)
@@ -190,10 +425,327 @@ def api_status():
         'status': 'online',
         'version': '1.0.0',
         'venice_api_key_status': key_status,
-        'venice_api_key_preview': key_preview
+        'venice_api_key_preview': key_preview,
+        'operational': metrics.status_snapshot()
+    })
+
+@api.route('/api/tasks/<task_id>', methods=['GET'])
+def task_status(task_id):
+    """
+    Status of a background task
+    
+    `status` is queued, running, succeeded or failed; `result` holds the
+    task's output (for text-to-image post-processing: image_url and
+    nft_traits) and `error` the failure message.
+    """
+    task = tasks.RUNNER.get(task_id)
+    if task is None:
+        return jsonify({
+            'success': False,
+            'error': "Unknown or expired task."
+        }), 404
+    
+    return jsonify({
+        'success': True,
+        'task': task
+    })
+
+@api.route('/api/jobs', methods=['POST'])
+def create_job():
+    """
+    Queue a text-to-image generation for the job workers (see job_queue.py)
+    
+    Expects the same JSON payload as /api/text-to-image and returns 202 with
+    the job ID straight away; poll GET /api/jobs/<job_id> for the result.
+    """
+    data = request.get_json(silent=True) or {}
+    error = _validate_text_to_image_request(data)
+    if error:
+        return error
+    
+    payload = {field: data[field] for field in ('name', 'holdjarID', 'description', 'style')}
+    payload['lane'] = scheduler.request_lane(request.headers)
+    try:
+        job_id, _ = job_queue.enqueue('text_to_image', payload)
+    except Exception as e:
+        print(f"Error queueing job: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': "The job queue is unavailable, please try again."
+        }), 503
+    
+    status_url = f"/api/jobs/{job_id}"
+    return jsonify({
+        'success': True,
+        'data': {'job_id': job_id, 'status': 'queued', 'status_url': status_url}
+    }), 202, {'Location': status_url}
+
+@api.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    Status of a queued job
+    
+    `status` is queued, running, succeeded, failed or dead (given up after
+    JOB_MAX_ATTEMPTS); `result` holds image_url and nft_traits once it succeeds.
+    """
+    job = None
+    if len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id):
+        job = job_queue.get_broker().get(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': "Unknown job."
+        }), 404
+    
+    return jsonify({
+        'success': True,
+        'job': job
+    })
+
+@api.route('/api/collection/stats', methods=['GET'])
+def collection_stats():
+    """
+    Collection-wide trait statistics
+    
+    Served from the rarity engine's incremental counters; nothing is rescanned.
+    Optional query parameter `top` sets how many of the rarest trait
+    combinations to list (default 10, max 100).
+    """
+    import rarity
+    try:
+        top = min(max(int(request.args.get('top', 10)), 0), 100)
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'error': "top must be an integer."
+        }), 400
+    
+    return jsonify({
+        'success': True,
+        'collection': rarity.get_engine().stats(top=top)
     })
 
-@app.route('/api/transform-drawing', methods=['POST'])
+@api.route('/api/collection/rarity/<content_hash>', methods=['GET'])
+def collection_rarity(content_hash):
+    """
+    Current rarity score, rank and tier of a minted image
+    
+    Ranks move as the collection grows, so this is the live value; the
+    `rarity` block in the image's traits is the value at mint time.
+    """
+    import rarity
+    result = rarity.get_engine().rarity_of(content_hash.lower())
+    if result is None:
+        return jsonify({
+            'success': False,
+            'error': "No minted image with that content hash."
+        }), 404
+    
+    return jsonify({
+        'success': True,
+        'content_hash': content_hash.lower(),
+        'rarity': result
+    })
+
+def _scheduler_identity(data):
+    """Who a generation counts against: the holdjarID, or the client address without one"""
+    return (data or {}).get('holdjarID') or request.remote_addr
+
+def _over_quota_error(e):
+    """
+    429 (or 503 when the server is saturated or Venice's circuit is open) with a precise Retry-After
+    
+    Args:
+        e (scheduler.OverQuota or CircuitOpenError): The pushback, with status_code and retry_after
+    """
+    retry_after = scheduler.retry_after_header(e)
+    return jsonify({
+        'success': False,
+        'error': f"{str(e)}. Please try again in {retry_after} seconds.",
+        'retry_after': int(retry_after)
+    }), e.status_code, {'Retry-After': retry_after}
+
+def _missing_fields_error(data, required_fields, needs_image=False):
+    """
+    Check a JSON payload for required fields
+    
+    Args:
+        data (dict): Request payload
+        required_fields (list): Field names that must be present
+        needs_image (bool): Whether imageUrl or base64Image is also required
+        
+    Returns:
+        tuple: Flask error response, or None if nothing is missing
+    """
+    missing_fields = [field for field in required_fields if field not in data]
+    
+    # Check if image is provided either as URL or base64
+    if needs_image and 'imageUrl' not in data and 'base64Image' not in data:
+        missing_fields.append('imageUrl or base64Image')
+    
+    if missing_fields:
+        return jsonify({
+            'success': False,
+            'error': f"Missing required fields: {', '.join(missing_fields)}"
+        }), 400
+    return None
+
+def _holdjar_id_error(data, required=True):
+    """
+    Check the payload's holdjarID is a non-empty string
+    
+    It keys the metadata store and the scheduler's per-wallet queues, so a
+    list or object must be turned away here rather than fail further down.
+    
+    Returns:
+        tuple: Flask error response, or None if holdjarID is valid
+    """
+    holdjar_id = data.get('holdjarID')
+    if holdjar_id is None and not required:
+        return None
+    if not holdjar_id or not isinstance(holdjar_id, str):
+        return jsonify({
+            'success': False,
+            'error': "holdjarID must be a non-empty string."
+        }), 400
+    return None
+
+def _base64_source_image(data):
+    """Return the payload's base64Image as a data URI"""
+    with stage_timer.stage('base64'):
+        # Use the provided base64 image directly
+        source_image_base64 = data['base64Image']
+        # Ensure it has the proper format prefix if not already present
+        if not source_image_base64.startswith('data:image/'):
+            image_format = 'png'  # Default format assumption
+            source_image_base64 = f"data:image/{image_format};base64,{source_image_base64}"
+    return source_image_base64
+
+def _image_data_uri(image_bytes, content_type):
+    """Encode downloaded image bytes as a data URI"""
+    # Convert to base64
+    with stage_timer.stage('base64'):
+        image_base64 = base64.b64encode(image_bytes).decode('utf-8')
+    
+    # Detect image format from content
+    image_format = (content_type or 'image/png').split('/')[-1]
+    
+    # Create the full base64 data URI
+    return f"data:image/{image_format};base64,{image_base64}"
+
+def _invalid_url_error():
+    return jsonify({
+        'success': False,
+        'error': "Invalid imageUrl. Please provide a valid URL."
+    }), 400
+
+def _fetch_failed_error(status_code):
+    return jsonify({
+        'success': False,
+        'error': f"Failed to fetch image from URL: {status_code}"
+    }), 400
+
+def _resolve_source_image(data):
+    """
+    Get the source image for a request as a base64 data URI
+    
+    Args:
+        data (dict): Request payload with imageUrl or base64Image
+        
+    Returns:
+        tuple: (data URI, None) on success or (None, Flask error response)
+    """
+    if 'base64Image' in data:
+        return _base64_source_image(data), None
+    
+    # Download image from URL
+    import validators
+    if not validators.url(data['imageUrl']):
+        return None, _invalid_url_error()
+    
+    # Download the image
+    import requests
+    with stage_timer.stage('fetch_source'):
+        image_response = requests.get(data['imageUrl'])
+    if image_response.status_code != 200:
+        return None, _fetch_failed_error(image_response.status_code)
+    
+    return _image_data_uri(image_response.content, image_response.headers.get('Content-Type')), None
+
+async def _aresolve_source_image(data):
+    """Async version of _resolve_source_image - awaits the imageUrl download"""
+    if 'base64Image' in data:
+        return _base64_source_image(data), None
+    
+    import validators
+    if not validators.url(data['imageUrl']):
+        return None, _invalid_url_error()
+    
+    import httpx
+    with stage_timer.stage('fetch_source'):
+        # Per call: the event loop this runs on is discarded after the request
+        async with httpx.AsyncClient(timeout=VeniceAPI.ASYNC_TIMEOUT) as client:
+            image_response = await client.get(data['imageUrl'])
+    if image_response.status_code != 200:
+        return None, _fetch_failed_error(image_response.status_code)
+    
+    # Base64 encoding multi-megabyte images is CPU work - keep it off the event loop
+    data_uri = await profiling.to_thread(
+        _image_data_uri, image_response.content, image_response.headers.get('Content-Type'))
+    return data_uri, None
+
+def _validate_transform_request(data):
+    """Validate a /api/transform-drawing payload, returning an error response or None"""
+    error = _missing_fields_error(data, ['name', 'holdjarID', 'animal', 'style'], needs_image=True)
+    if error:
+        return error
+    error = _holdjar_id_error(data)
+    if error:
+        return error
+    
+    # Validate style is either 'photorealistic' or 'cartoon'
+    if data['style'].lower() not in ['photorealistic', 'cartoon']:
+        return jsonify({
+            'success': False,
+            'error': "Style must be either 'photorealistic' or 'cartoon'"
+        }), 400
+    return None
+
+def _transform_response(prompt, data, result):
+    metadata_store.record_safely(
+        'transform',
+        holdjar_id=data['holdjarID'],
+        name=data['name'],
+        subject=data['animal'],
+        prompt=prompt,
+        style=data['style'],
+        venice_id=result.get('id'),
+        source_url=data.get('imageUrl')
+    )
+    
+    # Return the generated image(s)
+    return jsonify({
+        'success': True,
+        'message': "Drawing transformed successfully",
+        'data': {
+            'original_prompt': prompt,
+            'style': data['style'],
+            'images': result.get('images', []),
+            'id': result.get('id'),
+            'timing': result.get('timing', {})
+        }
+    }), 200
+
+def _transform_error(e):
+    # Log the error (you may want to add proper logging)
+    print(f"Error transforming drawing: {str(e)}")
+    
+    return jsonify({
+        'success': False,
+        'error': f"Failed to transform drawing: {str(e)}"
+    }), 500
+
+@api.route('/api/transform-drawing', methods=['POST'])
 def transform_drawing():
     """
     Endpoint to transform a child's drawing using Venice AI image generation API
@@ -208,73 +760,26 @@ def transform_drawing():
     try:
         data = request.get_json()
         
-        # Validate required fields exist
-        required_fields = ['name', 'holdjarID', 'animal', 'style']
-        missing_fields = [field for field in required_fields if field not in data]
-        
-        # Check if image is provided either as URL or base64
-        if 'imageUrl' not in data and 'base64Image' not in data:
-            missing_fields.append('imageUrl or base64Image')
-        
-        if missing_fields:
-            return jsonify({
-                'success': False,
-                'error': f"Missing required fields: {', '.join(missing_fields)}"
-            }), 400
-        
-        # Validate style is either 'photorealistic' or 'cartoon'
-        if data['style'].lower() not in ['photorealistic', 'cartoon']:
-            return jsonify({
-                'success': False,
-                'error': "Style must be either 'photorealistic' or 'cartoon'"
-            }), 400
+        with stage_timer.stage('validate'):
+            error = _validate_transform_request(data)
+        if error:
+            return error
         
         # Initialize Venice API client
         venice_client = VeniceAPI()
         
         # Get the source image
-        source_image_base64 = None
-        
-        if 'base64Image' in data:
-            # Use the provided base64 image directly
-            source_image_base64 = data['base64Image']
-            # Ensure it has the proper format prefix if not already present
-            if not source_image_base64.startswith('data:image/'):
-                image_format = 'png'  # Default format assumption
-                source_image_base64 = f"data:image/{image_format};base64,{source_image_base64}"
-        elif 'imageUrl' in data:
-            # Download image from URL
-            if not validators.url(data['imageUrl']):
-                return jsonify({
-                    'success': False,
-                    'error': "Invalid imageUrl. Please provide a valid URL."
-                }), 400
-                
-            # Download the image
-            image_response = requests.get(data['imageUrl'])
-            if image_response.status_code != 200:
-                return jsonify({
-                    'success': False,
-                    'error': f"Failed to fetch image from URL: {image_response.status_code}"
-                }), 400
-                
-            # Convert to base64
-            image_bytes = image_response.content
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-            
-            # Detect image format from content
-            content_type = image_response.headers.get('Content-Type', 'image/png')
-            image_format = content_type.split('/')[-1]
-            
-            # Create the full base64 data URI
-            source_image_base64 = f"data:image/{image_format};base64,{image_base64}"
+        source_image_base64, error = _resolve_source_image(data)
+        if error:
+            return error
         
         # Build prompt for image generation
-        prompt = venice_client.build_prompt(
-            child_name=data['name'],
-            animal=data['animal'],
-            style=data['style']
-        )
+        with stage_timer.stage('build_prompt'):
+            prompt = venice_client.build_prompt(
+                child_name=data['name'],
+                animal=data['animal'],
+                style=data['style']
+            )
         
         # Call Venice API to generate the transformed image
         try:
@@ -284,44 +789,133 @@ def transform_drawing():
             
             # We'll skip passing the source image for now as it causes issues
             # Simply using the prompt to guide the generation
-            result = venice_client.generate_image(
-                prompt=prompt,
-                style=data['style'],
-                source_image_base64=None  # Skip source image
-            )
+            # A cached response for the same animal and style skips the scheduler queue entirely
+            call = dict(child_name=data['name'], animal=data['animal'], style=data['style'])
+            result = venice_client.cached_result('generate_image', **call)
+            if result is None:
+                with scheduler.SCHEDULER.slot(_scheduler_identity(data), scheduler.request_lane(request.headers)):
+                    result = venice_client.generate_image(
+                        prompt=prompt,
+                        style=data['style'],
+                        source_image_base64=None  # Skip source image
+                    )
+                venice_client.cache_result('generate_image', result, **call)
             
-            # Return the generated image(s)
-            return jsonify({
-                'success': True,
-                'message': "Drawing transformed successfully",
-                'data': {
-                    'original_prompt': prompt,
-                    'style': data['style'],
-                    'images': result.get('images', []),
-                    'id': result.get('id'),
-                    'timing': result.get('timing', {})
-                }
-            }), 200
+            return _transform_response(prompt, data, result)
             
+        except (scheduler.OverQuota, CircuitOpenError) as e:
+            return _over_quota_error(e)
         except Exception as e:
-            # Log the error (you may want to add proper logging)
-            print(f"Error transforming drawing: {str(e)}")
-            
-            return jsonify({
-                'success': False,
-                'error': f"Failed to transform drawing: {str(e)}"
-            }), 500
+            return _transform_error(e)
         
     except Exception as e:
-        # Log the error (you may want to add proper logging)
-        print(f"Error transforming drawing: {str(e)}")
+        return _transform_error(e)
+
+async def transform_drawing_async():
+    """Async version of transform_drawing with the same JSON contract"""
+    try:
+        data = request.get_json()
         
-        return jsonify({
-            'success': False,
-            'error': f"Failed to transform drawing: {str(e)}"
-        }), 500
+        with stage_timer.stage('validate'):
+            error = _validate_transform_request(data)
+        if error:
+            return error
+        
+        venice_client = VeniceAPI()
+        
+        source_image_base64, error = await _aresolve_source_image(data)
+        if error:
+            return error
+        
+        with stage_timer.stage('build_prompt'):
+            prompt = venice_client.build_prompt(
+                child_name=data['name'],
+                animal=data['animal'],
+                style=data['style']
+            )
+        
+        try:
+            print("Calling Venice API (async) with the following parameters:")
+            print(f"Prompt: {prompt}")
+            print(f"Style: {data['style']}")
+            
+            call = dict(child_name=data['name'], animal=data['animal'], style=data['style'])
+            # The prompt cache is SQLite, and a store writes the whole Venice response - keep it off the event loop
+            result = await profiling.to_thread(venice_client.cached_result, 'generate_image', **call)
+            if result is None:
+                async with scheduler.SCHEDULER.aslot(_scheduler_identity(data), scheduler.request_lane(request.headers)):
+                    result = await venice_client.agenerate_image(
+                        prompt=prompt,
+                        style=data['style'],
+                        source_image_base64=None  # Skip source image
+                    )
+                await profiling.to_thread(venice_client.cache_result, 'generate_image', result, **call)
+            
+            return _transform_response(prompt, data, result)
+            
+        except (scheduler.OverQuota, CircuitOpenError) as e:
+            return _over_quota_error(e)
+        except Exception as e:
+            return _transform_error(e)
+        
+    except Exception as e:
+        return _transform_error(e)
+
+def _inpaint_params(data):
+    """Pull the inpainting parameters out of a request payload"""
+    return {
+        'prompt': data['prompt'],
+        'object_target': data['objectTarget'],
+        'inferred_object': data.get('inferredObject'),  # Optional
+        'strength': int(data.get('strength', 50)),  # Optional, default: 50
+        'style': data.get('style', 'Photographic'),  # Optional, default: Photographic
+        'holdjar_id': data.get('holdjarID'),  # Optional, recorded in the metadata store
+        'source_url': data.get('imageUrl')
+    }
+
+def _log_inpaint_call(params):
+    print("Calling Venice API inpainting with the following parameters:")
+    print(f"Prompt: {params['prompt']}")
+    print(f"Object Target: {params['object_target']}")
+    print(f"Inferred Object: {params['inferred_object']}")
+    print(f"Strength: {params['strength']}")
 
-@app.route('/api/inpaint', methods=['POST'])
+def _inpaint_response(params, result):
+    metadata_store.record_safely(
+        'inpaint',
+        holdjar_id=params['holdjar_id'],
+        subject=params['object_target'],
+        prompt=params['prompt'],
+        style=params['style'],
+        venice_id=result.get('id'),
+        source_url=params['source_url']
+    )
+    
+    # Return the generated image(s)
+    return jsonify({
+        'success': True,
+        'message': "Image inpainted successfully",
+        'data': {
+            'prompt': params['prompt'],
+            'objectTarget': params['object_target'],
+            'inferredObject': params['inferred_object'],
+            'strength': params['strength'],
+            'images': result.get('images', []),
+            'id': result.get('id'),
+            'timing': result.get('timing', {})
+        }
+    }), 200
+
+def _inpaint_error(e):
+    # Log the error
+    print(f"Error inpainting image: {str(e)}")
+    
+    return jsonify({
+        'success': False,
+        'error': f"Failed to inpaint image: {str(e)}"
+    }), 500
+
+@api.route('/api/inpaint', methods=['POST'])
 def inpaint_drawing():
     """
     Endpoint to inpaint a specific part of an image using Venice AI's defined mask inpainting
@@ -337,121 +931,227 @@ def inpaint_drawing():
     try:
         data = request.get_json()
         
-        # Validate required fields exist
-        required_fields = ['prompt', 'objectTarget']
-        missing_fields = [field for field in required_fields if field not in data]
-        
-        # Check if image is provided either as URL or base64
-        if 'imageUrl' not in data and 'base64Image' not in data:
-            missing_fields.append('imageUrl or base64Image')
-        
-        if missing_fields:
-            return jsonify({
-                'success': False,
-                'error': f"Missing required fields: {', '.join(missing_fields)}"
-            }), 400
+        with stage_timer.stage('validate'):
+            error = _missing_fields_error(data, ['prompt', 'objectTarget'], needs_image=True) or \
+                _holdjar_id_error(data, required=False)
+        if error:
+            return error
         
         # Initialize Venice API client
         venice_client = VeniceAPI()
         
         # Get the source image
-        source_image_base64 = None
-        
-        if 'base64Image' in data:
-            # Use the provided base64 image directly
-            source_image_base64 = data['base64Image']
-            # Ensure it has the proper format prefix if not already present
-            if not source_image_base64.startswith('data:image/'):
-                image_format = 'png'  # Default format assumption
-                source_image_base64 = f"data:image/{image_format};base64,{source_image_base64}"
-        elif 'imageUrl' in data:
-            # Download image from URL
-            if not validators.url(data['imageUrl']):
-                return jsonify({
-                    'success': False,
-                    'error': "Invalid imageUrl. Please provide a valid URL."
-                }), 400
-                
-            # Download the image
-            image_response = requests.get(data['imageUrl'])
-            if image_response.status_code != 200:
-                return jsonify({
-                    'success': False,
-                    'error': f"Failed to fetch image from URL: {image_response.status_code}"
-                }), 400
-                
-            # Convert to base64
-            image_bytes = image_response.content
-            image_base64 = base64.b64encode(image_bytes).decode('utf-8')
-            
-            # Detect image format from content
-            content_type = image_response.headers.get('Content-Type', 'image/png')
-            image_format = content_type.split('/')[-1]
-            
-            # Create the full base64 data URI
-            source_image_base64 = f"data:image/{image_format};base64,{image_base64}"
+        source_image_base64, error = _resolve_source_image(data)
+        if error:
+            return error
         
         # Get the other parameters
-        prompt = data['prompt']
-        object_target = data['objectTarget']
-        inferred_object = data.get('inferredObject')  # Optional
-        strength = int(data.get('strength', 50))  # Optional, default: 50
-        style = data.get('style', 'Photographic')  # Optional, default: Photographic
+        params = _inpaint_params(data)
         
         # Call Venice API to inpaint the image with defined mask
         try:
-            print("Calling Venice API inpainting with the following parameters:")
-            print(f"Prompt: {prompt}")
-            print(f"Object Target: {object_target}")
-            print(f"Inferred Object: {inferred_object}")
-            print(f"Strength: {strength}")
+            _log_inpaint_call(params)
             
             # Use the new inpaint_image method from VeniceAPI
-            result = venice_client.inpaint_image(
-                source_image_base64=source_image_base64,
-                prompt=prompt,
-                object_target=object_target,
-                inferred_object=inferred_object,
-                strength=strength,
-                model="fluently-xl",
-                width=1024,
-                height=1024
-            )
+            with scheduler.SCHEDULER.slot(_scheduler_identity(data), scheduler.request_lane(request.headers)):
+                result = venice_client.inpaint_image(
+                    source_image_base64=source_image_base64,
+                    prompt=params['prompt'],
+                    object_target=params['object_target'],
+                    inferred_object=params['inferred_object'],
+                    strength=params['strength'],
+                    model="fluently-xl",
+                    width=1024,
+                    height=1024
+                )
             
-            # Return the generated image(s)
-            return jsonify({
-                'success': True,
-                'message': "Image inpainted successfully",
-                'data': {
-                    'prompt': prompt,
-                    'objectTarget': object_target,
-                    'inferredObject': inferred_object,
-                    'strength': strength,
-                    'images': result.get('images', []),
-                    'id': result.get('id'),
-                    'timing': result.get('timing', {})
-                }
-            }), 200
+            return _inpaint_response(params, result)
             
+        except (scheduler.OverQuota, CircuitOpenError) as e:
+            return _over_quota_error(e)
         except Exception as e:
-            # Log the error
-            print(f"Error inpainting image: {str(e)}")
-            
-            return jsonify({
-                'success': False,
-                'error': f"Failed to inpaint image: {str(e)}"
-            }), 500
+            return _inpaint_error(e)
         
     except Exception as e:
-        # Log the error
-        print(f"Error inpainting image: {str(e)}")
+        return _inpaint_error(e)
+
+async def inpaint_drawing_async():
+    """Async version of inpaint_drawing with the same JSON contract"""
+    try:
+        data = request.get_json()
+        
+        with stage_timer.stage('validate'):
+            error = _missing_fields_error(data, ['prompt', 'objectTarget'], needs_image=True) or \
+                _holdjar_id_error(data, required=False)
+        if error:
+            return error
+        
+        venice_client = VeniceAPI()
+        
+        source_image_base64, error = await _aresolve_source_image(data)
+        if error:
+            return error
+        
+        params = _inpaint_params(data)
+        
+        try:
+            _log_inpaint_call(params)
+            
+            async with scheduler.SCHEDULER.aslot(_scheduler_identity(data), scheduler.request_lane(request.headers)):
+                result = await venice_client.ainpaint_image(
+                    source_image_base64=source_image_base64,
+                    prompt=params['prompt'],
+                    object_target=params['object_target'],
+                    inferred_object=params['inferred_object'],
+                    strength=params['strength'],
+                    model="fluently-xl",
+                    width=1024,
+                    height=1024
+                )
+            
+            return _inpaint_response(params, result)
+            
+        except (scheduler.OverQuota, CircuitOpenError) as e:
+            return _over_quota_error(e)
+        except Exception as e:
+            return _inpaint_error(e)
         
+    except Exception as e:
+        return _inpaint_error(e)
+
+def _validate_text_to_image_request(data):
+    """Validate a /api/text-to-image payload, returning an error response or None"""
+    error = _missing_fields_error(data, ['name', 'holdjarID', 'description', 'style'])
+    if error:
+        return error
+    error = _holdjar_id_error(data)
+    if error:
+        return error
+    
+    # Validate style is one of the supported options
+    if data['style'].lower() not in ['cartoon', 'watercolor', 'sketch']:
         return jsonify({
             'success': False,
-            'error': f"Failed to inpaint image: {str(e)}"
-        }), 500
+            'error': "Style must be either 'cartoon', 'watercolor', or 'sketch'"
+        }), 400
+    return None
+
+def _log_text_to_image_call(data):
+    print("Calling Venice API for text-to-image generation with the following parameters:")
+    print(f"Child Name: {data['name']}")
+    print(f"Description: {data['description']}")
+    print(f"Style: {data['style']}")
+
+def _generated_filename(child_name):
+    """Generate a unique filename for a generated image"""
+    unique_id = uuid.uuid4().hex[:8]
+    timestamp = int(time.time())
+    return f"{child_name.lower().replace(' ', '_')}_{unique_id}_{timestamp}.png"
 
-@app.route('/api/text-to-image', methods=['POST'])
+def _no_images_error():
+    return jsonify({
+        'success': False,
+        'error': "No images were generated"
+    }), 500
+
+def _post_process_generated(venice_client, artifact, filename, item):
+    """
+    Save a generated image, compute its NFT traits and record it
+    
+    Runs inline, or as a background task when DEFER_POST_PROCESSING is on.
+    
+    Args:
+        venice_client (VeniceAPI): Client used for saving and analysis
+        artifact (ImageArtifact): The generated image
+        filename (str): Filename to save the image as
+        item (dict): Request fields for the metadata store
+        
+    Returns:
+        dict: image_url and nft_traits
+    """
+    # Save the image and get its URL
+    image_url = venice_client.save_image_with_metadata(base64_image=artifact, filename=filename)
+    janitor.JANITOR.track(image_url.lstrip('/'))
+    
+    # Analyze the image to generate NFT traits, then count the mint in the rarity tables and phash index
+    nft_traits = venice_client.analyze_image_for_traits(artifact)
+    nft_traits = traits.record_mint(artifact.content_hash, nft_traits, image=artifact.image)
+    janitor.JANITOR.mint(image_url.lstrip('/'))
+    
+    metadata_store.record_safely(
+        'generation',
+        content_hash=artifact.content_hash,
+        image_url=image_url,
+        file_path=image_url.lstrip('/'),
+        traits=nft_traits,
+        **item
+    )
+    
+    # The decoded copy isn't needed any more; only the encoded form goes into the response
+    artifact.release()
+    return {'image_url': image_url, 'nft_traits': nft_traits}
+
+def _generation_item(data, result):
+    """Metadata store fields for a text-to-image request"""
+    return {
+        'holdjar_id': data['holdjarID'],
+        'name': data['name'],
+        'prompt': data['description'],
+        'style': data['style'],
+        'venice_id': result.get('id')
+    }
+
+def _defer_post_processing(venice_client, artifact, filename, item):
+    """
+    Queue save and trait analysis to run after the response
+    
+    Returns:
+        Task: The queued task, or None if the background queue is full
+    """
+    # Decode now: the task needs the bytes, the response only the data URI
+    artifact.decode()
+    try:
+        return tasks.RUNNER.submit('text_to_image_post_processing',
+                                   _post_process_generated, venice_client, artifact, filename, item)
+    except tasks.TaskQueueFull as e:
+        print(f"Background queue full, post-processing inline: {str(e)}")
+        return None
+
+def _text_to_image_response(data, result, image_blob, image_url, nft_traits, task=None):
+    response_data = {
+        'name': data['name'],
+        'description': data['description'],
+        'style': data['style'],
+        'image_url': image_url,  # URL to the saved image
+        'image_blob': image_blob,  # Base64 data URI
+        'nft_traits': nft_traits,  # NFT metadata traits
+        'id': result.get('id')
+    }
+    if task is not None:
+        # image_url and nft_traits arrive through the task status endpoint
+        response_data['task'] = {
+            'id': task.id,
+            'status': task.status,
+            'status_url': f"/api/tasks/{task.id}"
+        }
+    
+    # Return the generated image and traits
+    return jsonify({
+        'success': True,
+        'message': "Your magical drawing is ready!",
+        'data': response_data
+    }), 200
+
+def _text_to_image_error(e):
+    # Log the error
+    print(f"Error generating image from text: {str(e)}")
+    
+    return jsonify({
+        'success': False,
+        'error': f"Failed to create your drawing: {str(e)}"
+    }), 500
+
+@api.route('/api/text-to-image', methods=['POST'])
 def text_to_image():
     """
     Endpoint for kid-friendly text-to-image generation
@@ -469,89 +1169,105 @@ def text_to_image():
     try:
         data = request.get_json()
         
-        # Validate required fields exist
-        required_fields = ['name', 'holdjarID', 'description', 'style']
-        missing_fields = [field for field in required_fields if field not in data]
-        
-        if missing_fields:
-            return jsonify({
-                'success': False,
-                'error': f"Missing required fields: {', '.join(missing_fields)}"
-            }), 400
-        
-        # Validate style is one of the supported options
-        if data['style'].lower() not in ['cartoon', 'watercolor', 'sketch']:
-            return jsonify({
-                'success': False,
-                'error': "Style must be either 'cartoon', 'watercolor', or 'sketch'"
-            }), 400
+        with stage_timer.stage('validate'):
+            error = _validate_text_to_image_request(data)
+        if error:
+            return error
         
         # Initialize Venice API client
         venice_client = VeniceAPI()
         
         # Call Venice API to generate the image from text
         try:
-            print("Calling Venice API for text-to-image generation with the following parameters:")
-            print(f"Child Name: {data['name']}")
-            print(f"Description: {data['description']}")
-            print(f"Style: {data['style']}")
+            _log_text_to_image_call(data)
             
-            # Generate image using kid-friendly guardrails
-            result = venice_client.text_to_image_for_kids(
-                child_name=data['name'],
-                description=data['description'],
-                style=data['style']
-            )
+            # Generate image using kid-friendly guardrails, in this wallet's fair share of Venice,
+            # unless the same request is already cached
+            call = dict(child_name=data['name'], description=data['description'], style=data['style'])
+            result = venice_client.cached_result('text_to_image_for_kids', **call)
+            if result is None:
+                with scheduler.SCHEDULER.slot(_scheduler_identity(data), scheduler.request_lane(request.headers)):
+                    result = venice_client.text_to_image_for_kids(**call)
+                venice_client.cache_result('text_to_image_for_kids', result, **call)
             
             # Check if we got images back
             if not result.get('images') or len(result.get('images', [])) == 0:
-                return jsonify({
-                    'success': False,
-                    'error': "No images were generated"
-                }), 500
+                return _no_images_error()
                 
-            # Get the first generated image
-            base64_image = result['images'][0]
+            # Take the first generated image out of the result; the artifact
+            # decodes it once and shares the bytes with every later stage
+            artifact = ImageArtifact(result.pop('images')[0])
             
             # Generate a unique filename
-            import uuid
-            import time
-            unique_id = uuid.uuid4().hex[:8]
-            timestamp = int(time.time())
-            filename = f"{data['name'].lower().replace(' ', '_')}_{unique_id}_{timestamp}.png"
+            filename = _generated_filename(data['name'])
             
-            # Save the image and get its URL
-            image_url = venice_client.save_image_with_metadata(
-                base64_image=base64_image, 
-                filename=filename
-            )
+            # Save and analyze after the response when deferral is enabled
+            if settings.DEFER_POST_PROCESSING:
+                task = _defer_post_processing(venice_client, artifact, filename, _generation_item(data, result))
+                if task is not None:
+                    return _text_to_image_response(data, result, artifact.data_uri, None, None, task=task)
             
-            # Analyze the image to generate NFT traits
-            nft_traits = venice_client.analyze_image_for_traits(base64_image)
+            processed = _post_process_generated(venice_client, artifact, filename, _generation_item(data, result))
             
-            # Return the generated image and traits
-            return jsonify({
-                'success': True,
-                'message': "Your magical drawing is ready!",
-                'data': {
-                    'name': data['name'],
-                    'description': data['description'],
-                    'style': data['style'],
-                    'image_url': image_url,  # URL to the saved image
-                    'image_blob': f"data:image/png;base64,{base64_image}",  # Base64 data URI
-                    'nft_traits': nft_traits,  # NFT metadata traits
-                    'id': result.get('id')
-                }
-            }), 200
+            return _text_to_image_response(data, result, artifact.data_uri,
+                                           processed['image_url'], processed['nft_traits'])
             
+        except (scheduler.OverQuota, CircuitOpenError) as e:
+            return _over_quota_error(e)
         except Exception as e:
-            # Log the error
-            print(f"Error generating image from text: {str(e)}")
+            return _text_to_image_error(e)
             
-            return jsonify({
-                'success': False,
-                'error': f"Failed to create your drawing: {str(e)}"
-            }), 500
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': f"An error occurred: {str(e)}"
+        }), 500
+
+async def text_to_image_async():
+    """Async version of text_to_image with the same JSON contract"""
+    try:
+        data = request.get_json()
+        
+        with stage_timer.stage('validate'):
+            error = _validate_text_to_image_request(data)
+        if error:
+            return error
+        
+        venice_client = VeniceAPI()
+        
+        try:
+            _log_text_to_image_call(data)
+            
+            call = dict(child_name=data['name'], description=data['description'], style=data['style'])
+            # The prompt cache is SQLite, and a store writes the whole Venice response - keep it off the event loop
+            result = await profiling.to_thread(venice_client.cached_result, 'text_to_image_for_kids', **call)
+            if result is None:
+                async with scheduler.SCHEDULER.aslot(_scheduler_identity(data), scheduler.request_lane(request.headers)):
+                    result = await venice_client.atext_to_image_for_kids(**call)
+                await profiling.to_thread(venice_client.cache_result, 'text_to_image_for_kids', result, **call)
+            
+            if not result.get('images') or len(result.get('images', [])) == 0:
+                return _no_images_error()
+            
+            artifact = ImageArtifact(result.pop('images')[0])
+            filename = _generated_filename(data['name'])
+            
+            if settings.DEFER_POST_PROCESSING:
+                task = _defer_post_processing(venice_client, artifact, filename, _generation_item(data, result))
+                if task is not None:
+                    return _text_to_image_response(data, result, artifact.data_uri, None, None, task=task)
+            
+            # Disk writes and Pillow decoding block, so they run in the default executor
+            processed = await profiling.to_thread(
+                _post_process_generated, venice_client, artifact, filename, _generation_item(data, result))
+            
+            return _text_to_image_response(data, result, artifact.data_uri,
+                                           processed['image_url'], processed['nft_traits'])
+            
+        except (scheduler.OverQuota, CircuitOpenError) as e:
+            return _over_quota_error(e)
+        except Exception as e:
+            return _text_to_image_error(e)
             
     except Exception as e:
         return jsonify({
@@ -559,6 +1275,137 @@ def text_to_image():
             'error': f"An error occurred: {str(e)}"
         }), 500
 
+def _text_to_image_job(payload, job):
+    """
+    Run a queued text-to-image job on a job worker
+    
+    Jobs are delivered at least once, so every stage is checkpointed: a
+    redelivered job reloads the image it already saved through storage
+    (on any node, once it's in object storage) instead of calling Venice
+    again, and doesn't record a second metadata item. Scheduler quota
+    pushback defers the job without using up an attempt.
+    
+    Args:
+        payload (dict): name, holdjarID, description, style and lane
+        job (job_queue.Message): The delivery, with its checkpointed progress
+        
+    Returns:
+        dict: image_url and nft_traits
+    """
+    venice_client = VeniceAPI()
+    # Named after the job, so a retry overwrites rather than adds a file
+    filename = f"{payload['name'].lower().replace(' ', '_')}_{job.id[:12]}.png"
+    image_url = f"/generated_images/{filename}"
+    file_path = image_url.lstrip('/')
+    
+    artifact = None
+    if job.progress.get('saved'):
+        stored = storage.read(job.progress.get('storage_key', file_path), file_path)
+        if stored is not None:
+            artifact = ImageArtifact(base64.b64encode(stored).decode())
+            venice_id = job.progress.get('venice_id')
+    if artifact is None:
+        call = dict(child_name=payload['name'], description=payload['description'], style=payload['style'])
+        result = venice_client.cached_result('text_to_image_for_kids', **call)
+        if result is None:
+            try:
+                with scheduler.SCHEDULER.slot(payload['holdjarID'], payload.get('lane', 'interactive')):
+                    result = venice_client.text_to_image_for_kids(**call)
+            except (scheduler.OverQuota, CircuitOpenError) as e:
+                # Pushback, not a failure: run again once the quota (or Venice) allows it
+                raise job_queue.Defer(str(e), e.retry_after)
+            venice_client.cache_result('text_to_image_for_kids', result, **call)
+        if not result.get('images'):
+            raise RuntimeError("No images were generated")
+        artifact = ImageArtifact(result['images'][0])
+        # Uploaded before the checkpoint so a redelivery on another node can reload it
+        venice_client.save_image_with_metadata(base64_image=artifact, filename=filename, wait_for_upload=True)
+        janitor.JANITOR.track(file_path)
+        venice_id = result.get('id')
+        job.checkpoint(saved=True, storage_key=storage.storage_key('generated_images', filename),
+                       venice_id=venice_id)
+    
+    nft_traits = venice_client.analyze_image_for_traits(artifact)
+    # Recording a mint is a no-op for an image that was already counted
+    nft_traits = traits.record_mint(artifact.content_hash, nft_traits, image=artifact.image)
+    janitor.JANITOR.mint(file_path)
+    
+    if not job.progress.get('recorded'):
+        metadata_store.STORE.record(
+            'generation',
+            wait=True,
+            holdjar_id=payload['holdjarID'],
+            name=payload['name'],
+            prompt=payload['description'],
+            style=payload['style'],
+            venice_id=venice_id,
+            content_hash=artifact.content_hash,
+            image_url=image_url,
+            file_path=file_path,
+            traits=nft_traits
+        )
+        job.checkpoint(recorded=True)
+    
+    artifact.release()
+    return {'image_url': image_url, 'nft_traits': nft_traits}
+
+job_queue.register_handler('text_to_image', _text_to_image_job)
+
+# Async handlers swapped in by create_app when ASYNC_HANDLERS is enabled
+ASYNC_VIEWS = {
+    'api.transform_drawing': transform_drawing_async,
+    'api.inpaint_drawing': inpaint_drawing_async,
+    'api.text_to_image': text_to_image_async,
+}
+
+# Endpoints that write files or make paid Venice calls
+IDEMPOTENT_ENDPOINTS = ('api.submit_drawing', 'api.transform_drawing', 'api.inpaint_drawing', 'api.text_to_image')
+
+def create_app(config=None):
+    """
+    Application factory
+    
+    Args:
+        config (dict): Optional settings applied on top of the defaults
+        
+    Returns:
+        Flask: Configured application with all routes registered
+    """
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    app.config['ASYNC_HANDLERS'] = settings.ASYNC_HANDLERS
+    
+    if config:
+        app.config.update(config)
+    
+    CORS(app, expose_headers=['ETag', 'Idempotent-Replayed'])  # Enable CORS for all routes; pages read the gallery ETag
+    metrics.init_app(app)  # Request metrics and the /metrics endpoint
+    stage_timer.init_app(app)  # Server-Timing header per request
+    profiling.init_app(app)  # Request IDs and opt-in profiling
+    
+    # Create uploads directory if it doesn't exist
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    
+    app.register_blueprint(api)
+    
+    # Generation endpoints can run as async views that await Venice and the
+    # imageUrl download (needs flask[async] + httpx). Under WSGI, Flask runs
+    # each one in its own short-lived event loop while the request still holds
+    # a worker thread, so they add no concurrency; see README
+    if app.config['ASYNC_HANDLERS']:
+        app.view_functions.update(ASYNC_VIEWS)
+    
+    # Retries carrying the same Idempotency-Key replay the first response
+    idempotency.init_app(app, IDEMPOTENT_ENDPOINTS)
+    
+    return app
+
+# Module-level app kept for `python app.py` and existing imports;
+# production servers should go through wsgi.py / serve.py instead
+app = create_app()
+
 if __name__ == '__main__':
-    port = int(os.environ.get('PORT', 5001))  # Changed from 5000 to 5001
-    app.run(host='0.0.0.0', port=port, debug=True)
+    # Development server only - see serve.py for the production launcher
+    debug = settings.env_bool('FLASK_DEBUG', True)
+    app.run(host='0.0.0.0', port=settings.PORT, debug=debug, threaded=True)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Export a collection's images with ERC-721 metadata
+
+Writes the same ZIP or NDJSON stream as GET /api/export straight from the
+metadata store, without running the API server.
+
+Examples:
+    python export_collection.py collection.zip
+    python export_collection.py wallet.ndjson --holdjar 0x123abc --format ndjson
+    python export_collection.py wallet.ndjson --holdjar 0x123abc --format ndjson --resume
+    python export_collection.py part2.zip --after 1200
+"""
+import argparse
+import json
+import sys
+
+import export
+
+
+def last_exported_id(path):
+    """Id of the last complete line of an NDJSON export, or 0"""
+    last_id = 0
+    try:
+        with open(path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                last_id = json.loads(line)['id']
+    except FileNotFoundError:
+        pass
+    return last_id
+
+
+def truncate_partial_line(path):
+    """Drop a partially written last line so appended output stays valid NDJSON"""
+    with open(path, 'rb+') as f:
+        data_end = 0
+        for line in f:
+            if line.endswith(b'\n'):
+                data_end += len(line)
+        f.truncate(data_end)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream a collection export to a file")
+    parser.add_argument('output', help="Output file")
+    parser.add_argument('--holdjar', help="Only this holdjarID's items (default: whole collection)")
+    parser.add_argument('--format', choices=export.FORMATS, default='zip')
+    parser.add_argument('--after', type=int, default=0, help="Start after this item id")
+    parser.add_argument('--resume', action='store_true',
+                        help="NDJSON only: append to OUTPUT after its last complete item")
+    parser.add_argument('--no-images', action='store_true', help="NDJSON only: leave images out")
+    parser.add_argument('--image-base', default='', help="URL prefix for image links in the metadata")
+    args = parser.parse_args(argv)
+
+    after, mode = args.after, 'wb'
+    if args.resume:
+        if args.format != 'ndjson':
+            parser.error("--resume only works with --format ndjson; use --after with a new ZIP file")
+        try:
+            truncate_partial_line(args.output)
+        except FileNotFoundError:
+            pass
+        after, mode = max(after, last_exported_id(args.output)), 'ab'
+        print(f"Resuming after item {after}")
+
+    written = 0
+    with open(args.output, mode) as f:
+        for chunk in export.stream(args.format, holdjar_id=args.holdjar, after=after,
+                                   image_base=args.image_base, include_images=not args.no_images):
+            f.write(chunk)
+            written += len(chunk)
+    print(f"Wrote {written} bytes to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
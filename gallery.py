@@ -0,0 +1,161 @@
+"""
+Per-holdjarID gallery pages and thumbnails
+
+Pages are read from the metadata store with keyset pagination: the cursor is
+the (created_at, id) of the last item on the previous page, and each page is
+a single range scan of the partial (holdjar_id, created_at, id) index over
+items that have an image. Page cost depends only on the page size, not on
+how many items the wallet or the whole library holds - no directory scans.
+
+Thumbnails are generated on first request and cached on disk under
+THUMBNAIL_DIR, keyed by content hash, so they never go stale. They are
+tracked by the retention janitor like any other image (THUMBNAIL_DIR is one
+of the default RETENTION_DIRS) and simply regenerated after an eviction.
+"""
+import base64
+import binascii
+import hashlib
+import json
+import os
+import tempfile
+
+import janitor
+import metadata_store
+import settings
+import storage
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can't be decoded"""
+
+
+def encode_cursor(item):
+    """Opaque cursor pointing just past an item"""
+    raw = f"{item['created_at']!r}:{item['id']}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor from encode_cursor
+
+    Returns:
+        tuple: (created_at, id)
+
+    Raises:
+        InvalidCursor: If the cursor is malformed
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, item_id = raw.split(':')
+        return float(created_at), int(item_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise InvalidCursor(f"Invalid cursor: {cursor}") from e
+
+
+def image_url(item):
+    """Public URL of an item's image"""
+    if item['image_url']:
+        return item['image_url']
+    # Uploaded drawings are served from the upload folder
+    return f"/uploads/{os.path.basename(item['file_path'])}"
+
+
+def gallery_item(item):
+    """Shape a metadata row for the gallery response"""
+    return {
+        'id': item['id'],
+        'kind': item['kind'],
+        'name': item['name'],
+        'subject': item['subject'],
+        'prompt': item['prompt'],
+        'style': item['style'],
+        'created_at': item['created_at'],
+        'content_hash': item['content_hash'],
+        'image_url': image_url(item),
+        'thumbnail_url': f"/api/thumbnails/{item['id']}",
+        'traits': item['traits']
+    }
+
+
+def page(holdjar_id, limit=DEFAULT_PAGE_SIZE, cursor=None):
+    """
+    One page of a holdjarID's gallery, newest first
+
+    Args:
+        holdjar_id (str): Wallet / owner identifier
+        limit (int): Page size
+        cursor (str): Cursor from the previous page's next_cursor
+
+    Returns:
+        dict: items, next_cursor (None on the last page) and an etag for the page
+
+    Raises:
+        InvalidCursor: If the cursor is malformed
+    """
+    before = decode_cursor(cursor) if cursor else None
+    # One extra row tells us whether there is a next page
+    rows = metadata_store.STORE.gallery_items(holdjar_id, limit=limit + 1, before=before)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    items = [gallery_item(row) for row in rows]
+    next_cursor = encode_cursor(rows[-1]) if has_more else None
+
+    # Items are immutable once recorded, so the ids on the page identify its content
+    fingerprint = json.dumps([holdjar_id, limit, cursor, [row['id'] for row in rows], next_cursor])
+    etag = hashlib.sha1(fingerprint.encode()).hexdigest()
+    return {'items': items, 'next_cursor': next_cursor, 'etag': etag}
+
+
+def thumbnail_path(item_id):
+    """
+    Path of an item's thumbnail, generating it on first use
+
+    Args:
+        item_id (int): Metadata store item ID
+
+    Returns:
+        str: Thumbnail file path, or None if the item has no readable image
+    """
+    item = metadata_store.STORE.get(item_id)
+    if item is None or not item['file_path']:
+        return None
+
+    size = settings.THUMBNAIL_SIZE
+    key = item['content_hash'] or f"item{item_id}"
+    path = os.path.join(settings.THUMBNAIL_DIR, f"{key}_{size}.jpg")
+    if os.path.exists(path):
+        janitor.JANITOR.touch(path)
+        return path
+
+    from PIL import Image
+    temp_path = None
+    try:
+        # Another node's image, or one the janitor evicted, comes from object storage
+        with storage.open_file(storage.path_key(item['file_path']), item['file_path']) as source, \
+                Image.open(source) as image:
+            # JPEG sources decode straight at reduced scale
+            image.draft('RGB', (size, size))
+            image.thumbnail((size, size))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            os.makedirs(settings.THUMBNAIL_DIR, exist_ok=True)
+            # A temp file of its own, so concurrent first requests can't interleave writes
+            fd, temp_path = tempfile.mkstemp(dir=settings.THUMBNAIL_DIR, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, 'JPEG', quality=80)
+        os.replace(temp_path, path)
+    except (OSError, ValueError) as e:
+        print(f"Error creating thumbnail for item {item_id}: {str(e)}")
+        if temp_path is not None:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+        return None
+    janitor.JANITOR.track(path)
+    return path
@@ -0,0 +1,83 @@
+"""
+Gunicorn configuration for the KryptoKids API
+
+Every setting can be tuned through environment variables so the same file
+works for every deployment:
+
+    WORKER_MODEL        sync | threaded | gevent (default: threaded)
+    WEB_CONCURRENCY     number of worker processes (default: 2 x CPU + 1)
+    WORKER_THREADS      threads per worker for the threaded model (default: 8)
+    WORKER_CONNECTIONS  concurrent greenlets per worker for gevent (default: 1000)
+    WORKER_TIMEOUT      seconds before a silent worker is killed (default: 120)
+    GRACEFUL_TIMEOUT    seconds in-flight requests get to drain on shutdown (default: 60)
+    PRELOAD_APP         import the app once in the master before forking (default: true)
+    MAX_REQUESTS        recycle a worker after this many requests, 0 disables (default: 0)
+"""
+import multiprocessing
+import os
+
+# Map our worker model names onto gunicorn worker classes
+WORKER_MODELS = {
+    'sync': 'sync',          # prefork, one request per process
+    'threaded': 'gthread',   # prefork + thread pool, good default for Venice I/O
+    'gthread': 'gthread',
+    'gevent': 'gevent',      # cooperative greenlets, highest concurrency per worker
+}
+
+
+def _env_bool(name, default):
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes')
+
+
+worker_model = os.environ.get('WORKER_MODEL', 'threaded').lower()
+if worker_model not in WORKER_MODELS:
+    raise ValueError(f"Unknown WORKER_MODEL '{worker_model}'. Choose from: {', '.join(WORKER_MODELS)}")
+
+worker_class = WORKER_MODELS[worker_model]
+
+if worker_class == 'gevent':
+    # Patch the standard library before the app (and requests/ssl) is preloaded
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 5001)}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WORKER_THREADS', 8))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+
+# Venice generations regularly take 10+ seconds, so the default 30s is too tight
+timeout = int(os.environ.get('WORKER_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 60))
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+
+preload_app = _env_bool('PRELOAD_APP', True)
+max_requests = int(os.environ.get('MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', 0))
+
+accesslog = os.environ.get('ACCESS_LOG', '-')
+errorlog = os.environ.get('ERROR_LOG', '-')
+
+
+def on_starting(server):
+    server.log.info(f"Starting KryptoKids API: model={worker_model} workers={workers} "
+                    f"threads={threads} preload={preload_app}")
+    if worker_class == 'gevent' and _env_bool('ASYNC_HANDLERS', False):
+        # Flask's async views start an asyncio loop per request, which gevent doesn't cooperate with
+        server.log.warning("ASYNC_HANDLERS is not supported with the gevent worker model; use threaded workers")
+
+
+def worker_int(worker):
+    # SIGINT/SIGQUIT on a worker - note it so aborted requests are traceable
+    worker.log.info(f"Worker {worker.pid} interrupted, dropping in-flight requests")
+
+
+def worker_exit(server, worker):
+    # Let queued post-response work (image saves, trait analysis) finish,
+    # then commit the metadata rows and finish the storage uploads it queued
+    import metadata_store
+    import storage
+    import tasks
+    tasks.RUNNER.shutdown(wait=True)
+    metadata_store.STORE.flush(timeout=5)
+    storage.UPLOADER.shutdown(wait=True)
+    server.log.info(f"Worker {worker.pid} drained and exited")
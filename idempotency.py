@@ -0,0 +1,331 @@
+"""
+Idempotency-Key support for the generation and upload endpoints
+
+A client that retries a POST with the same `Idempotency-Key` header gets the
+stored response of the first attempt instead of triggering another paid
+Venice call or another file write. If the first attempt is still running,
+the retry attaches to it and returns its response once it finishes.
+
+Keys are scoped per endpoint and bound to a fingerprint of the request body;
+reusing a key with a different body is a 422. Outcomes are stored in a
+SQLite file (IDEMPOTENCY_DB_PATH) shared by every worker on the host for
+IDEMPOTENCY_TTL seconds:
+
+- responses below 500 are stored and replayed with `Idempotent-Replayed: true`
+- 5xx responses and 429s (transient: upstream errors, scheduler pushback)
+  are not stored, so the retry runs again
+- a key whose first attempt died mid-flight (worker killed) can be taken
+  over after IDEMPOTENCY_LOCK_TIMEOUT seconds
+
+A retry that attaches waits up to IDEMPOTENCY_WAIT seconds, then gets a 409
+with Retry-After.
+"""
+import functools
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from flask import current_app, jsonify, request
+
+import metrics
+import settings
+
+REQUESTS = metrics.Counter('kk_idempotent_requests_total', 'Requests carrying an Idempotency-Key by outcome',
+                           ['endpoint', 'outcome'])
+
+MAX_KEY_LENGTH = 255
+
+# Response headers worth replaying
+REPLAYED_HEADERS = ('Content-Type', 'Location', 'Retry-After')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    owner TEXT,
+    status_code INTEGER,
+    headers TEXT,
+    body BLOB,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (scope, key)
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_created ON idempotency_keys (created_at);
+"""
+
+# Outcomes of IdempotencyStore.begin()
+NEW, REPLAY, IN_FLIGHT, MISMATCH = 'new', 'replay', 'in_flight', 'mismatch'
+
+
+class IdempotencyStore:
+    """Stored outcomes per (endpoint, key), plus in-flight ownership"""
+
+    def __init__(self, path, ttl=86400, lock_timeout=300):
+        self.path = path
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self._local = threading.local()
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._begun = 0
+        self._schema_pid = None
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            if self._schema_pid != os.getpid():
+                connection.executescript(SCHEMA)
+                self._schema_pid = os.getpid()
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def begin(self, scope, key, fingerprint):
+        """
+        Claim a key, or find out what happened to it
+
+        Returns:
+            tuple: (NEW, owner token), (REPLAY, stored response dict),
+            (IN_FLIGHT, None) or (MISMATCH, None)
+        """
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            self._begun += 1
+            if self._begun % 100 == 0:
+                connection.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (now - self.ttl,))
+
+            row = connection.execute(
+                'SELECT * FROM idempotency_keys WHERE scope = ? AND key = ?', (scope, key)).fetchone()
+            if row is not None and row['created_at'] < now - self.ttl:
+                connection.execute('DELETE FROM idempotency_keys WHERE scope = ? AND key = ?', (scope, key))
+                row = None
+
+            if row is None:
+                owner = uuid.uuid4().hex
+                connection.execute(
+                    'INSERT INTO idempotency_keys (scope, key, fingerprint, owner, created_at) VALUES (?, ?, ?, ?, ?)',
+                    (scope, key, fingerprint, owner, now))
+                with self._lock:
+                    self._waiters[(scope, key)] = threading.Event()
+                return NEW, owner
+            if row['fingerprint'] != fingerprint:
+                return MISMATCH, None
+            if row['status_code'] is not None:
+                return REPLAY, {
+                    'status_code': row['status_code'],
+                    'headers': json.loads(row['headers']),
+                    'body': row['body']
+                }
+            if row['created_at'] < now - self.lock_timeout:
+                # The first attempt's worker died without finishing; take the key over
+                owner = uuid.uuid4().hex
+                connection.execute(
+                    'UPDATE idempotency_keys SET owner = ?, created_at = ? WHERE scope = ? AND key = ?',
+                    (owner, now, scope, key))
+                with self._lock:
+                    self._waiters[(scope, key)] = threading.Event()
+                return NEW, owner
+            return IN_FLIGHT, None
+        finally:
+            connection.execute('COMMIT')
+
+    def complete(self, scope, key, owner, response):
+        """Store the owner's response for replay (or drop it, for transient failures)"""
+        connection = self._connection()
+        if response.status_code >= 500 or response.status_code == 429:
+            connection.execute('DELETE FROM idempotency_keys WHERE scope = ? AND key = ? AND owner = ?',
+                               (scope, key, owner))
+        else:
+            headers = {name: response.headers[name] for name in REPLAYED_HEADERS if name in response.headers}
+            connection.execute(
+                'UPDATE idempotency_keys SET status_code = ?, headers = ?, body = ?, owner = NULL '
+                'WHERE scope = ? AND key = ? AND owner = ?',
+                (response.status_code, json.dumps(headers), response.get_data(), scope, key, owner))
+        self._wake(scope, key)
+
+    def abandon(self, scope, key, owner):
+        """Release a key whose view raised"""
+        self._connection().execute('DELETE FROM idempotency_keys WHERE scope = ? AND key = ? AND owner = ?',
+                                   (scope, key, owner))
+        self._wake(scope, key)
+
+    def _wake(self, scope, key):
+        with self._lock:
+            event = self._waiters.pop((scope, key), None)
+        if event is not None:
+            event.set()
+
+    def local_waiter(self, scope, key):
+        """Event set when an attempt in this process finishes, or None if the owner is elsewhere"""
+        with self._lock:
+            return self._waiters.get((scope, key))
+
+
+STORE = IdempotencyStore(
+    settings.IDEMPOTENCY_DB_PATH,
+    ttl=settings.IDEMPOTENCY_TTL,
+    lock_timeout=settings.IDEMPOTENCY_LOCK_TIMEOUT
+)
+
+# Seconds between checks while attached to an attempt running in another process
+POLL_INTERVAL = 0.25
+
+
+def request_fingerprint():
+    """SHA-256 over the request's method, path and body (form fields and file contents for uploads)"""
+    digest = hashlib.sha256(f"{request.method} {request.path}\n".encode())
+    if request.mimetype == 'multipart/form-data':
+        for name, value in sorted(request.form.items(multi=True)):
+            digest.update(f"{name}={value}\n".encode())
+        for name, file in sorted(request.files.items(multi=True), key=lambda item: item[0]):
+            digest.update(f"{name}:{file.filename}\n".encode())
+            digest.update(file.stream.read())
+            file.stream.seek(0)
+    else:
+        # Cached, so the view's get_json() still sees the body
+        digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def _replay(stored):
+    response = current_app.response_class(stored['body'], status=stored['status_code'])
+    for name, value in stored['headers'].items():
+        response.headers[name] = value
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _error(message, status, retry_after=None):
+    response = jsonify({'success': False, 'error': message})
+    response.status_code = status
+    if retry_after:
+        response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def _begin(scope, key, fingerprint):
+    """Claim or inspect a key; returns (outcome, value, error response)"""
+    return _checked(scope, STORE.begin(scope, key, fingerprint))
+
+
+def _checked(scope, begun):
+    """Count the outcome of STORE.begin() and turn a mismatch into its 422"""
+    outcome, value = begun
+    REQUESTS.inc(endpoint=scope, outcome=outcome)
+    if outcome == MISMATCH:
+        return outcome, None, _error("This Idempotency-Key was already used with a different request.", 422)
+    return outcome, value, None
+
+
+def _still_running():
+    return _error("A request with this Idempotency-Key is still in progress.", 409,
+                  retry_after=max(1, int(settings.IDEMPOTENCY_WAIT / 10)))
+
+
+def _store_outcome(scope, key, owner, response):
+    STORE.complete(scope, key, owner, response)
+    return response
+
+
+def idempotent(view, scope):
+    """
+    Wrap a view (sync or async) with Idempotency-Key handling
+
+    Args:
+        view (callable): Flask view function
+        scope (str): Endpoint name the keys are scoped to
+
+    Returns:
+        callable: View of the same kind that replays or attaches on a repeated key
+    """
+    if inspect.iscoroutinefunction(view):
+        @functools.wraps(view)
+        async def async_wrapper(*args, **kwargs):
+            import asyncio
+
+            # The store blocks on SQLite (BEGIN IMMEDIATE waits for other writers), so it runs off the event loop
+            async def begin():
+                return _checked(scope, await asyncio.to_thread(STORE.begin, scope, key, fingerprint))
+
+            key = request.headers.get('Idempotency-Key')
+            if not key:
+                return await view(*args, **kwargs)
+            if len(key) > MAX_KEY_LENGTH:
+                return _error(f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters.", 400)
+            fingerprint = request_fingerprint()
+
+            deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+            outcome, value, error = await begin()
+            while outcome == IN_FLIGHT:
+                if time.monotonic() >= deadline:
+                    return _still_running()
+                await asyncio.sleep(POLL_INTERVAL)
+                outcome, value, error = await begin()
+            if error:
+                return error
+            if outcome == REPLAY:
+                return _replay(value)
+
+            try:
+                response = current_app.make_response(await view(*args, **kwargs))
+            except Exception:
+                await asyncio.to_thread(STORE.abandon, scope, key, value)
+                raise
+            await asyncio.to_thread(STORE.complete, scope, key, value, response)
+            return response
+        return async_wrapper
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return _error(f"Idempotency-Key must be at most {MAX_KEY_LENGTH} characters.", 400)
+        fingerprint = request_fingerprint()
+
+        deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+        outcome, value, error = _begin(scope, key, fingerprint)
+        while outcome == IN_FLIGHT:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return _still_running()
+            # Owner in this process: wake as soon as it finishes; otherwise poll the shared file
+            event = STORE.local_waiter(scope, key)
+            if event is not None:
+                event.wait(remaining)
+            else:
+                time.sleep(min(POLL_INTERVAL, remaining))
+            outcome, value, error = _begin(scope, key, fingerprint)
+        if error:
+            return error
+        if outcome == REPLAY:
+            return _replay(value)
+
+        # NEW: first attempt, or a retry taking over after a transient failure
+        try:
+            response = current_app.make_response(view(*args, **kwargs))
+        except Exception:
+            STORE.abandon(scope, key, value)
+            raise
+        return _store_outcome(scope, key, value, response)
+    return wrapper
+
+
+def init_app(app, endpoints):
+    """Apply Idempotency-Key handling to the named endpoints (after any async view swap)"""
+    for endpoint in endpoints:
+        app.view_functions[endpoint] = idempotent(app.view_functions[endpoint], endpoint)
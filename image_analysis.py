@@ -0,0 +1,220 @@
+"""
+Vectorized color analysis for NFT traits
+
+Works on a small downsampled copy of the image (JPEG draft mode or Pillow's
+reduce), then computes everything with NumPy in a handful of array passes:
+
+- a real palette from 3-bit-per-channel histogram binning
+- brightness and HSV saturation distributions
+- an edge-density score from image gradients
+
+A 1024x1024 generation is reduced to roughly 128px on its longest side, so
+the analysis itself costs a few milliseconds regardless of the input size.
+"""
+import numpy as np
+
+# Longest side of the copy we analyze
+ANALYSIS_SIZE = 128
+
+# Histogram binning: keep the top 3 bits of each channel -> 512 color bins
+BIN_BITS = 3
+PALETTE_SIZE = 5
+
+# Upper edges of the saturation / HSV value bins reported as distributions
+SATURATION_EDGES = np.array([0.2, 0.5])
+VALUE_EDGES = np.array([0.33, 0.66])
+
+# Gradient magnitude (0-255 scale) above which a pixel counts as an edge
+EDGE_THRESHOLD = 32
+
+
+def analysis_view(image, max_side=ANALYSIS_SIZE):
+    """
+    Return a small RGB copy of an image for analysis
+
+    Args:
+        image (PIL.Image.Image): Opened image; for JPEGs call this before load()
+        max_side (int): Target size of the longest side
+
+    Returns:
+        PIL.Image.Image: RGB image no larger than about 2 x max_side
+    """
+    # JPEG can decode straight to a 1/2, 1/4 or 1/8 scale - far cheaper than full decode
+    if image.format == 'JPEG':
+        image.draft('RGB', (max_side, max_side))
+
+    factor = max(1, max(image.size) // max_side)
+    if factor > 1:
+        image = image.reduce(factor)
+
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return image
+
+
+def _hue_name(hue, saturation, value):
+    """Name a color from its HSV components (hue in degrees, s/v in 0-1)"""
+    if value < 0.2:
+        return "black"
+    if saturation < 0.15:
+        if value > 0.85:
+            return "white"
+        return "gray"
+    if (hue < 45 or hue >= 345) and value < 0.55 and saturation > 0.3:
+        return "brown"
+    if hue < 15 or hue >= 345:
+        return "red"
+    if hue < 45:
+        return "orange"
+    if hue < 70:
+        return "yellow"
+    if hue < 160:
+        return "green"
+    if hue < 200:
+        return "cyan"
+    if hue < 260:
+        return "blue"
+    if hue < 300:
+        return "purple"
+    return "pink"
+
+
+def _rgb_to_hsv(rgb):
+    """
+    Vectorized RGB -> HSV
+
+    Args:
+        rgb (np.ndarray): (..., 3) float array scaled to 0-1
+
+    Returns:
+        tuple: hue in degrees, saturation and value arrays (0-1)
+    """
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    # Element-wise max/min across channels is much faster than reducing over a length-3 axis
+    maximum = np.maximum(np.maximum(r, g), b)
+    minimum = np.minimum(np.minimum(r, g), b)
+    delta = maximum - minimum
+
+    saturation = np.where(maximum > 0, delta / np.where(maximum > 0, maximum, 1), 0.0)
+
+    safe_delta = np.where(delta > 0, delta, 1)
+    hue = np.select(
+        [maximum == r, maximum == g],
+        [((g - b) / safe_delta) % 6, (b - r) / safe_delta + 2],
+        (r - g) / safe_delta + 4,
+    ) * 60.0
+    hue = np.where(delta > 0, hue, 0.0)
+    return hue, saturation, maximum
+
+
+def _shares(values, edges, labels):
+    # searchsorted + bincount is a cheaper histogram for a handful of fixed edges
+    counts = np.bincount(np.searchsorted(edges, values, side='right'), minlength=len(labels))
+    total = max(1, counts.sum())
+    return {label: round(float(count / total), 3) for label, count in zip(labels, counts)}
+
+
+def analyze_colors(image, view=None):
+    """
+    Compute color traits for an image
+
+    Args:
+        image (PIL.Image.Image): Image to analyze (any mode/size)
+        view (PIL.Image.Image): Precomputed analysis_view(image), if available
+
+    Returns:
+        dict: color_properties for the NFT traits plus raw stats
+    """
+    if view is None:
+        view = analysis_view(image)
+    pixels = np.asarray(view, dtype=np.uint8).reshape(-1, 3)
+
+    # Channel statistics (same scale as the old ImageStat-based analysis)
+    means = pixels.mean(axis=0, dtype=np.float64)
+    stddevs = pixels.std(axis=0, dtype=np.float64)
+    brightness_value = float(means.mean())
+    color_diversity_value = float(stddevs.mean())
+
+    if brightness_value < 85:
+        brightness = "dark"
+    elif brightness_value > 170:
+        brightness = "bright"
+    else:
+        brightness = "medium"
+
+    if color_diversity_value < 50:
+        color_diversity = "low"
+    elif color_diversity_value > 100:
+        color_diversity = "high"
+    else:
+        color_diversity = "medium"
+
+    # Palette: bin every pixel, then average the real colors inside the busiest bins
+    shift = 8 - BIN_BITS
+    binned = (pixels >> shift).astype(np.int32)
+    bin_index = (binned[:, 0] << (2 * BIN_BITS)) | (binned[:, 1] << BIN_BITS) | binned[:, 2]
+    n_bins = 1 << (3 * BIN_BITS)
+    counts = np.bincount(bin_index, minlength=n_bins)
+    sums = np.stack([np.bincount(bin_index, weights=pixels[:, channel], minlength=n_bins)
+                     for channel in range(3)], axis=1)
+
+    top_bins = np.argsort(counts)[::-1][:PALETTE_SIZE]
+    top_bins = top_bins[counts[top_bins] > 0]
+    palette_rgb = sums[top_bins] / counts[top_bins, None]
+    palette_hue, palette_sat, palette_val = _rgb_to_hsv(palette_rgb / 255.0)
+
+    total_pixels = len(pixels)
+    palette = []
+    for index, rgb in enumerate(palette_rgb):
+        r, g, b = (int(round(channel)) for channel in rgb)
+        palette.append({
+            "hex": f"#{r:02x}{g:02x}{b:02x}",
+            "name": _hue_name(palette_hue[index], palette_sat[index], palette_val[index]),
+            "share": round(float(counts[top_bins[index]]) / total_pixels, 3),
+        })
+
+    dominant_colors = []
+    for entry in palette:
+        if entry["name"] not in dominant_colors:
+            dominant_colors.append(entry["name"])
+        if len(dominant_colors) == 3:
+            break
+
+    # HSV distributions (hue is only needed for the palette, so skip it per pixel)
+    r, g, b = (pixels[:, channel].astype(np.float32) for channel in range(3))
+    maximum = np.maximum(np.maximum(r, g), b)
+    minimum = np.minimum(np.minimum(r, g), b)
+    value = maximum / 255.0
+    saturation = np.where(maximum > 0, (maximum - minimum) / np.maximum(maximum, 1), 0.0)
+    saturation_distribution = _shares(saturation, SATURATION_EDGES, ["muted", "moderate", "vivid"])
+    brightness_distribution = _shares(value, VALUE_EDGES, ["dark", "medium", "bright"])
+
+    # Edge density from horizontal and vertical gradients of the luminance
+    gray = np.asarray(view.convert('L'), dtype=np.int16)
+    edges_x = np.abs(np.diff(gray, axis=1))[:-1, :]
+    edges_y = np.abs(np.diff(gray, axis=0))[:, :-1]
+    gradient = np.maximum(edges_x, edges_y)
+    edge_density = float((gradient > EDGE_THRESHOLD).mean()) if gradient.size else 0.0
+
+    return {
+        "color_properties": {
+            "dominant_colors": dominant_colors,
+            "brightness": brightness,
+            "color_diversity": color_diversity,
+            "palette": palette,
+            "saturation": {
+                "mean": round(float(saturation.mean()), 3),
+                "std": round(float(saturation.std()), 3),
+                "distribution": saturation_distribution,
+            },
+            "brightness_distribution": brightness_distribution,
+            "edge_density": round(edge_density, 3),
+        },
+        "color_stats": {
+            "r_mean": float(means[0]),
+            "g_mean": float(means[1]),
+            "b_mean": float(means[2]),
+            "brightness_value": brightness_value,
+            "color_diversity_value": color_diversity_value,
+        },
+    }
@@ -0,0 +1,113 @@
+"""
+Decode-once image artifacts
+
+A generated image used to be decoded from base64 separately by the save and
+trait-analysis stages and then copied again into the response's data URI.
+ImageArtifact wraps the base64 payload once and hands every stage the same
+lazily computed representations:
+
+    data           decoded bytes (decoded on first use, then shared)
+    content_hash   SHA-256 of the bytes
+    image          opened Pillow image (pixels decoded on demand)
+    analysis_view  small RGB copy for color analysis
+    data_uri       `data:<type>;base64,...` string for JSON responses
+
+Building the data URI releases the artifact's own reference to the bare
+base64 string, so the two multi-megabyte strings don't both stay alive, and
+release() drops the decoded bytes and Pillow image once the save and
+analysis stages are done, before the response is serialized.
+"""
+import base64
+
+import metrics
+import stage_timer
+
+
+class ImageArtifact:
+    """One generated image, decoded at most once per request"""
+
+    def __init__(self, base64_image, content_type='image/png'):
+        # Accept data URLs as well as bare base64
+        if base64_image.startswith('data:') and ',' in base64_image:
+            header, base64_image = base64_image.split(',', 1)
+            content_type = header[5:].split(';')[0] or content_type
+        self.content_type = content_type
+        self._base64 = base64_image
+        self._data = None
+        self._content_hash = None
+        self._image = None
+        self._analysis_view = None
+        self._data_uri = None
+
+    @property
+    def base64(self):
+        """Base64 payload without a data URL prefix"""
+        if self._base64 is None:
+            return self._data_uri.split(',', 1)[1]
+        return self._base64
+
+    @property
+    def data(self):
+        """Decoded image bytes"""
+        if self._data is None:
+            with metrics.IMAGE_STAGE.time(stage='base64_decode'), stage_timer.stage('base64'):
+                self._data = base64.b64decode(self.base64)
+        return self._data
+
+    def decode(self):
+        """
+        Decode the bytes now rather than on first use
+
+        Returns:
+            bytes: The decoded image bytes
+        """
+        return self.data
+
+    @property
+    def content_hash(self):
+        """Hex SHA-256 of the decoded bytes"""
+        if self._content_hash is None:
+            import traits
+            self._content_hash = traits.content_hash(self.data)
+        return self._content_hash
+
+    @property
+    def image(self):
+        """Opened Pillow image over the decoded bytes"""
+        if self._image is None:
+            from io import BytesIO
+            from PIL import Image
+            with metrics.IMAGE_STAGE.time(stage='decode'):
+                self._image = Image.open(BytesIO(self.data))
+        return self._image
+
+    @property
+    def analysis_view(self):
+        """Downsampled RGB copy used by the color analysis"""
+        if self._analysis_view is None:
+            import image_analysis
+            self._analysis_view = image_analysis.analysis_view(self.image)
+        return self._analysis_view
+
+    @property
+    def data_uri(self):
+        """`data:` URI for embedding the image in a JSON response"""
+        if self._data_uri is None:
+            self._data_uri = f"data:{self.content_type};base64,{self._base64}"
+            self._base64 = None
+        return self._data_uri
+
+    def release(self):
+        """Drop the decoded bytes and Pillow objects; the encoded form is kept"""
+        if self._image is not None:
+            self._image.close()
+        self._data = None
+        self._image = None
+        self._analysis_view = None
+
+
+def as_artifact(image):
+    """Wrap a base64 string in an ImageArtifact; artifacts pass through unchanged"""
+    if isinstance(image, ImageArtifact):
+        return image
+    return ImageArtifact(image)
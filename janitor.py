@@ -0,0 +1,428 @@
+"""
+Quota-driven retention for uploads and generated images
+
+Every image written under the served directories is tracked in a `files`
+table in the metadata database with its size and last access time, and a
+single-row `usage` table holds the running totals, kept current by triggers.
+Checking the quota is therefore one row read; the directories are only
+scanned once, to bootstrap the accounting on an existing install (or on
+demand with `python janitor.py --rescan`).
+
+A background thread in each worker process periodically:
+
+1. flushes the writes and accesses it buffered since the last run
+2. claims the run through the database, so only one process per interval
+   actually evicts
+3. evicts files not accessed for RETENTION_MAX_AGE_DAYS
+4. if usage is still over RETENTION_MAX_GB, evicts the least recently
+   accessed files until it is down to RETENTION_TARGET_RATIO of the quota
+
+Pinned and minted files (see pin()) are never evicted. With object storage
+configured only the local copy is removed and the image stays servable from
+the bucket; otherwise the file is gone and its metadata item loses its
+file_path, so galleries and exports stop listing it.
+
+Run `python janitor.py --once --dry-run` to see what a run would evict.
+"""
+import argparse
+import atexit
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import metadata_store
+import metrics
+import settings
+import storage
+
+EVICTED = metrics.Counter('kk_retention_evicted_total', 'Files evicted by the retention janitor', ['reason'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL,
+    pinned TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_files_evictable ON files (last_access) WHERE pinned IS NULL;
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    bytes INTEGER NOT NULL,
+    files INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO usage (id, bytes, files) VALUES (1, 0, 0);
+CREATE TRIGGER IF NOT EXISTS files_usage_insert AFTER INSERT ON files BEGIN
+    UPDATE usage SET bytes = bytes + NEW.size, files = files + 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS files_usage_delete AFTER DELETE ON files BEGIN
+    UPDATE usage SET bytes = bytes - OLD.size, files = files - 1 WHERE id = 1;
+END;
+CREATE TRIGGER IF NOT EXISTS files_usage_resize AFTER UPDATE OF size ON files BEGIN
+    UPDATE usage SET bytes = bytes + NEW.size - OLD.size WHERE id = 1;
+END;
+CREATE TABLE IF NOT EXISTS retention_state (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+# Pin reasons; only 'pinned' can be set or cleared through the API, 'minted' is set at mint time
+PIN_REASONS = ('pinned', 'minted')
+
+EVICTION_BATCH = 500
+
+
+class Janitor:
+    """Incremental file accounting plus periodic quota enforcement"""
+
+    def __init__(self, directories, max_bytes=0, max_age=0, target_ratio=0.9, interval=300):
+        """
+        Args:
+            directories (list): Served directories to account for, e.g. ['uploads', 'generated_images']
+            max_bytes (int): Byte quota; 0 disables it
+            max_age (float): Seconds since last access before a file is evicted; 0 disables it
+            target_ratio (float): Fraction of the quota to evict down to
+            interval (float): Seconds between runs
+        """
+        self.directories = directories
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.target_ratio = target_ratio
+        self.interval = interval
+        self._written = {}
+        self._accessed = {}
+        self._lock = threading.Lock()
+        self._pid = None
+        self._schema_pid = None
+        self._last_run = None
+
+    @property
+    def enabled(self):
+        return bool(self.max_bytes or self.max_age)
+
+    def _connection(self):
+        connection = metadata_store.STORE.connection()
+        if self._schema_pid != os.getpid():
+            with connection:
+                connection.executescript(SCHEMA)
+            self._schema_pid = os.getpid()
+        return connection
+
+    def _ensure_started(self):
+        """Start the janitor thread once per process"""
+        if self._pid == os.getpid() or not self.enabled:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # A forked child inherits buffered entries that the parent will flush itself
+            self._written, self._accessed = {}, {}
+            threading.Thread(target=self._loop, name='retention-janitor', daemon=True).start()
+            self._pid = os.getpid()
+
+    def track(self, path):
+        """Account for a file that was just written"""
+        if not self.enabled:
+            return
+        self._ensure_started()
+        with self._lock:
+            self._written[path] = time.time()
+
+    def touch(self, path):
+        """Record that a file was served; flushed in bulk on the next run"""
+        if not self.enabled:
+            return
+        self._ensure_started()
+        with self._lock:
+            self._accessed[path] = time.time()
+
+    def flush(self):
+        """Write buffered file writes and accesses to the database"""
+        with self._lock:
+            written, self._written = self._written, {}
+            accessed, self._accessed = self._accessed, {}
+        if not written and not accessed:
+            return
+
+        rows = []
+        for path, written_at in written.items():
+            try:
+                rows.append((path, os.path.getsize(path), written_at, accessed.pop(path, written_at)))
+            except OSError:
+                continue
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                'INSERT INTO files (path, size, created_at, last_access) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (path) DO UPDATE SET size = excluded.size, last_access = excluded.last_access',
+                rows)
+            connection.executemany(
+                'UPDATE files SET last_access = MAX(last_access, ?) WHERE path = ?',
+                [(accessed_at, path) for path, accessed_at in accessed.items()])
+
+    def rescan(self):
+        """
+        Rebuild the accounting from the directories
+
+        Returns:
+            int: Number of files found
+        """
+        connection = self._connection()
+        found = 0
+        with connection:
+            existing = {row['path'] for row in connection.execute('SELECT path FROM files')}
+            seen = set()
+            for directory in self.directories:
+                for root, _, names in os.walk(directory):
+                    rows = []
+                    for name in names:
+                        path = os.path.join(root, name)
+                        try:
+                            stat = os.stat(path)
+                        except OSError:
+                            continue
+                        seen.add(path)
+                        # atime is unreliable (noatime mounts), so the mtime seeds last access
+                        rows.append((path, stat.st_size, stat.st_mtime, stat.st_mtime))
+                    connection.executemany(
+                        'INSERT INTO files (path, size, created_at, last_access) VALUES (?, ?, ?, ?) '
+                        'ON CONFLICT (path) DO UPDATE SET size = excluded.size', rows)
+                    found += len(rows)
+            connection.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in existing - seen])
+            connection.execute(
+                'INSERT OR REPLACE INTO retention_state (key, value) VALUES (?, ?)', ('bootstrapped', time.time()))
+        return found
+
+    def _claim_run(self, now):
+        """True if this process gets to run the eviction pass for this interval"""
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR IGNORE INTO retention_state (key, value) VALUES (?, 0)', ('last_run',))
+            claimed = connection.execute(
+                'UPDATE retention_state SET value = ? WHERE key = ? AND value <= ?',
+                (now, 'last_run', now - self.interval * 0.9)).rowcount
+        return claimed == 1
+
+    def usage(self):
+        """Tracked bytes and file count"""
+        row = self._connection().execute('SELECT bytes, files FROM usage WHERE id = 1').fetchone()
+        return {'bytes': row['bytes'], 'files': row['files']}
+
+    def _evict(self, rows, reason, dry_run):
+        """
+        Delete files and the accounting rows of those actually removed
+
+        Returns:
+            tuple: (bytes freed, files evicted); files that couldn't be removed keep their rows
+        """
+        freed, evicted = 0, []
+        for row in rows:
+            if not dry_run:
+                try:
+                    os.remove(row['path'])
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"Error evicting {row['path']}: {str(e)}")
+                    continue
+            freed += row['size']
+            evicted.append(row)
+        if dry_run or not evicted:
+            return freed, len(evicted)
+        EVICTED.inc(len(evicted), reason=reason)
+
+        paths = [(row['path'],) for row in evicted]
+        connection = self._connection()
+        with connection:
+            connection.executemany('DELETE FROM files WHERE path = ? AND pinned IS NULL', paths)
+            if not storage.BACKEND.remote:
+                # No other copy left; stop listing the item in galleries and exports
+                connection.executemany('UPDATE items SET file_path = NULL WHERE file_path = ?', paths)
+        return freed, len(evicted)
+
+    def run(self, dry_run=False, now=None):
+        """
+        One eviction pass
+
+        Returns:
+            dict: Files and bytes evicted per reason, and usage afterwards
+        """
+        now = now or time.time()
+        connection = self._connection()
+        report = {'age': {'files': 0, 'bytes': 0}, 'quota': {'files': 0, 'bytes': 0}}
+
+        if self.max_age:
+            cutoff = now - self.max_age
+            after = None
+            while True:
+                # Keyset over the partial index; in a dry run nothing is deleted, so skip past each batch
+                if after is None:
+                    rows = connection.execute(
+                        'SELECT path, size, last_access FROM files WHERE pinned IS NULL AND last_access < ? '
+                        'ORDER BY last_access, path LIMIT ?', (cutoff, EVICTION_BATCH)).fetchall()
+                else:
+                    rows = connection.execute(
+                        'SELECT path, size, last_access FROM files WHERE pinned IS NULL AND last_access < ? '
+                        'AND (last_access > ? OR (last_access = ? AND path > ?)) ORDER BY last_access, path LIMIT ?',
+                        (cutoff, after[0], after[0], after[1], EVICTION_BATCH)).fetchall()
+                if not rows:
+                    break
+                freed, evicted = self._evict(rows, 'age', dry_run)
+                report['age']['bytes'] += freed
+                report['age']['files'] += evicted
+                after = (rows[-1]['last_access'], rows[-1]['path'])
+
+        if self.max_bytes:
+            used = self.usage()['bytes'] - (report['age']['bytes'] if dry_run else 0)
+            if used > self.max_bytes:
+                excess = used - int(self.max_bytes * self.target_ratio)
+                offset = 0
+                while excess > 0:
+                    rows = connection.execute(
+                        'SELECT path, size, last_access FROM files WHERE pinned IS NULL '
+                        'ORDER BY last_access, path LIMIT ? OFFSET ?', (EVICTION_BATCH, offset)).fetchall()
+                    if not rows:
+                        break
+                    batch, planned = [], excess
+                    for row in rows:
+                        if planned <= 0:
+                            break
+                        batch.append(row)
+                        planned -= row['size']
+                    freed, evicted = self._evict(batch, 'quota', dry_run)
+                    excess -= freed
+                    report['quota']['bytes'] += freed
+                    report['quota']['files'] += evicted
+                    # Nothing is deleted in a dry run; otherwise only files that couldn't be removed remain
+                    offset += len(rows) if dry_run else len(batch) - evicted
+
+        report['usage'] = self.usage()
+        return report
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+                now = time.time()
+                if not self._claim_run(now):
+                    continue
+                state = self._connection().execute(
+                    'SELECT value FROM retention_state WHERE key = ?', ('bootstrapped',)).fetchone()
+                if state is None:
+                    print(f"Retention janitor: accounted for {self.rescan()} existing files")
+                report = self.run(now=now)
+                self._last_run = now
+                if report['age']['files'] or report['quota']['files']:
+                    print(f"Retention janitor evicted {report['age']['files']} expired and "
+                          f"{report['quota']['files']} over-quota files")
+            except Exception as e:
+                print(f"Retention janitor run failed: {str(e)}")
+
+    def pin(self, path, reason='pinned'):
+        """
+        Exempt a file from eviction
+
+        Raises:
+            ValueError: On an unknown reason
+            FileNotFoundError: If the file doesn't exist
+        """
+        if reason not in PIN_REASONS:
+            raise ValueError(f"Unknown pin reason: {reason}")
+        size = os.path.getsize(path)
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            # A minted pin is never downgraded to a plain one
+            connection.execute(
+                'INSERT INTO files (path, size, created_at, last_access, pinned) VALUES (?, ?, ?, ?, ?) '
+                "ON CONFLICT (path) DO UPDATE SET pinned = CASE WHEN pinned = 'minted' THEN pinned "
+                'ELSE excluded.pinned END',
+                (path, size, now, now, reason))
+
+    def mint(self, path):
+        """Pin a freshly minted image for good; called by the server-side mint paths only"""
+        try:
+            self.pin(path, 'minted')
+        except (OSError, sqlite3.Error) as e:
+            print(f"Error pinning minted image {path}: {str(e)}")
+
+    def unpin(self, path):
+        """
+        Make a pinned file evictable again
+
+        Returns:
+            bool: False if the file is minted (minted files stay pinned)
+        """
+        connection = self._connection()
+        with connection:
+            row = connection.execute('SELECT pinned FROM files WHERE path = ?', (path,)).fetchone()
+            if row is not None and row['pinned'] == 'minted':
+                return False
+            connection.execute('UPDATE files SET pinned = NULL WHERE path = ?', (path,))
+        return True
+
+    def pinned(self, path):
+        """Pin reason of a file, or None"""
+        row = self._connection().execute('SELECT pinned FROM files WHERE path = ?', (path,)).fetchone()
+        return row['pinned'] if row else None
+
+    def snapshot(self):
+        """Quota state for /api/status"""
+        state = {
+            'enabled': self.enabled,
+            'max_bytes': self.max_bytes,
+            'max_age_seconds': self.max_age,
+            'last_run': self._last_run,
+            'evicted': {reason: EVICTED.value(reason=reason) for reason in ('age', 'quota')}
+        }
+        if self.enabled:
+            state['usage'] = self.usage()
+        return state
+
+
+JANITOR = Janitor(
+    [directory.strip() for directory in settings.RETENTION_DIRS.split(',') if directory.strip()],
+    max_bytes=int(settings.RETENTION_MAX_GB * 1024 ** 3),
+    max_age=settings.RETENTION_MAX_AGE_DAYS * 86400,
+    target_ratio=settings.RETENTION_TARGET_RATIO,
+    interval=settings.RETENTION_INTERVAL
+)
+metrics.register_status_provider('retention', JANITOR.snapshot)
+
+
+@atexit.register
+def _flush_on_exit():
+    if JANITOR._pid == os.getpid():
+        try:
+            JANITOR.flush()
+        except Exception as e:
+            print(f"Error flushing retention accounting: {str(e)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enforce the retention quotas for stored images")
+    parser.add_argument('--once', action='store_true', help="Run one eviction pass and exit")
+    parser.add_argument('--dry-run', action='store_true', help="Report what would be evicted without deleting")
+    parser.add_argument('--rescan', action='store_true', help="Rebuild the file accounting from the directories first")
+    args = parser.parse_args(argv)
+
+    if args.rescan:
+        print(f"Accounted for {JANITOR.rescan()} files")
+    if args.once or args.dry_run:
+        if not JANITOR.enabled:
+            print("No quota configured; set RETENTION_MAX_GB and/or RETENTION_MAX_AGE_DAYS")
+            return 0
+        report = JANITOR.run(dry_run=args.dry_run)
+        verb = "Would evict" if args.dry_run else "Evicted"
+        for reason in ('age', 'quota'):
+            print(f"{verb} {report[reason]['files']} files ({report[reason]['bytes']} bytes) by {reason}")
+        print(f"Usage: {report['usage']['files']} files, {report['usage']['bytes']} bytes")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,782 @@
+"""
+Shared generation job queue for multi-node deployments
+
+Web nodes enqueue generation jobs (POST /api/jobs) and return straight away;
+worker processes on any machine reserve jobs from a shared broker, run the
+Venice call, save and trait analysis, and store the result, which clients
+poll at GET /api/jobs/<id>. Web and worker tiers scale independently.
+
+Brokers (JOB_BROKER_URL):
+
+    memory://                  InMemoryBroker - one process only, for tests
+    sqlite:///data/jobs.db     SQLiteBroker - processes sharing one host
+    redis://host:6379/0        RedisBroker - any number of nodes (needs the
+                               redis package; works with Redis-compatible servers)
+
+All three give the same at-least-once semantics:
+
+- reserve() hides a job for a visibility timeout and hands out a receipt;
+  workers extend() it while they run
+- ack() with the receipt completes the job; a stale receipt (the job timed
+  out and was handed to another worker) is refused
+- a job whose visibility timeout expires is delivered again; fail() retries
+  after JOB_RETRY_DELAY seconds
+- after max_attempts deliveries a job is dead-lettered instead of retried
+- a handler that raises Defer (e.g. on scheduler pushback) puts the job back
+  for the given delay without using up an attempt
+
+Because a job can run more than once, handlers checkpoint their side effects
+(set_progress) and skip completed stages on redelivery, so a retried job
+doesn't pay for a second Venice call or record a second item.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+
+import metrics
+import settings
+
+JOBS = metrics.Counter('kk_jobs_total', 'Queued generation jobs by kind and outcome', ['kind', 'status'])
+
+# Statuses a job moves through; dead means dead-lettered
+STATUSES = ('queued', 'running', 'succeeded', 'failed', 'dead')
+
+# Job handlers by kind, registered by the modules that implement them
+HANDLERS = {}
+
+
+class Defer(RuntimeError):
+    """Raised by a handler to run the job again later without counting an attempt"""
+
+    def __init__(self, message, delay):
+        super().__init__(message)
+        self.delay = delay
+
+
+def register_handler(kind, handler):
+    """
+    Register the function that runs jobs of a kind
+
+    Args:
+        kind (str): Job kind, e.g. 'text_to_image'
+        handler (callable): handler(payload, job) -> JSON-serializable result;
+            job is the Message, with progress and checkpoint()
+    """
+    HANDLERS[kind] = handler
+
+
+def new_job_id():
+    return uuid.uuid4().hex
+
+
+class Message:
+    """One delivery of a job to a worker"""
+
+    def __init__(self, broker, job_id, kind, payload, attempts, receipt, progress=None):
+        self.broker = broker
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.attempts = attempts
+        self.receipt = receipt
+        self.progress = progress or {}
+
+    def checkpoint(self, **fields):
+        """Record completed stages so a redelivery can skip them"""
+        self.progress.update(fields)
+        self.broker.set_progress(self.id, **fields)
+
+
+class InMemoryBroker:
+    """Single-process broker with the same semantics as the shared ones; for tests"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def enqueue(self, kind, payload, job_id=None, max_attempts=3, delay=0):
+        """
+        Add a job unless one with the same ID exists
+
+        Returns:
+            tuple: (job_id, created)
+        """
+        job_id = job_id or new_job_id()
+        now = time.time()
+        with self._lock:
+            if job_id in self._jobs:
+                return job_id, False
+            self._jobs[job_id] = {
+                'id': job_id, 'kind': kind, 'payload': payload, 'status': 'queued', 'attempts': 0,
+                'max_attempts': max_attempts, 'visible_at': now + delay, 'receipt': None, 'result': None,
+                'error': None, 'progress': {}, 'created_at': now, 'updated_at': now
+            }
+        return job_id, True
+
+    def reserve(self, visibility_timeout):
+        """
+        Take the next visible job, hiding it for visibility_timeout seconds
+
+        Returns:
+            Message: The job, or None if nothing is ready
+        """
+        now = time.time()
+        with self._lock:
+            ready = sorted((job for job in self._jobs.values()
+                            if job['status'] in ('queued', 'running') and job['visible_at'] <= now),
+                           key=lambda job: job['visible_at'])
+            for job in ready:
+                if job['attempts'] >= job['max_attempts']:
+                    # The last delivery timed out without an ack or fail
+                    job.update(status='dead', error="Visibility timeout expired on the last attempt",
+                               receipt=None, updated_at=now)
+                    continue
+                job.update(status='running', attempts=job['attempts'] + 1, receipt=uuid.uuid4().hex,
+                           visible_at=now + visibility_timeout, updated_at=now)
+                return Message(self, job['id'], job['kind'], job['payload'], job['attempts'],
+                               job['receipt'], dict(job['progress']))
+        return None
+
+    def _held(self, message):
+        job = self._jobs.get(message.id)
+        return job if job is not None and job['receipt'] == message.receipt else None
+
+    def extend(self, message, visibility_timeout):
+        """Keep a running job hidden; False if the receipt is stale"""
+        with self._lock:
+            job = self._held(message)
+            if job is None:
+                return False
+            job['visible_at'] = time.time() + visibility_timeout
+            return True
+
+    def ack(self, message, result=None):
+        """Complete a job; False if the receipt is stale"""
+        with self._lock:
+            job = self._held(message)
+            if job is None:
+                return False
+            job.update(status='succeeded', result=result, receipt=None, updated_at=time.time())
+            return True
+
+    def fail(self, message, error, retry_delay=0):
+        """
+        Give a job back after an error
+
+        Returns:
+            str: 'retry', 'dead', or None if the receipt is stale
+        """
+        now = time.time()
+        with self._lock:
+            job = self._held(message)
+            if job is None:
+                return None
+            if job['attempts'] >= job['max_attempts']:
+                job.update(status='dead', error=error, receipt=None, updated_at=now)
+                return 'dead'
+            job.update(status='queued', error=error, receipt=None, visible_at=now + retry_delay, updated_at=now)
+            return 'retry'
+
+    def defer(self, message, delay):
+        """Put a running job back for `delay` seconds without counting the attempt; False if stale"""
+        now = time.time()
+        with self._lock:
+            job = self._held(message)
+            if job is None:
+                return False
+            job.update(status='queued', attempts=job['attempts'] - 1, receipt=None, visible_at=now + delay,
+                       updated_at=now)
+            return True
+
+    def set_progress(self, job_id, **fields):
+        with self._lock:
+            self._jobs[job_id]['progress'].update(fields)
+
+    def get(self, job_id):
+        """Job status document, or None"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return _public(job) if job else None
+
+    def dead_letters(self, limit=50):
+        with self._lock:
+            dead = [job for job in self._jobs.values() if job['status'] == 'dead']
+        return [_public(job) for job in sorted(dead, key=lambda job: job['updated_at'])[:limit]]
+
+    def requeue(self, job_id):
+        """Give a dead-lettered job a fresh set of attempts"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] != 'dead':
+                return False
+            job.update(status='queued', attempts=0, visible_at=time.time(), updated_at=time.time())
+            return True
+
+    def purge(self, older_than):
+        """Forget finished jobs last updated before a timestamp"""
+        with self._lock:
+            for job_id in [job_id for job_id, job in self._jobs.items()
+                           if job['status'] in ('succeeded', 'dead') and job['updated_at'] < older_than]:
+                del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            counts = {status: 0 for status in STATUSES}
+            for job in self._jobs.values():
+                counts[job['status']] += 1
+        return counts
+
+
+def _public(job):
+    """The fields of a job that the status endpoint returns"""
+    return {
+        'id': job['id'],
+        'kind': job['kind'],
+        'status': job['status'],
+        'attempts': job['attempts'],
+        'max_attempts': job['max_attempts'],
+        'result': job['result'],
+        'error': job['error'],
+        'created_at': job['created_at'],
+        'updated_at': job['updated_at']
+    }
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    visible_at REAL NOT NULL,
+    receipt TEXT,
+    result TEXT,
+    error TEXT,
+    progress TEXT NOT NULL DEFAULT '{}',
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (visible_at) WHERE status IN ('queued', 'running');
+CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs (status, updated_at);
+"""
+
+
+class SQLiteBroker:
+    """Broker in a SQLite file (WAL); shared by the processes of one host"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as connection:
+            connection.executescript(SQLITE_SCHEMA)
+
+    def _connection(self):
+        # One connection per thread and process
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def _transaction(self):
+        """BEGIN IMMEDIATE so concurrent reservers serialize instead of racing"""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        return _Transaction(connection)
+
+    def enqueue(self, kind, payload, job_id=None, max_attempts=3, delay=0):
+        job_id = job_id or new_job_id()
+        now = time.time()
+        with self._transaction() as connection:
+            created = connection.execute(
+                'INSERT OR IGNORE INTO jobs (id, kind, payload, status, max_attempts, visible_at, created_at, '
+                "updated_at) VALUES (?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), max_attempts, now + delay, now, now)).rowcount
+        return job_id, created == 1
+
+    def reserve(self, visibility_timeout):
+        now = time.time()
+        with self._transaction() as connection:
+            while True:
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE status IN ('queued', 'running') AND visible_at <= ? "
+                    'ORDER BY visible_at LIMIT 1', (now,)).fetchone()
+                if row is None:
+                    return None
+                if row['attempts'] >= row['max_attempts']:
+                    connection.execute(
+                        "UPDATE jobs SET status = 'dead', receipt = NULL, error = ?, updated_at = ? WHERE id = ?",
+                        ("Visibility timeout expired on the last attempt", now, row['id']))
+                    continue
+                receipt = uuid.uuid4().hex
+                connection.execute(
+                    "UPDATE jobs SET status = 'running', attempts = attempts + 1, receipt = ?, visible_at = ?, "
+                    'updated_at = ? WHERE id = ?', (receipt, now + visibility_timeout, now, row['id']))
+                return Message(self, row['id'], row['kind'], json.loads(row['payload']), row['attempts'] + 1,
+                               receipt, json.loads(row['progress']))
+
+    def extend(self, message, visibility_timeout):
+        with self._transaction() as connection:
+            return connection.execute(
+                'UPDATE jobs SET visible_at = ? WHERE id = ? AND receipt = ?',
+                (time.time() + visibility_timeout, message.id, message.receipt)).rowcount == 1
+
+    def ack(self, message, result=None):
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET status = 'succeeded', result = ?, receipt = NULL, updated_at = ? "
+                'WHERE id = ? AND receipt = ?',
+                (json.dumps(result), time.time(), message.id, message.receipt)).rowcount == 1
+
+    def fail(self, message, error, retry_delay=0):
+        now = time.time()
+        with self._transaction() as connection:
+            row = connection.execute('SELECT attempts, max_attempts FROM jobs WHERE id = ? AND receipt = ?',
+                                     (message.id, message.receipt)).fetchone()
+            if row is None:
+                return None
+            if row['attempts'] >= row['max_attempts']:
+                connection.execute(
+                    "UPDATE jobs SET status = 'dead', error = ?, receipt = NULL, updated_at = ? WHERE id = ?",
+                    (error, now, message.id))
+                return 'dead'
+            connection.execute(
+                "UPDATE jobs SET status = 'queued', error = ?, receipt = NULL, visible_at = ?, updated_at = ? "
+                'WHERE id = ?', (error, now + retry_delay, now, message.id))
+            return 'retry'
+
+    def defer(self, message, delay):
+        now = time.time()
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET status = 'queued', attempts = attempts - 1, receipt = NULL, visible_at = ?, "
+                'updated_at = ? WHERE id = ? AND receipt = ?',
+                (now + delay, now, message.id, message.receipt)).rowcount == 1
+
+    def set_progress(self, job_id, **fields):
+        with self._transaction() as connection:
+            row = connection.execute('SELECT progress FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is not None:
+                progress = json.loads(row['progress'])
+                progress.update(fields)
+                connection.execute('UPDATE jobs SET progress = ? WHERE id = ?', (json.dumps(progress), job_id))
+
+    def _document(self, row):
+        job = dict(row)
+        job['result'] = json.loads(job['result']) if job['result'] else None
+        return _public(job)
+
+    def get(self, job_id):
+        row = self._connection().execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._document(row) if row else None
+
+    def dead_letters(self, limit=50):
+        rows = self._connection().execute(
+            "SELECT * FROM jobs WHERE status = 'dead' ORDER BY updated_at LIMIT ?", (limit,))
+        return [self._document(row) for row in rows]
+
+    def requeue(self, job_id):
+        now = time.time()
+        with self._transaction() as connection:
+            return connection.execute(
+                "UPDATE jobs SET status = 'queued', attempts = 0, visible_at = ?, updated_at = ? "
+                "WHERE id = ? AND status = 'dead'", (now, now, job_id)).rowcount == 1
+
+    def purge(self, older_than):
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM jobs WHERE status IN ('succeeded', 'dead') AND updated_at < ?", (older_than,))
+
+    def stats(self):
+        counts = {status: 0 for status in STATUSES}
+        for row in self._connection().execute('SELECT status, COUNT(*) AS count FROM jobs GROUP BY status'):
+            counts[row['status']] = row['count']
+        return counts
+
+
+class _Transaction:
+    """Commit on success, roll back on error, for a connection in autocommit mode"""
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, exc_type, exc, tb):
+        self.connection.execute('ROLLBACK' if exc_type else 'COMMIT')
+        return False
+
+
+# Redis keeps every job in one sorted set scored by the time it becomes
+# visible; reserving moves the score forward by the visibility timeout.
+# Each state change is a Lua script, so it is atomic on the server.
+_REDIS_ENQUEUE = """
+if redis.call('EXISTS', KEYS[2]) == 1 then return 0 end
+redis.call('HSET', KEYS[2], 'id', ARGV[1], 'kind', ARGV[2], 'payload', ARGV[3], 'status', 'queued',
+           'attempts', 0, 'max_attempts', ARGV[4], 'created_at', ARGV[5], 'updated_at', ARGV[5])
+redis.call('ZADD', KEYS[1], ARGV[6], ARGV[1])
+return 1
+"""
+
+_REDIS_RESERVE = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 16)
+for _, id in ipairs(ids) do
+    local key = ARGV[4] .. ':job:' .. id
+    local attempts = tonumber(redis.call('HGET', key, 'attempts') or '0')
+    if attempts >= tonumber(redis.call('HGET', key, 'max_attempts') or '1') then
+        redis.call('ZREM', KEYS[1], id)
+        redis.call('HSET', key, 'status', 'dead', 'receipt', '', 'updated_at', ARGV[1],
+                   'error', 'Visibility timeout expired on the last attempt')
+        redis.call('RPUSH', KEYS[2], id)
+    else
+        redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[2]), id)
+        redis.call('HSET', key, 'status', 'running', 'receipt', ARGV[3], 'attempts', attempts + 1,
+                   'updated_at', ARGV[1])
+        return {id, redis.call('HGET', key, 'kind'), redis.call('HGET', key, 'payload'), attempts + 1}
+    end
+end
+return false
+"""
+
+_REDIS_EXTEND = """
+if redis.call('HGET', KEYS[2], 'receipt') ~= ARGV[2] then return 0 end
+redis.call('ZADD', KEYS[1], 'XX', ARGV[3], ARGV[1])
+return 1
+"""
+
+_REDIS_ACK = """
+if redis.call('HGET', KEYS[2], 'receipt') ~= ARGV[2] then return 0 end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[2], 'status', 'succeeded', 'result', ARGV[3], 'receipt', '', 'updated_at', ARGV[4])
+if tonumber(ARGV[5]) > 0 then
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+    redis.call('EXPIRE', KEYS[3], ARGV[5])
+end
+return 1
+"""
+
+_REDIS_FAIL = """
+if redis.call('HGET', KEYS[2], 'receipt') ~= ARGV[2] then return 0 end
+local attempts = tonumber(redis.call('HGET', KEYS[2], 'attempts'))
+if attempts >= tonumber(redis.call('HGET', KEYS[2], 'max_attempts')) then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HSET', KEYS[2], 'status', 'dead', 'error', ARGV[3], 'receipt', '', 'updated_at', ARGV[4])
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+    return 2
+end
+redis.call('ZADD', KEYS[1], tonumber(ARGV[4]) + tonumber(ARGV[5]), ARGV[1])
+redis.call('HSET', KEYS[2], 'status', 'queued', 'error', ARGV[3], 'receipt', '', 'updated_at', ARGV[4])
+return 1
+"""
+
+_REDIS_DEFER = """
+if redis.call('HGET', KEYS[2], 'receipt') ~= ARGV[2] then return 0 end
+redis.call('HINCRBY', KEYS[2], 'attempts', -1)
+redis.call('HSET', KEYS[2], 'status', 'queued', 'receipt', '', 'updated_at', ARGV[3])
+redis.call('ZADD', KEYS[1], tonumber(ARGV[3]) + tonumber(ARGV[4]), ARGV[1])
+return 1
+"""
+
+_REDIS_REQUEUE = """
+if redis.call('HGET', KEYS[2], 'status') ~= 'dead' then return 0 end
+redis.call('HSET', KEYS[2], 'status', 'queued', 'attempts', 0, 'updated_at', ARGV[2])
+redis.call('LREM', KEYS[3], 0, ARGV[1])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+return 1
+"""
+
+
+class RedisBroker:
+    """Broker on Redis or any Redis-compatible server; shared across nodes"""
+
+    def __init__(self, url, prefix='kk:jobs', result_ttl=0):
+        """
+        Args:
+            url (str): redis:// or rediss:// URL
+            prefix (str): Key prefix
+            result_ttl (int): Seconds finished jobs are kept; 0 keeps them
+        """
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("The redis job broker needs the redis package (pip install redis)") from e
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.result_ttl = int(result_ttl)
+        self._queue = f"{prefix}:queue"
+        self._dead = f"{prefix}:dead"
+        self._scripts = {name: self.client.register_script(source) for name, source in (
+            ('enqueue', _REDIS_ENQUEUE), ('reserve', _REDIS_RESERVE), ('extend', _REDIS_EXTEND),
+            ('ack', _REDIS_ACK), ('fail', _REDIS_FAIL), ('defer', _REDIS_DEFER), ('requeue', _REDIS_REQUEUE))}
+
+    def _key(self, job_id):
+        return f"{self.prefix}:job:{job_id}"
+
+    def _progress_key(self, job_id):
+        return f"{self.prefix}:progress:{job_id}"
+
+    def enqueue(self, kind, payload, job_id=None, max_attempts=3, delay=0):
+        job_id = job_id or new_job_id()
+        now = time.time()
+        created = self._scripts['enqueue'](
+            keys=[self._queue, self._key(job_id)],
+            args=[job_id, kind, json.dumps(payload), max_attempts, now, now + delay])
+        return job_id, created == 1
+
+    def reserve(self, visibility_timeout):
+        receipt = uuid.uuid4().hex
+        reserved = self._scripts['reserve'](
+            keys=[self._queue, self._dead], args=[time.time(), visibility_timeout, receipt, self.prefix])
+        if not reserved:
+            return None
+        job_id, kind, payload, attempts = reserved
+        progress = {field: json.loads(value)
+                    for field, value in self.client.hgetall(self._progress_key(job_id)).items()}
+        return Message(self, job_id, kind, json.loads(payload), int(attempts), receipt, progress)
+
+    def extend(self, message, visibility_timeout):
+        return self._scripts['extend'](
+            keys=[self._queue, self._key(message.id)],
+            args=[message.id, message.receipt, time.time() + visibility_timeout]) == 1
+
+    def ack(self, message, result=None):
+        return self._scripts['ack'](
+            keys=[self._queue, self._key(message.id), self._progress_key(message.id)],
+            args=[message.id, message.receipt, json.dumps(result), time.time(), self.result_ttl]) == 1
+
+    def fail(self, message, error, retry_delay=0):
+        outcome = self._scripts['fail'](
+            keys=[self._queue, self._key(message.id), self._dead],
+            args=[message.id, message.receipt, error, time.time(), retry_delay])
+        return {1: 'retry', 2: 'dead'}.get(outcome)
+
+    def defer(self, message, delay):
+        return self._scripts['defer'](
+            keys=[self._queue, self._key(message.id)],
+            args=[message.id, message.receipt, time.time(), delay]) == 1
+
+    def set_progress(self, job_id, **fields):
+        self.client.hset(self._progress_key(job_id),
+                         mapping={field: json.dumps(value) for field, value in fields.items()})
+
+    def _document(self, job):
+        return _public({
+            'id': job['id'],
+            'kind': job['kind'],
+            'status': job['status'],
+            'attempts': int(job['attempts']),
+            'max_attempts': int(job['max_attempts']),
+            'result': json.loads(job['result']) if job.get('result') else None,
+            'error': job.get('error') or None,
+            'created_at': float(job['created_at']),
+            'updated_at': float(job['updated_at'])
+        })
+
+    def get(self, job_id):
+        job = self.client.hgetall(self._key(job_id))
+        return self._document(job) if job else None
+
+    def dead_letters(self, limit=50):
+        documents = []
+        for job_id in self.client.lrange(self._dead, 0, limit - 1):
+            job = self.client.hgetall(self._key(job_id))
+            if job:
+                documents.append(self._document(job))
+        return documents
+
+    def requeue(self, job_id):
+        return self._scripts['requeue'](
+            keys=[self._queue, self._key(job_id), self._dead], args=[job_id, time.time()]) == 1
+
+    def purge(self, older_than):
+        """Finished jobs expire through result_ttl instead"""
+
+    def stats(self):
+        now = time.time()
+        pending = self.client.zcount(self._queue, '-inf', now)
+        return {
+            'ready_or_expired': pending,
+            'invisible': self.client.zcard(self._queue) - pending,
+            'dead': self.client.llen(self._dead)
+        }
+
+
+def create_broker(url=None):
+    """
+    Build a broker from a URL (default: JOB_BROKER_URL)
+
+    Raises:
+        ValueError: On an unsupported URL scheme
+    """
+    url = url or settings.JOB_BROKER_URL
+    if url.startswith('memory://'):
+        return InMemoryBroker()
+    if url.startswith('sqlite:///'):
+        return SQLiteBroker(url[len('sqlite:///'):])
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBroker(url, prefix=settings.JOB_REDIS_PREFIX, result_ttl=settings.JOB_RESULT_TTL)
+    raise ValueError(f"Unsupported job broker URL: {url}")
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """The process-wide broker, created on first use"""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = create_broker()
+    return _broker
+
+
+def enqueue(kind, payload, job_id=None):
+    """Queue a job on the shared broker; returns (job_id, created)"""
+    job_id, created = get_broker().enqueue(kind, payload, job_id=job_id, max_attempts=settings.JOB_MAX_ATTEMPTS)
+    if created:
+        JOBS.inc(kind=kind, status='queued')
+    return job_id, created
+
+
+def _status():
+    # Don't open a broker connection just to report on it
+    return get_broker().stats() if _broker is not None else {'connected': False}
+
+
+metrics.register_status_provider('job_queue', _status)
+
+
+class JobWorker:
+    """Reserves jobs from a broker and runs their handlers"""
+
+    def __init__(self, broker, handlers=None, visibility_timeout=300, retry_delay=10, poll_interval=1.0):
+        self.broker = broker
+        self.handlers = HANDLERS if handlers is None else handlers
+        self.visibility_timeout = visibility_timeout
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+
+    def _heartbeat(self, message, done):
+        # Keep the job hidden while the handler runs
+        while not done.wait(self.visibility_timeout / 3):
+            if not self.broker.extend(message, self.visibility_timeout):
+                print(f"Lost job {message.id}; another worker now owns it")
+                return
+
+    def run_once(self):
+        """
+        Reserve and run at most one job
+
+        Returns:
+            bool: False if no job was ready
+        """
+        message = self.broker.reserve(self.visibility_timeout)
+        if message is None:
+            return False
+
+        handler = self.handlers.get(message.kind)
+        if handler is None:
+            outcome = self.broker.fail(message, f"No handler for job kind {message.kind}", self.retry_delay)
+            JOBS.inc(kind=message.kind, status=outcome or 'stale')
+            return True
+
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(message, done), daemon=True)
+        heartbeat.start()
+        try:
+            result = handler(message.payload, message)
+        except Defer as e:
+            print(f"Job {message.id} ({message.kind}) deferred {e.delay:.0f}s: {str(e)}")
+            deferred = self.broker.defer(message, e.delay)
+            JOBS.inc(kind=message.kind, status='deferred' if deferred else 'stale')
+            return True
+        except Exception as e:
+            print(f"Job {message.id} ({message.kind}) attempt {message.attempts} failed: {str(e)}")
+            traceback.print_exc()
+            outcome = self.broker.fail(message, str(e), self.retry_delay)
+            JOBS.inc(kind=message.kind, status=outcome or 'stale')
+            return True
+        finally:
+            done.set()
+
+        acked = self.broker.ack(message, result)
+        JOBS.inc(kind=message.kind, status='succeeded' if acked else 'stale')
+        return True
+
+    def run(self, stop=None):
+        """Process jobs until stop (a threading.Event) is set"""
+        stop = stop or threading.Event()
+        last_purge = 0
+        while not stop.is_set():
+            try:
+                if time.time() - last_purge > 3600:
+                    self.broker.purge(time.time() - settings.JOB_RESULT_TTL)
+                    last_purge = time.time()
+                if not self.run_once():
+                    stop.wait(self.poll_interval)
+            except Exception as e:
+                # Broker hiccups (network, locked database) shouldn't kill the worker
+                print(f"Job worker error: {str(e)}")
+                stop.wait(self.poll_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run generation job workers against the shared broker")
+    parser.add_argument('--threads', type=int, default=settings.JOB_WORKER_THREADS,
+                        help="Jobs run at once by this process")
+    parser.add_argument('--dead-letters', action='store_true', help="List dead-lettered jobs and exit")
+    parser.add_argument('--requeue', metavar='JOB_ID', help="Give a dead-lettered job fresh attempts and exit")
+    args = parser.parse_args(argv)
+
+    broker = get_broker()
+    if args.dead_letters:
+        for job in broker.dead_letters():
+            print(json.dumps(job))
+        return 0
+    if args.requeue:
+        print("Requeued" if broker.requeue(args.requeue) else "Not a dead-lettered job")
+        return 0
+
+    # Registers the job handlers
+    import app  # noqa: F401
+
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=JobWorker(broker, visibility_timeout=settings.JOB_VISIBILITY_TIMEOUT,
+                                          retry_delay=settings.JOB_RETRY_DELAY).run,
+                         args=(stop,), name=f"job-worker-{index}", daemon=True)
+        for index in range(args.threads)
+    ]
+    for thread in threads:
+        thread.start()
+    print(f"Job worker running {args.threads} threads against {settings.JOB_BROKER_URL}")
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("Stopping; running jobs finish first")
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,373 @@
+"""
+Embedded metadata store for submissions and generations
+
+Every drawing submission, transform, inpaint and text-to-image generation is
+recorded as a row in one SQLite `items` table, indexed by holdjarID, content
+hash and creation time, so galleries, quotas, rarity and dedupe can use
+indexed lookups instead of scanning directories.
+
+- WAL journal mode, so readers never block the writer (or each other)
+- one connection per thread, opened lazily and re-opened after a fork, so
+  every gunicorn worker gets its own connections
+- writes go through a queue to a single writer thread that commits them in
+  batches of up to METADATA_BATCH_SIZE rows or every METADATA_FLUSH_MS,
+  keeping request handlers off the fsync path
+
+record() returns immediately; call flush() (or record(..., wait=True)) when a
+later read in the same request must see the row.
+"""
+import atexit
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import metrics
+import settings
+
+COLUMNS = (
+    'kind', 'holdjar_id', 'name', 'subject', 'prompt', 'style', 'venice_id',
+    'content_hash', 'image_url', 'file_path', 'source_url', 'traits_json', 'created_at'
+)
+
+# Item kinds recorded by the API
+KINDS = ('drawing', 'transform', 'inpaint', 'generation')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    holdjar_id TEXT,
+    name TEXT,
+    subject TEXT,
+    prompt TEXT,
+    style TEXT,
+    venice_id TEXT,
+    content_hash TEXT,
+    image_url TEXT,
+    file_path TEXT,
+    source_url TEXT,
+    traits_json TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_items_holdjar ON items (holdjar_id, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_items_content_hash ON items (content_hash);
+CREATE INDEX IF NOT EXISTS idx_items_created ON items (created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_items_kind ON items (kind, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_items_gallery ON items (holdjar_id, created_at DESC, id DESC)
+    WHERE file_path IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_items_export ON items (holdjar_id, id) WHERE file_path IS NOT NULL;
+CREATE TABLE IF NOT EXISTS trait_documents (
+    content_hash TEXT PRIMARY KEY,
+    traits_json TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+WRITES = metrics.Counter('kk_metadata_writes_total', 'Metadata rows written by outcome', ['status'])
+
+
+class _Flush:
+    """Queue marker; set once every row queued before it is committed"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class MetadataStore:
+    """SQLite-backed item store with per-thread readers and a batching writer"""
+
+    def __init__(self, path, batch_size=100, flush_interval=0.05):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._writer = None
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute('PRAGMA journal_mode=WAL')
+        # WAL + NORMAL stays consistent after a crash; only the last commits can be lost on power failure
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _ensure_started(self):
+        """Create the schema and writer thread once per process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = self._connect()
+            with connection:
+                connection.executescript(SCHEMA)
+            connection.close()
+            # A forked child inherits the parent's queue object but not its writer thread
+            self._queue = queue.Queue()
+            self._local = threading.local()
+            self._writer = threading.Thread(target=self._write_loop, name='metadata-writer', daemon=True)
+            self._writer.start()
+            self._pid = os.getpid()
+
+    def connection(self):
+        """This thread's read connection"""
+        self._ensure_started()
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._connect()
+            self._local.connection = connection
+        return connection
+
+    def record(self, kind, wait=False, **fields):
+        """
+        Queue an item for insertion
+
+        Args:
+            kind (str): One of KINDS
+            wait (bool): Block until the row is committed
+            **fields: Column values; `traits` is stored as JSON in traits_json
+
+        Raises:
+            ValueError: On an unknown kind or column
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown item kind: {kind}")
+        traits = fields.pop('traits', None)
+        if traits is not None:
+            fields['traits_json'] = json.dumps(traits)
+        unknown = set(fields) - set(COLUMNS)
+        if unknown:
+            raise ValueError(f"Unknown item fields: {', '.join(sorted(unknown))}")
+        fields['kind'] = kind
+        fields.setdefault('created_at', time.time())
+
+        self._ensure_started()
+        self._queue.put(tuple(fields.get(column) for column in COLUMNS))
+        if wait:
+            self.flush()
+
+    def flush(self, timeout=10):
+        """
+        Wait until everything queued so far is committed
+
+        Returns:
+            bool: False if the writer didn't catch up within the timeout
+        """
+        self._ensure_started()
+        marker = _Flush()
+        self._queue.put(marker)
+        return marker.done.wait(timeout)
+
+    def _write_loop(self):
+        connection = self._connect()
+        insert = f"INSERT INTO items ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+        while True:
+            rows, markers = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if isinstance(item, _Flush):
+                    markers.append(item)
+                else:
+                    rows.append(item)
+                if len(rows) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+
+            if rows:
+                try:
+                    with connection:
+                        connection.executemany(insert, rows)
+                    WRITES.inc(len(rows), status='ok')
+                except sqlite3.Error as e:
+                    # One bad row must not cost the rest of the batch; retry them one at a time
+                    print(f"Error writing {len(rows)} metadata rows, retrying one by one: {str(e)}")
+                    self._write_rows(connection, insert, rows)
+            for marker in markers:
+                marker.done.set()
+
+    @staticmethod
+    def _write_rows(connection, insert, rows):
+        for row in rows:
+            try:
+                with connection:
+                    connection.execute(insert, row)
+                WRITES.inc(status='ok')
+            except sqlite3.Error as e:
+                print(f"Dropping metadata row for holdjarID {row[COLUMNS.index('holdjar_id')]!r}: {str(e)}")
+                WRITES.inc(status='error')
+
+    def pending(self):
+        return self._queue.qsize()
+
+    @staticmethod
+    def _item(row):
+        item = dict(row)
+        traits_json = item.pop('traits_json', None)
+        item['traits'] = json.loads(traits_json) if traits_json else None
+        return item
+
+    def get(self, item_id):
+        """Return one item by ID, or None"""
+        row = self.connection().execute('SELECT * FROM items WHERE id = ?', (item_id,)).fetchone()
+        return self._item(row) if row else None
+
+    def items_for_holdjar(self, holdjar_id, kind=None, limit=50, before=None):
+        """
+        Newest items for a holdjarID, using the (holdjar_id, created_at, id) index
+
+        Args:
+            holdjar_id (str): Owner identifier
+            kind (str): Optional item kind filter
+            limit (int): Maximum number of items
+            before (tuple): Optional (created_at, id) keyset cursor; only older items are returned
+
+        Returns:
+            list: Items, newest first
+        """
+        query = 'SELECT * FROM items WHERE holdjar_id = ?'
+        params = [holdjar_id]
+        if kind:
+            query += ' AND kind = ?'
+            params.append(kind)
+        if before:
+            query += ' AND (created_at < ? OR (created_at = ? AND id < ?))'
+            params.extend([before[0], before[0], before[1]])
+        query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+        params.append(limit)
+        return [self._item(row) for row in self.connection().execute(query, params)]
+
+    def gallery_items(self, holdjar_id, limit=50, before=None):
+        """
+        Newest items with an image for a holdjarID (uses the partial gallery index)
+
+        Args:
+            holdjar_id (str): Owner identifier
+            limit (int): Maximum number of items
+            before (tuple): Optional (created_at, id) keyset cursor
+
+        Returns:
+            list: Items, newest first
+        """
+        query = 'SELECT * FROM items WHERE holdjar_id = ? AND file_path IS NOT NULL'
+        params = [holdjar_id]
+        if before:
+            query += ' AND (created_at < ? OR (created_at = ? AND id < ?))'
+            params.extend([before[0], before[0], before[1]])
+        query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+        params.append(limit)
+        return [self._item(row) for row in self.connection().execute(query, params)]
+
+    def export_items(self, holdjar_id=None, after=0, limit=200):
+        """
+        Items with an image in ascending id order, for resumable exports
+
+        Args:
+            holdjar_id (str): Only this owner's items; None for all
+            after (int): Only items with a larger id
+            limit (int): Maximum number of items
+
+        Returns:
+            list: Items, oldest first
+        """
+        if holdjar_id is None:
+            rows = self.connection().execute(
+                'SELECT * FROM items WHERE id > ? AND file_path IS NOT NULL ORDER BY id LIMIT ?', (after, limit))
+        else:
+            rows = self.connection().execute(
+                'SELECT * FROM items WHERE holdjar_id = ? AND file_path IS NOT NULL AND id > ? ORDER BY id LIMIT ?',
+                (holdjar_id, after, limit))
+        return [self._item(row) for row in rows]
+
+    def items_by_content_hash(self, content_hash):
+        """Every item recorded for an image's content hash, oldest first"""
+        rows = self.connection().execute(
+            'SELECT * FROM items WHERE content_hash = ? ORDER BY created_at, id', (content_hash,))
+        return [self._item(row) for row in rows]
+
+    def trait_document(self, content_hash):
+        """The trait document stored for an image's content hash, or None"""
+        row = self.connection().execute(
+            'SELECT traits_json FROM trait_documents WHERE content_hash = ?', (content_hash,)).fetchone()
+        return json.loads(row['traits_json']) if row else None
+
+    def store_trait_document(self, content_hash, traits, replace=False):
+        """
+        Store an image's trait document (written directly, not through the batching writer)
+
+        Args:
+            content_hash (str): content_hash of the image bytes
+            traits (dict): Trait document
+            replace (bool): Overwrite an existing document; otherwise the first one wins
+
+        Returns:
+            dict: The document now stored for the hash
+        """
+        connection = self.connection()
+        verb = 'INSERT OR REPLACE' if replace else 'INSERT OR IGNORE'
+        with connection:
+            connection.execute(
+                f'{verb} INTO trait_documents (content_hash, traits_json, created_at) VALUES (?, ?, ?)',
+                (content_hash, json.dumps(traits), time.time()))
+        if replace:
+            return traits
+        return self.trait_document(content_hash)
+
+    def recent(self, limit=50, kind=None):
+        """Newest items across all owners"""
+        if kind:
+            rows = self.connection().execute(
+                'SELECT * FROM items WHERE kind = ? ORDER BY created_at DESC LIMIT ?', (kind, limit))
+        else:
+            rows = self.connection().execute(
+                'SELECT * FROM items ORDER BY created_at DESC, id DESC LIMIT ?', (limit,))
+        return [self._item(row) for row in rows]
+
+    def counts_for_holdjar(self, holdjar_id):
+        """Number of items per kind for a holdjarID"""
+        rows = self.connection().execute(
+            'SELECT kind, COUNT(*) AS count FROM items WHERE holdjar_id = ? GROUP BY kind', (holdjar_id,))
+        return {row['kind']: row['count'] for row in rows}
+
+    def snapshot(self):
+        """Writer state for /api/status"""
+        return {
+            'pending_writes': self.pending(),
+            'written': WRITES.value(status='ok'),
+            'write_errors': WRITES.value(status='error')
+        }
+
+
+STORE = MetadataStore(
+    settings.METADATA_DB_PATH,
+    batch_size=settings.METADATA_BATCH_SIZE,
+    flush_interval=settings.METADATA_FLUSH_MS / 1000.0
+)
+metrics.register_status_provider('metadata_store', STORE.snapshot)
+
+
+@atexit.register
+def _flush_on_exit():
+    # Don't lose the last batch when the process exits normally
+    if STORE._pid == os.getpid():
+        STORE.flush(timeout=5)
+
+
+def record_safely(kind, **fields):
+    """record() for request handlers: a metadata failure must never fail the request"""
+    try:
+        STORE.record(kind, **fields)
+    except Exception as e:
+        print(f"Error recording {kind} metadata: {str(e)}")
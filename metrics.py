@@ -0,0 +1,456 @@
+"""
+Prometheus-style metrics for the KryptoKids API
+
+A small in-process registry (counters, gauges and histograms) rendered in
+the Prometheus text exposition format at /metrics. Every metric is updated
+incrementally under its own lock, so recording is cheap on the hot path and
+scraping never scans request history.
+
+Each gunicorn worker process keeps its own registry; scrape every worker
+(or run a single multi-threaded / gevent worker) to see the full picture.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+# Upstream generations run from sub-second to a minute, so the buckets reach further
+# than the usual Prometheus defaults
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Base class handling names, labels and registration"""
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+    TYPE = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def total(self):
+        """Sum across all label sets"""
+        with self._lock:
+            return sum(self._values.values())
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets"""
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            # Buckets are non-cumulative internally and summed at render time
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][index] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the wrapped block in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self, **labels):
+        """Return (bucket bounds, cumulative counts, sum, count) for one label set"""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            if state is None:
+                return self.buckets, [0] * len(self.buckets), 0.0, 0
+            counts = list(state['counts'])
+            total, count = state['sum'], state['count']
+        cumulative, running = [], 0
+        for bucket_count in counts:
+            running += bucket_count
+            cumulative.append(running)
+        return self.buckets, cumulative, total, count
+
+    def _render_sample(self, key, state):
+        lines, running = [], 0
+        for bound, bucket_count in zip(self.buckets, state['counts']):
+            running += bucket_count
+            labels = _format_labels(self.labelnames, key, ('le', _format_value(float(bound))))
+            lines.append(f"{self.name}_bucket{labels} {running}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(state['sum'])}")
+        lines.append(f"{self.name}_count{labels} {state['count']}")
+        return lines
+
+
+class RollingPercentiles:
+    """
+    Percentiles over the most recent observations
+
+    A fixed-size ring buffer is updated in O(1) per observation; percentiles
+    sort at most `size` values, so reading them stays cheap however long the
+    process has been running.
+    """
+
+    def __init__(self, size=512):
+        from collections import deque
+        self._values = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self._values.append(value)
+
+    def percentiles(self, quantiles=(0.5, 0.9, 0.95, 0.99)):
+        with self._lock:
+            values = sorted(self._values)
+        if not values:
+            return {}
+        result = {}
+        for quantile in quantiles:
+            index = min(len(values) - 1, int(round(quantile * (len(values) - 1))))
+            result[f"p{int(quantile * 100)}"] = round(values[index], 4)
+        result['samples'] = len(values)
+        return result
+
+
+class Registry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics.append(metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# HTTP server metrics
+HTTP_REQUESTS = Counter(
+    'kk_http_requests_total', 'HTTP requests handled', ['route', 'method', 'status'])
+HTTP_IN_FLIGHT = Gauge(
+    'kk_http_requests_in_flight', 'HTTP requests currently being handled', ['route'])
+HTTP_LATENCY = Histogram(
+    'kk_http_request_duration_seconds', 'HTTP request latency', ['route', 'method'])
+
+# Upstream Venice metrics
+VENICE_LATENCY = Histogram(
+    'kk_venice_request_duration_seconds', 'Venice API call latency', ['method', 'model'])
+VENICE_RESPONSES = Counter(
+    'kk_venice_responses_total', 'Venice API calls by outcome', ['method', 'model', 'status'])
+VENICE_IN_FLIGHT = Gauge(
+    'kk_venice_requests_in_flight', 'Venice API calls currently waiting on a response')
+VENICE_REPORTED = Histogram(
+    'kk_venice_reported_duration_seconds', "Server-side durations from Venice's timing object", ['phase'])
+
+# Local image work
+IMAGE_STAGE = Histogram(
+    'kk_image_stage_duration_seconds', 'Time spent decoding, saving and analyzing images', ['stage'])
+
+# Recent upstream latencies (seconds) for the rolling percentiles in /api/status
+VENICE_RECENT_LATENCY = RollingPercentiles()
+
+# Keys of the `timing` object Venice returns with every generation (milliseconds)
+VENICE_TIMING_PHASES = {
+    'inferenceDuration': 'inference',
+    'inferencePreprocessingTime': 'preprocessing',
+    'inferenceQueueTime': 'queue',
+    'total': 'total',
+}
+
+
+class _UpstreamCall:
+    status = 'error'
+
+
+@contextmanager
+def upstream_call(method, model):
+    """
+    Record latency, outcome and concurrency of one Venice API call
+
+    Set `.status` on the yielded object to the HTTP status code once the
+    response arrives; calls that raise before that are counted as errors.
+
+    Args:
+        method (str): VeniceAPI method making the call
+        model (str): Model named in the payload
+    """
+    call = _UpstreamCall()
+    VENICE_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    try:
+        yield call
+    finally:
+        elapsed = time.perf_counter() - started
+        VENICE_IN_FLIGHT.dec()
+        VENICE_LATENCY.observe(elapsed, method=method, model=model)
+        VENICE_RECENT_LATENCY.observe(elapsed)
+        VENICE_RESPONSES.inc(method=method, model=model, status=call.status)
+
+
+def observe_venice_timing(result):
+    """
+    Record the `timing` block of a Venice response
+
+    Args:
+        result (dict): Parsed Venice API response
+    """
+    timing = result.get('timing') if isinstance(result, dict) else None
+    if not isinstance(timing, dict):
+        return
+    for key, phase in VENICE_TIMING_PHASES.items():
+        value = timing.get(key)
+        if isinstance(value, (int, float)):
+            VENICE_REPORTED.observe(value / 1000.0, phase=phase)
+
+
+class CacheStats:
+    """
+    Hit/miss accounting for an in-process cache
+
+    Instances register themselves under `caches` in the /api/status snapshot
+    and export kk_cache_requests_total{cache, result} to /metrics.
+    """
+
+    def __init__(self, name, size_fn=None):
+        self.name = name
+        self.size_fn = size_fn
+        _caches[name] = self
+
+    def hit(self):
+        CACHE_REQUESTS.inc(cache=self.name, result='hit')
+
+    def miss(self):
+        CACHE_REQUESTS.inc(cache=self.name, result='miss')
+
+    def snapshot(self):
+        hits = CACHE_REQUESTS.value(cache=self.name, result='hit')
+        misses = CACHE_REQUESTS.value(cache=self.name, result='miss')
+        lookups = hits + misses
+        snapshot = {'hits': hits, 'misses': misses,
+                    'hit_ratio': round(hits / lookups, 4) if lookups else None}
+        if self.size_fn is not None:
+            snapshot['size'] = self.size_fn()
+        return snapshot
+
+
+CACHE_REQUESTS = Counter('kk_cache_requests_total', 'Cache lookups by result', ['cache', 'result'])
+_caches = {}
+
+# Named callables contributing extra sections to /api/status (queues, caches, ...)
+_status_providers = {}
+
+
+def register_status_provider(name, provider):
+    """
+    Add a section to the operational snapshot in /api/status
+
+    Providers must be cheap: they are called on every status poll.
+
+    Args:
+        name (str): Key of the section in the snapshot
+        provider (callable): Returns a JSON-serializable value
+    """
+    _status_providers[name] = provider
+
+
+def _sum_counter(counter, predicate):
+    with counter._lock:
+        items = list(counter._values.items())
+    return sum(value for key, value in items if predicate(dict(zip(counter.labelnames, key))))
+
+
+def process_memory():
+    """
+    Resident memory of this process in bytes
+
+    Returns:
+        dict: Current RSS (Linux) and peak RSS
+    """
+    import resource
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    memory = {'peak_rss_bytes': peak if sys.platform == 'darwin' else peak * 1024}
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        import os
+        memory['rss_bytes'] = resident_pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    return memory
+
+
+def status_snapshot():
+    """
+    Operational snapshot built from incrementally maintained counters
+
+    Returns:
+        dict: In-flight work, error counts, upstream latency percentiles,
+        memory and every registered provider section
+    """
+    snapshot = {
+        'http_in_flight': HTTP_IN_FLIGHT.total(),
+        'upstream_in_flight': VENICE_IN_FLIGHT.value(),
+        'upstream_latency_seconds': VENICE_RECENT_LATENCY.percentiles(),
+        'errors': {
+            'http_5xx': _sum_counter(HTTP_REQUESTS, lambda labels: labels['status'].startswith('5')),
+            'upstream': _sum_counter(VENICE_RESPONSES, lambda labels: labels['status'] != '200'),
+        },
+        'memory': process_memory(),
+        'caches': {name: cache.snapshot() for name, cache in list(_caches.items())},
+    }
+    for name, provider in list(_status_providers.items()):
+        try:
+            snapshot[name] = provider()
+        except Exception as e:
+            snapshot[name] = {'error': str(e)}
+    return snapshot
+
+
+def init_app(app):
+    """
+    Instrument a Flask app and expose /metrics
+
+    Args:
+        app (Flask): Application to instrument
+    """
+    from flask import Response, g, request
+
+    def _route():
+        return request.url_rule.rule if request.url_rule else 'unmatched'
+
+    @app.before_request
+    def _start_request_metrics():
+        g._metrics_started = time.perf_counter()
+        g._metrics_route = _route()
+        HTTP_IN_FLIGHT.inc(route=g._metrics_route)
+
+    @app.after_request
+    def _record_response_metrics(response):
+        if '_metrics_route' in g:
+            HTTP_REQUESTS.inc(route=g._metrics_route, method=request.method, status=response.status_code)
+            g._metrics_counted = True
+        return response
+
+    @app.teardown_request
+    def _finish_request_metrics(exc):
+        started = g.pop('_metrics_started', None)
+        if started is None:
+            return
+        route = g.pop('_metrics_route')
+        HTTP_IN_FLIGHT.dec(route=route)
+        HTTP_LATENCY.observe(time.perf_counter() - started, route=route, method=request.method)
+        # Unhandled errors that never produced a response still need counting
+        if not g.pop('_metrics_counted', False):
+            HTTP_REQUESTS.inc(route=route, method=request.method, status=500)
+
+    def metrics_endpoint():
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metrics_endpoint, methods=['GET'])
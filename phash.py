@@ -0,0 +1,231 @@
+"""
+Perceptual hashes and a near-duplicate index
+
+Every uploaded drawing and generated image gets a 64-bit difference hash
+(dHash): the image is shrunk to 9x8 grayscale and each bit records whether a
+pixel is brighter than its right-hand neighbour. Visually similar images end
+up a few bits apart, so "near-duplicate" means a small Hamming distance.
+
+HashIndex answers radius queries with multi-index hashing: each hash is split
+into four 16-bit chunks, each chunk has its own lookup table, and two hashes
+within distance r must agree on at least one chunk to within r // 4 bits.
+A query therefore probes a few dozen buckets and verifies a small candidate
+set, instead of scanning the collection - well under a millisecond at a
+million images for the radii used here.
+
+The index is persisted to an append-only file of fixed-size records. Each
+process keeps an in-memory copy and picks up records appended by other
+workers before every query.
+"""
+import os
+import struct
+import threading
+from itertools import combinations
+
+import settings
+
+HASH_BITS = 64
+CHUNK_BITS = 16
+CHUNKS = HASH_BITS // CHUNK_BITS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+# Record: 64-bit hash + raw SHA-256 of the image bytes
+RECORD = struct.Struct('>Q32s')
+
+# Nearest-neighbour search radius used for uniqueness_factor; farther images count as unrelated
+UNIQUENESS_RADIUS = 7
+
+
+# Native popcount on Python 3.10+
+_popcount = getattr(int, 'bit_count', None) or (lambda value: bin(value).count('1'))
+
+
+def hamming(a, b):
+    """Number of differing bits between two hashes"""
+    return _popcount(a ^ b)
+
+
+def dhash(image):
+    """
+    Compute the 64-bit difference hash of an image
+
+    Args:
+        image (PIL.Image.Image): Opened image (any mode/size)
+
+    Returns:
+        int: Perceptual hash
+    """
+    from PIL import Image
+
+    # Decode JPEGs at reduced scale; the hash only needs 9x8 pixels
+    if image.format == 'JPEG':
+        image.draft('L', (64, 64))
+    pixels = list(image.convert('L').resize((9, 8), Image.BOX).getdata())
+
+    value = 0
+    for row in range(8):
+        offset = row * 9
+        for column in range(8):
+            value = (value << 1) | (pixels[offset + column] > pixels[offset + column + 1])
+    return value
+
+
+def dhash_bytes(image_data):
+    """dHash of raw image file bytes"""
+    from io import BytesIO
+    from PIL import Image
+    return dhash(Image.open(BytesIO(image_data)))
+
+
+def _chunks(value):
+    return [(value >> (index * CHUNK_BITS)) & CHUNK_MASK for index in range(CHUNKS)]
+
+
+def _neighbours(chunk, radius):
+    """Yield every chunk value within `radius` bits of `chunk`"""
+    yield chunk
+    for flips in range(1, radius + 1):
+        for bits in combinations(range(CHUNK_BITS), flips):
+            flipped = chunk
+            for bit in bits:
+                flipped ^= 1 << bit
+            yield flipped
+
+
+class HashIndex:
+    """Multi-index hash table over 64-bit perceptual hashes"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._hashes = []
+        self._digests = []
+        self._known = set()
+        self._tables = [{} for _ in range(CHUNKS)]
+        self._offset = 0
+        self._lock = threading.Lock()
+        if path:
+            self.refresh()
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _insert(self, value, digest):
+        position = len(self._hashes)
+        self._hashes.append(value)
+        self._digests.append(digest)
+        self._known.add(digest)
+        for table, chunk in zip(self._tables, _chunks(value)):
+            table.setdefault(chunk, []).append(position)
+
+    def refresh(self):
+        """Load records appended to the index file since the last read"""
+        if not self.path:
+            return
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        with self._lock:
+            if size <= self._offset:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                # Ignore a partially written trailing record; it is read next time
+                data = f.read((size - self._offset) // RECORD.size * RECORD.size)
+            for value, raw_digest in RECORD.iter_unpack(data):
+                digest = raw_digest.hex()
+                if digest not in self._known:
+                    self._insert(value, digest)
+            self._offset += len(data)
+
+    def add(self, value, digest):
+        """
+        Add an image's hash to the index (no-op if the image is already indexed)
+
+        Args:
+            value (int): Perceptual hash
+            digest (str): Hex SHA-256 of the image bytes
+        """
+        self.refresh()
+        with self._lock:
+            if digest in self._known:
+                return
+            self._insert(value, digest)
+            if self.path:
+                # Our own record is skipped as already known when refresh() reads it back
+                with open(self.path, 'ab') as f:
+                    f.write(RECORD.pack(value, bytes.fromhex(digest)))
+
+    def search(self, value, radius, exclude=None):
+        """
+        Find indexed images within a Hamming radius
+
+        Args:
+            value (int): Perceptual hash to look up
+            radius (int): Maximum Hamming distance
+            exclude (str): Content hash to leave out (the image itself)
+
+        Returns:
+            list: (distance, content hash) pairs, closest first
+        """
+        self.refresh()
+        chunk_radius = radius // CHUNKS
+        candidates = set()
+        with self._lock:
+            for table, chunk in zip(self._tables, _chunks(value)):
+                for probe in _neighbours(chunk, chunk_radius):
+                    positions = table.get(probe)
+                    if positions:
+                        candidates.update(positions)
+
+            matches = []
+            for position in candidates:
+                distance = _popcount(value ^ self._hashes[position])
+                digest = self._digests[position]
+                if distance <= radius and digest != exclude:
+                    matches.append((distance, digest))
+        matches.sort()
+        return matches
+
+    def nearest(self, value, radius, exclude=None):
+        """
+        Closest indexed image within a radius
+
+        Returns:
+            tuple: (distance, content hash), or None when nothing is that close
+        """
+        matches = self.search(value, radius, exclude=exclude)
+        return matches[0] if matches else None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Return the process-wide index backed by PHASH_INDEX_PATH"""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                directory = os.path.dirname(settings.PHASH_INDEX_PATH)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                _index = HashIndex(settings.PHASH_INDEX_PATH)
+    return _index
+
+
+def uniqueness_factor(distance):
+    """
+    Map nearest-neighbour distance to a 1-100 uniqueness score
+
+    Args:
+        distance (int): Hamming distance to the closest other image, or None if
+            nothing is within UNIQUENESS_RADIUS
+
+    Returns:
+        int: 1 for an exact perceptual match, 100 for an unrelated image
+    """
+    if distance is None:
+        return 100
+    return max(1, round(100 * distance / (UNIQUENESS_RADIUS + 1)))
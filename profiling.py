@@ -0,0 +1,241 @@
+"""
+Opt-in per-request profiling
+
+Profiling is off unless an operator turns it on, either for a random
+fraction of requests (PROFILE_SAMPLE_RATE) or for a single request by
+sending the shared secret in an `X-Profile-Token` header (PROFILE_TOKEN).
+
+Two profilers are available (PROFILE_MODE):
+
+    sample    statistical sampler (default). A background thread snapshots the
+              stacks of the request thread and of every thread doing work for
+              the request every PROFILE_INTERVAL_MS, and writes collapsed stacks
+              (*.folded), ready for flamegraph.pl or speedscope.
+    cprofile  deterministic cProfile. Writes pstats files (*.prof) for
+              snakeviz, flameprof or `python -m pstats`. cProfile only sees
+              the request thread, so use sample mode for async handlers.
+
+With ASYNC_HANDLERS the view runs on an asgiref event loop thread and hands
+blocking work to executor threads through to_thread(); both are followed,
+so their stacks show up under the thread's name. Work deferred past the
+response (DEFER_POST_PROCESSING, background tasks) runs after the profile is
+written and isn't covered.
+
+Output files go to PROFILE_DIR and are named
+`<timestamp>_<route>_<request id>.<ext>` so a slow request can be matched to
+its profile through the X-Request-ID response header.
+"""
+import contextvars
+import functools
+import hmac
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import settings
+
+PROFILE_HEADER = 'X-Profile-Token'
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+# Profiler of the request being handled; copied into the threads its async work runs on
+_ACTIVE = contextvars.ContextVar('profiler', default=None)
+
+
+class StackSampler:
+    """Statistical profiler sampling the stacks of a request's threads on a timer"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = {}
+        # Other threads working for the request, by ident, with the name their stacks are rooted at
+        self._followed = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def follow(self, thread_id, name):
+        with self._lock:
+            self._followed[thread_id] = name
+
+    def unfollow(self, thread_id):
+        with self._lock:
+            self._followed.pop(thread_id, None)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = [(self.thread_id, None)] + list(self._followed.items())
+            for thread_id, name in threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if name:
+                    stack.append(f"[{name}]")
+                key = ';'.join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def write(self, path):
+        """Write collapsed stacks, one `frame;frame;frame count` line per stack"""
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f"{stack} {count}\n")
+
+
+class DeterministicProfiler:
+    """cProfile wrapper with the same start/stop/write interface"""
+
+    def __init__(self):
+        import cProfile
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def write(self, path):
+        self._profile.dump_stats(path)
+
+
+@contextmanager
+def _following():
+    """Sample the calling thread along with the profiled request it is working for"""
+    profiler = _ACTIVE.get()
+    if not isinstance(profiler, StackSampler):
+        yield
+        return
+    thread = threading.current_thread()
+    profiler.follow(thread.ident, thread.name)
+    try:
+        yield
+    finally:
+        profiler.unfollow(thread.ident)
+
+
+def _followed(fn):
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        with _following():
+            return fn(*args, **kwargs)
+    return run
+
+
+async def to_thread(fn, *args, **kwargs):
+    """
+    asyncio.to_thread for request handlers: the executor thread is profiled with the request
+
+    Args:
+        fn (callable): Blocking work to run in the default executor
+
+    Returns:
+        The return value of fn
+    """
+    import asyncio
+    # to_thread copies the context, so the worker sees this request's profiler
+    return await asyncio.to_thread(_followed(fn), *args, **kwargs)
+
+
+def _route_slug(request):
+    rule = request.url_rule.rule if request.url_rule else request.path
+    return re.sub(r'[^A-Za-z0-9]+', '_', rule).strip('_') or 'root'
+
+
+def _token_matches(request):
+    token = request.headers.get(PROFILE_HEADER)
+    if not token or not settings.PROFILE_TOKEN:
+        return False
+    return hmac.compare_digest(token.encode(), settings.PROFILE_TOKEN.encode())
+
+
+def init_app(app):
+    """
+    Assign request IDs and profile selected requests
+
+    Args:
+        app (Flask): Application to instrument
+    """
+    from flask import g, request
+
+    # Async views run on an event loop in another thread; follow it for the whole view
+    async_to_sync = app.async_to_sync
+
+    def followed_async_to_sync(func):
+        @functools.wraps(func)
+        async def run(*args, **kwargs):
+            with _following():
+                return await func(*args, **kwargs)
+        return async_to_sync(run)
+
+    app.async_to_sync = followed_async_to_sync
+
+    @app.before_request
+    def _start_profiling():
+        # Client-supplied IDs end up in file names, so keep them to a safe alphabet
+        supplied = re.sub(r'[^A-Za-z0-9_-]', '', request.headers.get(REQUEST_ID_HEADER, ''))[:64]
+        g.request_id = supplied or uuid.uuid4().hex
+
+        requested = _token_matches(request)
+        sampled = settings.PROFILE_SAMPLE_RATE > 0 and random.random() < settings.PROFILE_SAMPLE_RATE
+        if not (requested or sampled):
+            return
+
+        if settings.PROFILE_MODE == 'cprofile':
+            profiler = DeterministicProfiler()
+        else:
+            profiler = StackSampler(threading.get_ident(), settings.PROFILE_INTERVAL_MS / 1000.0)
+        try:
+            profiler.start()
+        except ValueError as e:
+            # Newer Pythons allow only one cProfile per process at a time
+            print(f"Skipping profile for request {g.request_id}: {str(e)}")
+            return
+        g._profiler = profiler
+        _ACTIVE.set(profiler)
+        g._profile_requested = requested
+        g._profile_started = time.time()
+
+    @app.after_request
+    def _tag_response(response):
+        response.headers[REQUEST_ID_HEADER] = g.get('request_id', '')
+        if g.get('_profile_requested'):
+            response.headers['X-Profile-Id'] = g.request_id
+        return response
+
+    @app.teardown_request
+    def _finish_profiling(exc):
+        profiler = g.pop('_profiler', None)
+        if profiler is None:
+            return
+        # Worker threads are reused across requests, so don't leave the profiler in their context
+        _ACTIVE.set(None)
+        profiler.stop()
+
+        extension = 'prof' if isinstance(profiler, DeterministicProfiler) else 'folded'
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(g.pop('_profile_started')))
+        filename = f"{stamp}_{_route_slug(request)}_{g.request_id}.{extension}"
+        try:
+            os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+            profiler.write(os.path.join(settings.PROFILE_DIR, filename))
+            print(f"Profile written: {os.path.join(settings.PROFILE_DIR, filename)}")
+        except OSError as e:
+            print(f"Error writing profile {filename}: {str(e)}")
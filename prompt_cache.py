@@ -0,0 +1,588 @@
+"""
+Result cache and off-peak pre-warming for prompt-determined generations
+
+The images of `generate_image` (prompted by `build_prompt` for
+/api/transform-drawing, which doesn't send the drawing itself) and
+`text_to_image_for_kids` (prompted by `build_kid_friendly_prompt`) depend
+only on the animal or description, the style and the size, so a repeated
+request can be answered with the Venice response of an earlier one. With
+PROMPT_CACHE_TTL set (default 0: off) responses are stored in a SQLite file
+shared by every worker on the host, keyed by a hash of those name-free
+arguments (the "request", see VeniceAPI.cached_result). The child's name is
+only added when the prompt for a miss is built, so the same dragon for
+another child is a hit. The views check the cache before queueing for a
+scheduler slot, so a hit answers in milliseconds instead of waiting 10+
+seconds on Venice.
+
+Every lookup also bumps an exponentially decaying popularity score for its
+request (half-life PROMPT_POPULARITY_HALF_LIFE seconds). Bumps and hit times
+are buffered per worker and written in one transaction every FLUSH_INTERVAL
+seconds, so lookups only read. During the local hours in PREWARM_HOURS
+(e.g. "1-6", or "22-5" across midnight) a background thread regenerates the
+most popular requests whose entries are missing or expire within a day, so
+they are warm for the next peak:
+
+- at most PREWARM_DAILY_BUDGET Venice generations per day across all workers
+  (default 0: pre-warming off)
+- only requests scoring at least PREWARM_MIN_SCORE
+- calls run in the scheduler's batch lane without counting against any
+  wallet's quota, and a run stops as soon as interactive traffic preempts it
+
+With PROMPT_CACHE_SEMANTIC=1, text-to-image responses are also filed under a
+normalized key (see normalize_description), so near-identical descriptions
+share a generation: "A blue dragon!!" and "blue dragons" hit the same entry,
+whichever child asks. The normalized key only selects cache entries; Venice
+still gets the child's own words on a miss.
+
+`python prompt_cache.py --top 20` lists the most popular requests;
+`--prewarm` runs one pass now, outside the window but within the budget.
+"""
+import argparse
+import atexit
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import metrics
+import settings
+
+STATS = metrics.CacheStats('prompt_cache')
+SEMANTIC_HITS = metrics.Counter('kk_prompt_cache_semantic_hits_total',
+                                'Prompt cache hits found through the normalized description')
+PREWARMED = metrics.Counter('kk_prompt_prewarm_total', 'Venice generations made by the pre-warmer', ['result'])
+
+# Venice calls whose image is fully determined by their (name-free) arguments
+CACHEABLE_METHODS = ('generate_image', 'text_to_image_for_kids')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    method TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_hit REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_results_last_hit ON results (last_hit);
+CREATE TABLE IF NOT EXISTS popularity (
+    key TEXT PRIMARY KEY,
+    method TEXT NOT NULL,
+    request TEXT NOT NULL,
+    score REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS aliases (
+    semantic_key TEXT PRIMARY KEY,
+    key TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS prewarm_state (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+# Entries expiring sooner than this are refreshed by the pre-warmer
+REFRESH_AHEAD = 86400
+
+# Popularity rows that decayed below this are forgotten
+FORGET_BELOW = 0.05
+
+TRIM_EVERY = 50
+
+# Buffered popularity bumps and hit times are written after this many seconds or distinct keys
+FLUSH_INTERVAL = 5
+FLUSH_EVERY = 200
+
+# Words that don't change what gets drawn
+STOP_WORDS = frozenset("""
+a an the some any this that these those my your his her our their its
+i me we you please can could would will want wanna like love see draw drawing
+make picture image photo illustration of just really so
+""".split())
+
+# Words that relate things to each other; their order matters
+RELATION_WORDS = frozenset("""
+in on at under over above below behind beside between near by with without from to into onto
+for through around across inside outside up down off out while who which is are was
+eating riding holding chasing playing flying swimming wearing
+eats rides holds chases plays flies swims wears has have
+""".split())
+
+IRREGULAR_PLURALS = {
+    'mice': 'mouse', 'geese': 'goose', 'children': 'child', 'teeth': 'tooth', 'feet': 'foot',
+    'people': 'person', 'men': 'man', 'women': 'woman', 'oxen': 'ox', 'wolves': 'wolf',
+    'elves': 'elf', 'leaves': 'leaf', 'knives': 'knife', 'calves': 'calf', 'puppies': 'puppy',
+    'dice': 'die', 'cacti': 'cactus', 'octopi': 'octopus'
+}
+
+# Singular words that merely end in s
+NOT_PLURAL = ('ss', 'us', 'is', 'os', 'ous')
+
+# Longest description a noun phrase can be (modifiers plus head)
+NOUN_PHRASE_WORDS = 4
+
+
+def singular(word):
+    """Crude singular form of an English noun; leaves short and non-plural words alone"""
+    if word in IRREGULAR_PLURALS:
+        return IRREGULAR_PLURALS[word]
+    if len(word) <= 3 or not word.endswith('s') or word.endswith(NOT_PLURAL):
+        return word
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith(('sses', 'xes', 'ches', 'shes', 'zes')):
+        return word[:-2]
+    return word[:-1]
+
+
+def _noun_phrase(words):
+    """Order-insensitive form of a simple noun phrase ("red big dragon" == "big red dragon"), else None"""
+    if not words or len(words) > NOUN_PHRASE_WORDS:
+        return None
+    if any(word in RELATION_WORDS or word.endswith('ing') for word in words):
+        return None
+    # The head noun stays last; its modifiers are sorted and de-duplicated
+    return sorted(set(words[:-1]) - {words[-1]}) + [words[-1]]
+
+
+def normalize_description(description):
+    """
+    Normalize a (safety-filtered) description for use as a cache key
+
+    Lower-cases, drops punctuation and stop words, singularizes, and puts
+    simple noun phrases, and "and"-lists of them, in a canonical order.
+    Anything with relation words keeps its order: "cat chasing a dog" and
+    "dog chasing a cat" stay different.
+
+    Args:
+        description (str): Output of the safety filter
+
+    Returns:
+        str: Normalized description
+    """
+    words = [singular(word) for word in re.findall(r"[a-z0-9]+", description.lower().replace("'", ''))
+             if word not in STOP_WORDS]
+    phrases, current = [], []
+    for word in words:
+        if word == 'and':
+            phrases.append(current)
+            current = []
+        else:
+            current.append(word)
+    phrases.append(current)
+    phrases = [phrase for phrase in phrases if phrase]
+
+    normalized = [_noun_phrase(phrase) for phrase in phrases]
+    if all(phrase is not None for phrase in normalized):
+        return ' and '.join(sorted(' '.join(phrase) for phrase in normalized))
+    return ' '.join(words)
+
+
+def request_key(method, request):
+    """Stable hash of a cacheable call's name-free arguments"""
+    encoded = json.dumps([method, request], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def parse_hours(spec):
+    """
+    Parse an off-peak window like "1-6" (local hours, end exclusive; may wrap midnight)
+
+    Raises:
+        ValueError: On a malformed window
+    """
+    try:
+        start, end = (int(part) for part in spec.split('-'))
+    except ValueError:
+        raise ValueError(f"Invalid hour window: {spec!r} (expected e.g. '1-6')")
+    if not (0 <= start < 24 and 0 <= end <= 24):
+        raise ValueError(f"Invalid hour window: {spec!r}")
+    return start, end
+
+
+def in_window(hour, window):
+    start, end = window
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+class PromptCache:
+    """Shared response cache, decaying popularity counters and the pre-warmer"""
+
+    def __init__(self, path, ttl=0, max_entries=2000, half_life=3 * 86400, daily_budget=0,
+                 hours='1-6', min_score=3, interval=600, semantic=False):
+        """
+        Args:
+            path (str): SQLite file shared by the workers
+            ttl (float): Seconds a response is reused; 0 disables the cache
+            max_entries (int): Responses kept, least recently hit evicted first
+            half_life (float): Seconds for a popularity score to halve
+            daily_budget (int): Pre-warm generations per day; 0 disables pre-warming
+            hours (str): Off-peak window for pre-warming, local hours
+            min_score (float): Decayed popularity a request needs to be pre-warmed
+            interval (float): Seconds between pre-warm runs
+            semantic (bool): Also look responses up by normalized description
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.half_life = half_life
+        self.daily_budget = daily_budget
+        self.window = parse_hours(hours)
+        self.min_score = min_score
+        self.interval = interval
+        self.semantic = semantic
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._schema_pid = None
+        self._pid = None
+        self._puts = 0
+        self._last_run = None
+        self._bumps = {}
+        self._hits = {}
+        self._buffer_pid = None
+        self._flushed_at = time.monotonic()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    @property
+    def prewarming(self):
+        return self.enabled and self.daily_budget > 0
+
+    def _decay(self, score, updated_at, now):
+        return score * 0.5 ** (max(0.0, now - updated_at) / self.half_life)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.create_function('decay', 3, self._decay, deterministic=True)
+            if self._schema_pid != os.getpid():
+                with connection:
+                    connection.executescript(SCHEMA)
+                self._schema_pid = os.getpid()
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def _ensure_started(self):
+        """Start the pre-warm thread once per process"""
+        if self._pid == os.getpid() or not self.prewarming:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._loop, name='prompt-prewarm', daemon=True).start()
+            self._pid = os.getpid()
+
+    def get(self, method, request, semantic_key=None):
+        """
+        Cached Venice response for a call, counting the request towards its popularity
+
+        Args:
+            method (str): One of CACHEABLE_METHODS
+            request (dict): The call's name-free arguments (see VeniceAPI.cached_result)
+            semantic_key (str): Normalized key (see semantic_key()) tried when the exact request misses
+
+        Returns:
+            dict: The response, or None on a miss (or with the cache off)
+        """
+        if not self.enabled:
+            return None
+        self._ensure_started()
+        key = request_key(method, request)
+        now = time.time()
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT key, result FROM results WHERE key = ? AND created_at >= ?', (key, now - self.ttl)).fetchone()
+        if row is None and semantic_key and self.semantic:
+            row = connection.execute(
+                'SELECT r.key, r.result FROM aliases a JOIN results r ON r.key = a.key '
+                'WHERE a.semantic_key = ? AND r.created_at >= ?', (semantic_key, now - self.ttl)).fetchone()
+            if row is not None:
+                SEMANTIC_HITS.inc()
+        self._bump(key, method, request, None if row is None else row['key'], now)
+        if row is None:
+            STATS.miss()
+            return None
+        STATS.hit()
+        return json.loads(row['result'])
+
+    def _bump(self, key, method, request, hit_key, now):
+        """Buffer a popularity bump (and hit time); written by flush()"""
+        with self._lock:
+            self._own_buffers()
+            bump = self._bumps.get(key)
+            if bump is None:
+                self._bumps[key] = [method, request, 1.0, now]
+            else:
+                bump[2] = self._decay(bump[2], bump[3], now) + 1
+                bump[3] = now
+            if hit_key is not None:
+                self._hits[hit_key] = now
+            due = (len(self._bumps) >= FLUSH_EVERY
+                   or time.monotonic() - self._flushed_at >= FLUSH_INTERVAL)
+        if due:
+            self.flush()
+
+    def _own_buffers(self):
+        # A forked child inherits buffered bumps that the parent will flush itself
+        if self._buffer_pid != os.getpid():
+            self._bumps, self._hits = {}, {}
+            self._buffer_pid = os.getpid()
+
+    def flush(self):
+        """Write this process's buffered popularity bumps and hit times in one transaction"""
+        with self._lock:
+            self._own_buffers()
+            bumps, self._bumps = self._bumps, {}
+            hits, self._hits = self._hits, {}
+            self._flushed_at = time.monotonic()
+        if not bumps and not hits:
+            return
+        connection = self._connection()
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT INTO popularity (key, method, request, score, updated_at) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET '
+                    'score = decay(score, updated_at, excluded.updated_at) + excluded.score, '
+                    'updated_at = excluded.updated_at',
+                    [(key, method, json.dumps(request, sort_keys=True), score, updated_at)
+                     for key, (method, request, score, updated_at) in bumps.items()])
+                connection.executemany('UPDATE results SET last_hit = MAX(last_hit, ?) WHERE key = ?',
+                                       [(hit_at, key) for key, hit_at in hits.items()])
+        except sqlite3.Error as e:
+            # Popularity is advisory; losing one interval's bumps is fine
+            print(f"Error writing prompt popularity: {str(e)}")
+
+    def put(self, method, request, result, semantic_key=None):
+        """Store a successful Venice response, also under its normalized key if given"""
+        if not self.enabled or not result.get('images'):
+            return
+        now = time.time()
+        key = request_key(method, request)
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO results (key, method, result, created_at, last_hit) VALUES (?, ?, ?, ?, ?)',
+                (key, method, json.dumps(result), now, now))
+            if semantic_key and self.semantic:
+                connection.execute('INSERT OR REPLACE INTO aliases (semantic_key, key) VALUES (?, ?)',
+                                   (semantic_key, key))
+        self._puts += 1
+        if self._puts % TRIM_EVERY == 0:
+            self.trim(now)
+
+    def trim(self, now=None):
+        """Drop expired responses and the least recently hit ones over max_entries"""
+        now = now or time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM results WHERE created_at < ?', (now - self.ttl,))
+            connection.execute(
+                'DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_hit DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,))
+            connection.execute('DELETE FROM popularity WHERE decay(score, updated_at, ?) < ?', (now, FORGET_BELOW))
+            connection.execute('DELETE FROM aliases WHERE key NOT IN (SELECT key FROM results)')
+
+    def semantic_key(self, method, request, **normalized):
+        """
+        Secondary key for a request with some fields normalized (e.g. description)
+
+        Returns:
+            str: The key, or None with semantic lookups off
+        """
+        if not (self.enabled and self.semantic):
+            return None
+        return request_key(method + ':normalized', dict(request, **normalized))
+
+    def popular(self, limit=20, now=None):
+        """Requests by decayed popularity, most popular first"""
+        now = now or time.time()
+        rows = self._connection().execute(
+            'SELECT p.key, p.method, p.request, decay(p.score, p.updated_at, ?) AS score, r.created_at AS cached_at '
+            'FROM popularity p LEFT JOIN results r ON r.key = p.key ORDER BY score DESC LIMIT ?',
+            (now, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def _state(self, key):
+        row = self._connection().execute('SELECT value FROM prewarm_state WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else 0
+
+    def _claim(self, key, limit, amount=1):
+        """Atomically add `amount` to a counter in prewarm_state unless that passes `limit`"""
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR IGNORE INTO prewarm_state (key, value) VALUES (?, 0)', (key,))
+            return connection.execute(
+                'UPDATE prewarm_state SET value = value + ? WHERE key = ? AND value + ? <= ?',
+                (amount, key, amount, limit)).rowcount == 1
+
+    def _claim_run(self, now):
+        """True if this process gets to run the pre-warm pass for this interval"""
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR IGNORE INTO prewarm_state (key, value) VALUES (?, 0)', ('last_run',))
+            claimed = connection.execute(
+                'UPDATE prewarm_state SET value = ? WHERE key = ? AND value <= ?',
+                (now, 'last_run', now - self.interval * 0.9)).rowcount
+        return claimed == 1
+
+    @staticmethod
+    def _budget_key(now):
+        return 'spent:' + time.strftime('%Y-%m-%d', time.localtime(now))
+
+    def spent_today(self, now=None):
+        return int(self._state(self._budget_key(now or time.time())))
+
+    def prewarm(self, now=None, call=None):
+        """
+        Regenerate popular requests whose responses are missing or about to expire
+
+        Args:
+            now (float): Current time
+            call (callable): call(method, request) -> Venice response; defaults to VeniceAPI
+
+        Returns:
+            dict: generated, failed and skipped counts, and why the pass stopped
+        """
+        import scheduler
+
+        now = now or time.time()
+        if call is None:
+            from venice_api import VeniceAPI
+            client = VeniceAPI()
+            call = client.generate_for_request
+
+        report = {'generated': 0, 'failed': 0, 'fresh': 0, 'stopped': 'done'}
+        self.flush()
+        self.trim(now)
+        refresh_before = now - self.ttl + min(REFRESH_AHEAD, self.ttl / 2)
+        budget_key = self._budget_key(now)
+        remaining = self.daily_budget - self.spent_today(now)
+        # A few extra candidates cover the ones that turn out to be fresh
+        for candidate in self.popular(limit=max(0, remaining) * 4 + 10, now=now):
+            if candidate['score'] < self.min_score:
+                break
+            if candidate['cached_at'] is not None and candidate['cached_at'] > refresh_before:
+                report['fresh'] += 1
+                continue
+            if not self._claim(budget_key, self.daily_budget):
+                report['stopped'] = 'budget'
+                break
+            request = json.loads(candidate['request'])
+            try:
+                with scheduler.SCHEDULER.slot('prewarm', 'batch', enforce_quota=False) as lease:
+                    result = call(candidate['method'], request)
+            except scheduler.OverQuota:
+                # No batch capacity; the generation wasn't made, so give the budget back
+                self._claim(budget_key, self.daily_budget, amount=-1)
+                report['stopped'] = 'busy'
+                break
+            except Exception as e:
+                PREWARMED.inc(result='failed')
+                report['failed'] += 1
+                report['stopped'] = 'error'
+                print(f"Pre-warming {candidate['method']} failed: {str(e)}")
+                break
+            self.put(candidate['method'], request, result)
+            PREWARMED.inc(result='generated')
+            report['generated'] += 1
+            if lease is not None and lease.preempted:
+                report['stopped'] = 'preempted'
+                break
+        return report
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                now = time.time()
+                if not in_window(time.localtime(now).tm_hour, self.window):
+                    continue
+                if self.spent_today(now) >= self.daily_budget or not self._claim_run(now):
+                    continue
+                report = self.prewarm(now)
+                self._last_run = now
+                if report['generated'] or report['failed']:
+                    print(f"Pre-warmed {report['generated']} prompts "
+                          f"({report['failed']} failed, stopped: {report['stopped']})")
+            except Exception as e:
+                print(f"Pre-warm run failed: {str(e)}")
+
+    def snapshot(self):
+        """Cache and pre-warm state for /api/status"""
+        state = {'enabled': self.enabled, 'ttl': self.ttl, 'semantic': self.semantic}
+        if self.enabled:
+            state['entries'] = self._connection().execute('SELECT COUNT(*) FROM results').fetchone()[0]
+            state['prewarm'] = {
+                'enabled': self.prewarming,
+                'window': '%d-%d' % self.window,
+                'daily_budget': self.daily_budget,
+                'spent_today': self.spent_today(),
+                'last_run': self._last_run
+            }
+        return state
+
+
+CACHE = PromptCache(
+    settings.PROMPT_CACHE_DB_PATH,
+    ttl=settings.PROMPT_CACHE_TTL,
+    max_entries=settings.PROMPT_CACHE_MAX_ENTRIES,
+    half_life=settings.PROMPT_POPULARITY_HALF_LIFE,
+    daily_budget=settings.PREWARM_DAILY_BUDGET,
+    hours=settings.PREWARM_HOURS,
+    min_score=settings.PREWARM_MIN_SCORE,
+    interval=settings.PREWARM_INTERVAL,
+    semantic=settings.PROMPT_CACHE_SEMANTIC
+)
+metrics.register_status_provider('prompt_cache', CACHE.snapshot)
+
+
+@atexit.register
+def _flush_on_exit():
+    # Don't lose the last interval's popularity when the process exits normally
+    if CACHE.enabled:
+        CACHE.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and pre-warm the prompt result cache")
+    parser.add_argument('--top', type=int, metavar='N', help="List the N most popular requests")
+    parser.add_argument('--prewarm', action='store_true', help="Run one pre-warm pass now (within the daily budget)")
+    args = parser.parse_args(argv)
+
+    if not CACHE.enabled:
+        print("Prompt cache is off; set PROMPT_CACHE_TTL")
+        return 1
+    if args.top:
+        for entry in CACHE.popular(limit=args.top):
+            request = json.loads(entry['request'])
+            state = 'cached' if entry['cached_at'] else 'not cached'
+            subject = request.get('animal') or request.get('description', '')
+            print(f"{entry['score']:8.2f}  {entry['method']:<24} {state:<10} {request['style']:<14} {subject[:60]}")
+    if args.prewarm:
+        if not CACHE.prewarming:
+            print("Pre-warming is off; set PREWARM_DAILY_BUDGET")
+            return 1
+        report = CACHE.prewarm()
+        print(f"Generated {report['generated']}, failed {report['failed']}, already fresh {report['fresh']} "
+              f"(stopped: {report['stopped']}; {CACHE.spent_today()}/{CACHE.daily_budget} spent today)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,263 @@
+"""
+Collection-wide rarity engine
+
+Rarity is statistical: each minted image contributes its categorical trait
+values (RARITY_TRAITS) to per-value frequency counters, and an image's rarity
+score is the information content of its traits, sum(-log2(count / total)),
+so rare values weigh more as the collection grows.
+
+Recording a mint is O(1): bump a handful of counters and the count of the
+image's trait combination. Images that share a combination always share a
+score, so ranks are computed over the distinct combinations (bounded by the
+product of the trait vocabularies, a few thousand) rather than by rescanning
+every image in the library.
+
+Mints are appended to a JSON-lines log (RARITY_LOG_PATH). Each process
+replays it on first use and tails it before every query, so all workers see
+the same collection.
+"""
+import json
+import math
+import os
+import threading
+from collections import Counter
+
+import settings
+
+# (trait type, path into the trait document)
+RARITY_TRAITS = [
+    ("magical_power", ("nft_traits", "magical_power")),
+    ("special_ability", ("nft_traits", "special_ability")),
+    ("brightness", ("color_properties", "brightness")),
+    ("color_diversity", ("color_properties", "color_diversity")),
+    ("primary_color", ("color_properties", "dominant_colors", 0)),
+]
+
+# Rarest fraction of the collection that lands in each tier, checked in order
+TIERS = [
+    ("legendary", 0.01),
+    ("epic", 0.05),
+    ("rare", 0.15),
+    ("uncommon", 0.40),
+    ("common", 1.0),
+]
+
+
+def trait_values(trait_document):
+    """
+    Extract the categorical values the engine counts
+
+    Args:
+        trait_document (dict): Trait document from traits.py
+
+    Returns:
+        tuple: One value per RARITY_TRAITS entry ("none" when missing)
+    """
+    values = []
+    for _, path in RARITY_TRAITS:
+        value = trait_document
+        for key in path:
+            try:
+                value = value[key]
+            except (KeyError, IndexError, TypeError):
+                value = "none"
+                break
+        values.append(str(value))
+    return tuple(values)
+
+
+def tier_for(percentile):
+    """Rarity tier for a rank percentile (0 = rarest, 1 = most common)"""
+    for tier, cutoff in TIERS:
+        if percentile <= cutoff:
+            return tier
+    return TIERS[-1][0]
+
+
+class RarityEngine:
+    """Incremental trait frequency tables with combination-level ranking"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.total = 0
+        self._counters = [Counter() for _ in RARITY_TRAITS]
+        self._combinations = Counter()
+        self._images = {}
+        self._offset = 0
+        self._lock = threading.Lock()
+        self._ranking = None
+        if path:
+            self.refresh()
+
+    def _count(self, digest, combination):
+        self._images[digest] = combination
+        self._combinations[combination] += 1
+        for counter, value in zip(self._counters, combination):
+            counter[value] += 1
+        self.total += 1
+        self._ranking = None
+
+    def refresh(self):
+        """Replay log lines appended since the last read"""
+        if not self.path:
+            return
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        with self._lock:
+            if size <= self._offset:
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read(size - self._offset)
+            # Leave a partially written last line for the next refresh
+            data = data[:data.rfind(b'\n') + 1]
+            for line in data.splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry['content_hash'] not in self._images:
+                    self._count(entry['content_hash'], tuple(entry['traits']))
+            self._offset += len(data)
+
+    def record(self, digest, trait_document):
+        """
+        Count a minted image (no-op if it was already counted)
+
+        Args:
+            digest (str): Content hash of the image
+            trait_document (dict): Its trait document
+        """
+        combination = trait_values(trait_document)
+        self.refresh()
+        with self._lock:
+            if digest in self._images:
+                return
+            self._count(digest, combination)
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps({'content_hash': digest, 'traits': list(combination)}) + '\n')
+
+    def _weights(self):
+        """Information content of every trait value at the current counts"""
+        log_total = math.log2(self.total)
+        return [{value: log_total - math.log2(count) for value, count in counter.items()}
+                for counter in self._counters]
+
+    @staticmethod
+    def _score(weights, combination):
+        return sum(weight[value] for weight, value in zip(weights, combination))
+
+    def _ranked(self):
+        """
+        Rank the distinct combinations, rarest first; cached until the next mint
+
+        Returns:
+            list: (score, images with this combination, rank, combination); equal scores share a rank
+        """
+        if self.total == 0:
+            return []
+        if self._ranking is None:
+            weights = self._weights()
+            scored = sorted(((self._score(weights, combination), count, combination)
+                             for combination, count in self._combinations.items()), reverse=True)
+            ranking, seen, rank, previous = [], 0, 1, None
+            for score, count, combination in scored:
+                if score != previous:
+                    rank, previous = seen + 1, score
+                ranking.append((score, count, rank, combination))
+                seen += count
+            self._ranking = ranking
+        return self._ranking
+
+    def rarity_of(self, digest):
+        """
+        Current rarity of a counted image
+
+        Args:
+            digest (str): Content hash of the image
+
+        Returns:
+            dict: score, rank (1 = rarest; ties share a rank), percentile, tier and
+            collection_size, or None if the image hasn't been counted
+        """
+        self.refresh()
+        with self._lock:
+            combination = self._images.get(digest)
+            if combination is None:
+                return None
+            weights = self._weights()
+            score = self._score(weights, combination)
+            if self._ranking is not None:
+                rank = next(rank for ranked_score, _, rank, _ in self._ranking if ranked_score <= score)
+            else:
+                # One pass over the combinations beats sorting them when nothing is cached
+                rank = 1 + sum(count for other, count in self._combinations.items()
+                               if self._score(weights, other) > score)
+            total = self.total
+        percentile = rank / total
+        return {
+            'score': round(score, 3),
+            'rank': rank,
+            'percentile': round(percentile, 4),
+            'tier': tier_for(percentile),
+            'collection_size': total
+        }
+
+    def stats(self, top=10):
+        """
+        Collection statistics for the /api/collection/stats endpoint
+
+        Args:
+            top (int): Number of rarest trait combinations to list
+
+        Returns:
+            dict: Totals, per-trait value frequencies, tier sizes and the rarest combinations
+        """
+        self.refresh()
+        with self._lock:
+            total = self.total
+            traits = {}
+            for (trait_type, _), counter in zip(RARITY_TRAITS, self._counters):
+                traits[trait_type] = {
+                    value: {'count': count, 'share': round(count / total, 4)}
+                    for value, count in counter.most_common()
+                }
+
+            ranking = self._ranked()
+            tiers = {tier: 0 for tier, _ in TIERS}
+            for _, count, rank, _ in ranking:
+                tiers[tier_for(rank / total)] += count
+            rarest = ranking[:top]
+            distinct = len(ranking)
+
+        trait_names = [trait_type for trait_type, _ in RARITY_TRAITS]
+        return {
+            'total': total,
+            'distinct_combinations': distinct,
+            'traits': traits,
+            'tiers': tiers,
+            'rarest_combinations': [
+                {'traits': dict(zip(trait_names, combination)), 'score': round(score, 3), 'count': count}
+                for score, count, _, combination in rarest
+            ]
+        }
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the process-wide engine backed by RARITY_LOG_PATH"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                directory = os.path.dirname(settings.RARITY_LOG_PATH)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                _engine = RarityEngine(settings.RARITY_LOG_PATH)
+    return _engine
@@ -0,0 +1,481 @@
+"""
+Fair scheduling of upstream Venice capacity across holdjarIDs
+
+Every Venice generation call runs inside a scheduler slot. At most
+SCHEDULER_CONCURRENCY calls run at once per process; when they are all busy,
+callers wait in a weighted fair queue keyed by holdjarID:
+
+- each request gets a virtual finish tag max(V, identity's last tag) + 1/weight
+  (start-time fair queuing), and free slots go to the smallest tag, so a
+  wallet with fifty requests queued is interleaved with, not ahead of, a
+  child asking for one
+- no identity runs more than SCHEDULER_PER_IDENTITY calls at once or queues
+  more than SCHEDULER_MAX_QUEUED
+- SCHEDULER_QUOTAS sets sliding-window quotas per identity, e.g.
+  "10/60,100/3600" for 10 a minute and 100 an hour
+
+Requests over their share are rejected straight away with OverQuota, whose
+retry_after says when a retry can succeed: exactly when the oldest request
+leaves the quota window, or an estimate from the recent service time when
+the identity's queue is full. Views turn it into a 429 with Retry-After.
+
+Work is split into two lanes, each with its own fair queue:
+
+    interactive   requests from the web pages (the default)
+    batch         bulk scripts, pre-warming and re-renders; views put a request
+                  here with the `X-Priority: batch` header
+
+Batch work is guaranteed SCHEDULER_BATCH_SHARE of the slots while it has
+work queued, and otherwise only runs on idle capacity. Slots it borrows
+beyond that share are preemptible: when an interactive request finds every
+slot busy, the newest borrowed batch slot is handed to it immediately. The
+preempted call still finishes (an HTTP call to Venice can't be taken back),
+so the upstream briefly sees one extra call; its lease is flagged
+`preempted` so multi-step batch work can stop early and requeue.
+
+Limits apply per worker process, like the Venice connection pool they guard.
+"""
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import metrics
+import settings
+
+REJECTIONS = metrics.Counter('kk_scheduler_rejections_total', 'Requests turned away by the scheduler', ['reason'])
+WAIT = metrics.Histogram('kk_scheduler_wait_seconds', 'Time spent queued for an upstream slot', ['lane'])
+PREEMPTIONS = metrics.Counter('kk_scheduler_preemptions_total', 'Borrowed batch slots handed to interactive requests')
+
+LANES = ('interactive', 'batch')
+
+# Idle identity state is swept after this many admissions
+SWEEP_EVERY = 1024
+
+
+class OverQuota(RuntimeError):
+    """Raised when a request can't be admitted; retry_after is in seconds"""
+
+    def __init__(self, message, retry_after, reason):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+    @property
+    def status_code(self):
+        # Over the caller's own share is the caller's problem; a full server is ours
+        return 503 if self.reason in ('busy', 'timeout') else 429
+
+
+def parse_quotas(spec):
+    """
+    Parse a quota spec like "10/60,100/3600"
+
+    Returns:
+        list: (limit, window_seconds) tuples
+
+    Raises:
+        ValueError: On a malformed spec
+    """
+    quotas = []
+    for part in filter(None, (part.strip() for part in (spec or '').split(','))):
+        limit, window = part.split('/')
+        quotas.append((int(limit), float(window)))
+    return quotas
+
+
+def parse_weights(spec):
+    """Parse identity weights like "0xabc:2,0xdef:0.5" into a dict"""
+    weights = {}
+    for part in filter(None, (part.strip() for part in (spec or '').split(','))):
+        identity, weight = part.rsplit(':', 1)
+        weights[identity.strip()] = float(weight)
+    return weights
+
+
+class _Identity:
+    """Scheduling state of one holdjarID"""
+
+    __slots__ = ('active', 'queued', 'last_finish', 'admitted')
+
+    def __init__(self):
+        self.active = 0
+        self.queued = {lane: 0 for lane in LANES}
+        self.last_finish = {lane: 0.0 for lane in LANES}
+        self.admitted = deque()
+
+
+class Lease:
+    """
+    One request's place in the queue, then its upstream slot
+
+    Woken through an Event (threads) or a Future (asyncio). Batch leases
+    holding a borrowed slot may be preempted; check `preempted` between
+    steps of long batch work.
+    """
+
+    __slots__ = ('identity', 'lane', 'start', 'finish', 'granted', 'cancelled', 'borrowed', 'preempted',
+                 'enqueued', '_event', '_loop', '_future')
+
+    def __init__(self, identity, lane, start, finish, loop=None):
+        self.identity = identity
+        self.lane = lane
+        self.start = start
+        self.finish = finish
+        self.granted = False
+        self.cancelled = False
+        self.borrowed = False
+        self.preempted = False
+        self.enqueued = time.monotonic()
+        self._loop = loop
+        self._future = loop.create_future() if loop else None
+        self._event = None if loop else threading.Event()
+
+    def grant(self):
+        self.granted = True
+        if self._future is not None:
+            self._loop.call_soon_threadsafe(_resolve, self._future)
+        else:
+            self._event.set()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(True)
+
+
+class FairScheduler:
+    """Weighted fair queues per lane in front of a fixed number of upstream slots"""
+
+    def __init__(self, capacity, per_identity=2, max_queued=4, max_total_queued=256,
+                 quotas=(), weights=None, queue_timeout=60, batch_share=0.25,
+                 batch_max_queued=64, batch_queue_timeout=600):
+        """
+        Args:
+            capacity (int): Upstream calls allowed at once; 0 disables scheduling
+            per_identity (int): Concurrent calls allowed per identity
+            max_queued (int): Interactive requests one identity may have waiting
+            max_total_queued (int): Requests waiting across all identities and lanes
+            quotas (list): (limit, window_seconds) sliding-window quotas per identity
+            weights (dict): Share weights per identity (default 1)
+            queue_timeout (float): Seconds an interactive request may wait for a slot
+            batch_share (float): Fraction of the slots reserved for batch work with work queued
+            batch_max_queued (int): Batch requests one identity may have waiting
+            batch_queue_timeout (float): Seconds a batch request may wait for a slot
+        """
+        self.capacity = capacity
+        self.per_identity = per_identity
+        self.max_queued = {'interactive': max_queued, 'batch': batch_max_queued}
+        self.max_total_queued = max_total_queued
+        self.quotas = sorted(quotas, key=lambda quota: quota[1])
+        self.weights = weights or {}
+        self.queue_timeout = {'interactive': queue_timeout, 'batch': batch_queue_timeout}
+        self.batch_reserved = int(capacity * batch_share)
+        self._identities = {}
+        self._heaps = {lane: [] for lane in LANES}
+        self._virtual = {lane: 0.0 for lane in LANES}
+        self._lane_active = {lane: 0 for lane in LANES}
+        self._lane_queued = {lane: 0 for lane in LANES}
+        self._borrowed = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._admissions = 0
+        self._service_time = 10.0  # EWMA of slot hold time; Venice calls take ~10s
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def _check_quotas(self, state, now):
+        """Raise OverQuota if another admission would exceed a window (lock held)"""
+        if not self.quotas:
+            return
+        longest = self.quotas[-1][1]
+        while state.admitted and state.admitted[0] <= now - longest:
+            state.admitted.popleft()
+        retry_after = 0.0
+        for limit, window in self.quotas:
+            in_window = [at for at in state.admitted if at > now - window]
+            if len(in_window) >= limit:
+                # The window has room again once the limit-th newest admission ages out
+                frees_at = in_window[-limit] + window if limit > 0 else now + window
+                retry_after = max(retry_after, frees_at - now)
+        if retry_after:
+            REJECTIONS.inc(reason='quota')
+            raise OverQuota("Generation quota reached for this holdjarID", retry_after, 'quota')
+
+    def _queue_estimate(self, queued_ahead):
+        """Seconds until a request behind queued_ahead others gets a slot"""
+        return self._service_time * math.ceil((queued_ahead + 1) / max(self.per_identity, 1))
+
+    def _admit(self, identity, lane, enforce_quota, loop=None):
+        """Queue a request and dispatch what fits (takes the lock)"""
+        if lane not in LANES:
+            raise ValueError(f"Unknown scheduler lane: {lane}")
+        now = time.time()
+        with self._lock:
+            self._admissions += 1
+            if self._admissions % SWEEP_EVERY == 0:
+                self._sweep(now)
+            state = self._identities.get(identity)
+            if state is None:
+                state = self._identities[identity] = _Identity()
+
+            if enforce_quota:
+                self._check_quotas(state, now)
+            if state.queued[lane] >= self.max_queued[lane]:
+                REJECTIONS.inc(reason='share')
+                raise OverQuota("Too many generations queued for this holdjarID",
+                                self._queue_estimate(state.queued[lane] + state.active), 'share')
+            if sum(self._lane_queued.values()) >= self.max_total_queued:
+                REJECTIONS.inc(reason='busy')
+                raise OverQuota("The image generator is busy", self._service_time, 'busy')
+
+            if self.quotas and enforce_quota:
+                state.admitted.append(now)
+            start = max(self._virtual[lane], state.last_finish[lane])
+            finish = start + 1.0 / self.weights.get(identity, 1.0)
+            state.last_finish[lane] = finish
+            lease = Lease(identity, lane, start, finish, loop)
+            heapq.heappush(self._heaps[lane], (finish, next(self._sequence), lease))
+            state.queued[lane] += 1
+            self._lane_queued[lane] += 1
+            self._dispatch()
+        return lease
+
+    def _pop(self, lane):
+        """Smallest finish tag in a lane whose identity is under its cap, or None (lock held)"""
+        heap, blocked, found = self._heaps[lane], [], None
+        while heap:
+            entry = heapq.heappop(heap)
+            lease = entry[2]
+            if lease.cancelled:
+                continue
+            if self._identities[lease.identity].active >= self.per_identity:
+                blocked.append(entry)
+                continue
+            found = lease
+            break
+        for entry in blocked:
+            heapq.heappush(heap, entry)
+        return found
+
+    def _grant(self, lease):
+        state = self._identities[lease.identity]
+        state.queued[lease.lane] -= 1
+        state.active += 1
+        self._lane_queued[lease.lane] -= 1
+        self._lane_active[lease.lane] += 1
+        self._active += 1
+        self._virtual[lease.lane] = max(self._virtual[lease.lane], lease.start)
+        WAIT.observe(time.monotonic() - lease.enqueued, lane=lease.lane)
+        lease.grant()
+
+    def _batch_shortfall(self):
+        """Free slots batch work needs to reach its reservation (lock held)"""
+        demand = self._lane_active['batch'] + self._lane_queued['batch']
+        return max(0, min(self.batch_reserved, demand) - self._lane_active['batch'])
+
+    def _preempt(self):
+        """Hand the newest borrowed batch slot over to an interactive request (lock held)"""
+        lease = self._borrowed.pop()
+        lease.preempted = True
+        self._lane_active['batch'] -= 1
+        self._active -= 1
+        PREEMPTIONS.inc()
+
+    def _dispatch(self):
+        """Grant free slots: interactive first, batch up to its reservation or on idle capacity (lock held)"""
+        while True:
+            free = self.capacity - self._active
+            if free <= 0 and not self._borrowed:
+                return
+            tried_interactive = False
+            if free > self._batch_shortfall() or free <= 0:
+                tried_interactive = True
+                lease = self._pop('interactive')
+                if lease is not None:
+                    if free <= 0:
+                        self._preempt()
+                    self._grant(lease)
+                    continue
+            if free <= 0:
+                return
+            lease = self._pop('batch')
+            if lease is not None:
+                if self._lane_active['batch'] >= self.batch_reserved:
+                    lease.borrowed = True
+                    self._borrowed.append(lease)
+                self._grant(lease)
+                continue
+            # Batch is short of its reservation but can't use the slot (identity caps)
+            if not tried_interactive:
+                lease = self._pop('interactive')
+                if lease is not None:
+                    self._grant(lease)
+                    continue
+            return
+
+    def _abandon(self, lease):
+        """
+        Withdraw a lease that timed out or was cancelled (takes the lock)
+
+        Returns:
+            bool: True if it was granted meanwhile and now holds a slot
+        """
+        with self._lock:
+            if lease.granted:
+                return True
+            lease.cancelled = True
+            self._identities[lease.identity].queued[lease.lane] -= 1
+            self._lane_queued[lease.lane] -= 1
+        return False
+
+    def _release(self, lease, held):
+        with self._lock:
+            self._service_time = 0.8 * self._service_time + 0.2 * held
+            self._identities[lease.identity].active -= 1
+            if not lease.preempted:
+                # A preempted lease already gave its slot away
+                self._lane_active[lease.lane] -= 1
+                self._active -= 1
+                if lease.borrowed:
+                    self._borrowed.remove(lease)
+            # Borrowed slots that now fit inside the batch reservation are no longer preemptible
+            while self._borrowed and self._lane_active['batch'] - len(self._borrowed) < self.batch_reserved:
+                self._borrowed.pop(0).borrowed = False
+            self._dispatch()
+
+    def _sweep(self, now):
+        """Forget identities with nothing running, queued or inside a quota window (lock held)"""
+        longest = self.quotas[-1][1] if self.quotas else 0
+        for identity, state in list(self._identities.items()):
+            if state.active or any(state.queued.values()):
+                continue
+            if state.admitted and state.admitted[-1] > now - longest:
+                continue
+            del self._identities[identity]
+
+    def _timed_out(self):
+        REJECTIONS.inc(reason='timeout')
+        return OverQuota("Timed out waiting for the image generator", self._service_time, 'timeout')
+
+    @contextmanager
+    def slot(self, identity, lane='interactive', enforce_quota=True):
+        """
+        Hold one upstream slot for the wrapped block
+
+        Args:
+            identity (str): holdjarID (or another key) the call counts against
+            lane (str): 'interactive' or 'batch'
+            enforce_quota (bool): Apply the sliding-window quotas; internal batch work opts out
+
+        Yields:
+            Lease: The slot; batch callers can check `preempted`
+
+        Raises:
+            OverQuota: If the identity is over its share or quota, or no slot frees up in time
+        """
+        if not self.enabled:
+            yield None
+            return
+        lease = self._admit(identity, lane, enforce_quota)
+        if not lease.granted:
+            try:
+                granted = lease._event.wait(self.queue_timeout[lane])
+            except BaseException:
+                # Interrupted (KeyboardInterrupt, gevent.Timeout, ...): don't leave the lease queued or holding a slot
+                if self._abandon(lease):
+                    self._release(lease, 0)
+                raise
+            if not granted and not self._abandon(lease):
+                raise self._timed_out()
+        started = time.monotonic()
+        try:
+            yield lease
+        finally:
+            self._release(lease, time.monotonic() - started)
+
+    @asynccontextmanager
+    async def aslot(self, identity, lane='interactive', enforce_quota=True):
+        """Async version of slot() for the async views"""
+        if not self.enabled:
+            yield None
+            return
+        import asyncio
+        lease = self._admit(identity, lane, enforce_quota, loop=asyncio.get_running_loop())
+        if not lease.granted:
+            try:
+                await asyncio.wait_for(asyncio.shield(lease._future), self.queue_timeout[lane])
+            except asyncio.TimeoutError:
+                if not self._abandon(lease):
+                    raise self._timed_out()
+            except BaseException:
+                # Cancelled (client went away) or otherwise interrupted
+                if self._abandon(lease):
+                    self._release(lease, 0)
+                raise
+        started = time.monotonic()
+        try:
+            yield lease
+        finally:
+            self._release(lease, time.monotonic() - started)
+
+    def snapshot(self):
+        """Queue state for /api/status"""
+        with self._lock:
+            busiest = sorted(self._identities.items(),
+                             key=lambda item: -(item[1].active + sum(item[1].queued.values())))[:5]
+            return {
+                'enabled': self.enabled,
+                'capacity': self.capacity,
+                'active': self._active,
+                'queued': sum(self._lane_queued.values()),
+                'lanes': {
+                    lane: {
+                        'active': self._lane_active[lane],
+                        'queued': self._lane_queued[lane],
+                        'reserved': self.batch_reserved if lane == 'batch' else self.capacity - self.batch_reserved
+                    }
+                    for lane in LANES
+                },
+                'borrowed_batch_slots': len(self._borrowed),
+                'preemptions': PREEMPTIONS.value(),
+                'identities': len(self._identities),
+                'service_time_seconds': round(self._service_time, 3),
+                'busiest': [
+                    {'holdjarID': identity, 'active': state.active, 'queued': sum(state.queued.values())}
+                    for identity, state in busiest if state.active or any(state.queued.values())
+                ],
+                'rejected': {reason: REJECTIONS.value(reason=reason)
+                             for reason in ('quota', 'share', 'busy', 'timeout')}
+            }
+
+
+SCHEDULER = FairScheduler(
+    capacity=settings.SCHEDULER_CONCURRENCY,
+    per_identity=settings.SCHEDULER_PER_IDENTITY,
+    max_queued=settings.SCHEDULER_MAX_QUEUED,
+    max_total_queued=settings.SCHEDULER_MAX_TOTAL_QUEUED,
+    quotas=parse_quotas(settings.SCHEDULER_QUOTAS),
+    weights=parse_weights(settings.SCHEDULER_WEIGHTS),
+    queue_timeout=settings.SCHEDULER_QUEUE_TIMEOUT,
+    batch_share=settings.SCHEDULER_BATCH_SHARE,
+    batch_max_queued=settings.SCHEDULER_BATCH_MAX_QUEUED,
+    batch_queue_timeout=settings.SCHEDULER_BATCH_QUEUE_TIMEOUT
+)
+metrics.register_status_provider('scheduler', SCHEDULER.snapshot)
+
+
+def retry_after_header(error):
+    """Retry-After value (whole seconds, at least 1) for an OverQuota"""
+    return str(max(1, math.ceil(error.retry_after)))
+
+
+def request_lane(headers):
+    """Lane named by a request's X-Priority header; anything but 'batch' is interactive"""
+    return 'batch' if headers.get('X-Priority', '').strip().lower() == 'batch' else 'interactive'
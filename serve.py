@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Production launcher for the KryptoKids API
+
+Runs the app under gunicorn with the settings from gunicorn.conf.py.
+Command line flags override the matching environment variables.
+
+Examples:
+    python serve.py                                   # threaded workers
+    python serve.py --worker-model sync --workers 4
+    python serve.py --worker-model gevent --worker-connections 500
+
+Send SIGTERM for a graceful shutdown: workers stop accepting new connections
+and in-flight generations get GRACEFUL_TIMEOUT seconds to finish.
+"""
+import argparse
+import os
+import sys
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run the KryptoKids API with gunicorn")
+    parser.add_argument('--worker-model', choices=['sync', 'threaded', 'gevent'],
+                        help="Worker model (env: WORKER_MODEL)")
+    parser.add_argument('--workers', type=int, help="Worker processes (env: WEB_CONCURRENCY)")
+    parser.add_argument('--threads', type=int, help="Threads per worker (env: WORKER_THREADS)")
+    parser.add_argument('--worker-connections', type=int,
+                        help="Greenlets per gevent worker (env: WORKER_CONNECTIONS)")
+    parser.add_argument('--bind', help="Address to bind, e.g. 0.0.0.0:5001 (env: BIND)")
+    parser.add_argument('--timeout', type=int, help="Worker timeout in seconds (env: WORKER_TIMEOUT)")
+    parser.add_argument('--graceful-timeout', type=int,
+                        help="Seconds to drain on shutdown (env: GRACEFUL_TIMEOUT)")
+    parser.add_argument('--no-preload', action='store_true', help="Import the app in each worker")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    
+    overrides = {
+        'WORKER_MODEL': args.worker_model,
+        'WEB_CONCURRENCY': args.workers,
+        'WORKER_THREADS': args.threads,
+        'WORKER_CONNECTIONS': args.worker_connections,
+        'BIND': args.bind,
+        'WORKER_TIMEOUT': args.timeout,
+        'GRACEFUL_TIMEOUT': args.graceful_timeout,
+    }
+    for name, value in overrides.items():
+        if value is not None:
+            os.environ[name] = str(value)
+    if args.no_preload:
+        os.environ['PRELOAD_APP'] = 'false'
+    
+    try:
+        from gunicorn.app.wsgiapp import run
+    except ImportError:
+        print("gunicorn is not installed. Run: pip install -r requirements.txt")
+        return 1
+    
+    sys.argv = ['gunicorn', '-c', CONFIG_PATH, 'wsgi:app']
+    return run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
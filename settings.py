@@ -0,0 +1,123 @@
+"""
+Process-wide configuration for the KryptoKids API
+
+The .env file is read exactly once, here. Every other module imports its
+settings from this module instead of calling load_dotenv() itself.
+"""
+import os
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+
+def env_bool(name, default=False):
+    """Read a boolean flag from the environment"""
+    return os.environ.get(name, str(default)).lower() in ('1', 'true', 'yes')
+
+
+# Get API key from environment variables
+VENICE_API_KEY = os.getenv('VENICE_API_KEY')
+
+PORT = int(os.environ.get('PORT', 5001))
+ASYNC_HANDLERS = env_bool('ASYNC_HANDLERS')
+
+# Per-request profiling (see profiling.py)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sample').lower()
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+# Upstream Venice connection handling
+VENICE_POOL_SIZE = int(os.environ.get('VENICE_POOL_SIZE', 16))
+VENICE_CIRCUIT_FAILURES = int(os.environ.get('VENICE_CIRCUIT_FAILURES', 5))
+VENICE_CIRCUIT_RESET_SECONDS = float(os.environ.get('VENICE_CIRCUIT_RESET_SECONDS', 30))
+
+# Memoized trait documents kept per process (see traits.py)
+TRAIT_CACHE_SIZE = int(os.environ.get('TRAIT_CACHE_SIZE', 1024))
+
+# Perceptual-hash near-duplicate index (see phash.py)
+PHASH_INDEX_PATH = os.environ.get('PHASH_INDEX_PATH', os.path.join('data', 'phash_index.bin'))
+DUPLICATE_POLICY = os.environ.get('DUPLICATE_POLICY', 'flag').lower()  # off, flag or reject
+DUPLICATE_DISTANCE = int(os.environ.get('DUPLICATE_DISTANCE', 6))
+
+# Collection-wide rarity (see rarity.py)
+RARITY_LOG_PATH = os.environ.get('RARITY_LOG_PATH', os.path.join('data', 'rarity_log.jsonl'))
+RARITY_MIN_COLLECTION = int(os.environ.get('RARITY_MIN_COLLECTION', 100))
+
+# Post-response background work (see tasks.py)
+DEFER_POST_PROCESSING = env_bool('DEFER_POST_PROCESSING')
+BACKGROUND_WORKERS = int(os.environ.get('BACKGROUND_WORKERS', 4))
+BACKGROUND_MAX_PENDING = int(os.environ.get('BACKGROUND_MAX_PENDING', 64))
+BACKGROUND_RESULT_TTL = float(os.environ.get('BACKGROUND_RESULT_TTL', 900))
+BACKGROUND_RESULT_DIR = os.environ.get('BACKGROUND_RESULT_DIR', os.path.join('data', 'tasks'))
+
+# SQLite metadata store (see metadata_store.py)
+METADATA_DB_PATH = os.environ.get('METADATA_DB_PATH', os.path.join('data', 'kryptokids.db'))
+METADATA_BATCH_SIZE = int(os.environ.get('METADATA_BATCH_SIZE', 100))
+METADATA_FLUSH_MS = float(os.environ.get('METADATA_FLUSH_MS', 50))
+
+# Gallery thumbnails (see gallery.py)
+THUMBNAIL_DIR = os.environ.get('THUMBNAIL_DIR', os.path.join('data', 'thumbnails'))
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', 256))
+
+# Image storage backend and background uploads (see storage.py)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local').lower()  # local or s3
+STORAGE_BUCKET = os.environ.get('STORAGE_BUCKET')
+STORAGE_PREFIX = os.environ.get('STORAGE_PREFIX', '')
+STORAGE_ENDPOINT_URL = os.environ.get('STORAGE_ENDPOINT_URL')  # e.g. http://localhost:9000 for MinIO
+STORAGE_REGION = os.environ.get('STORAGE_REGION')
+STORAGE_PUBLIC_URL = os.environ.get('STORAGE_PUBLIC_URL')
+STORAGE_URL_EXPIRES = int(os.environ.get('STORAGE_URL_EXPIRES', 3600))
+STORAGE_MULTIPART_MB = int(os.environ.get('STORAGE_MULTIPART_MB', 8))
+STORAGE_UPLOAD_WORKERS = int(os.environ.get('STORAGE_UPLOAD_WORKERS', 4))
+STORAGE_MAX_PENDING = int(os.environ.get('STORAGE_MAX_PENDING', 256))
+
+# Retention quotas for stored images (see janitor.py); 0 disables a quota
+RETENTION_MAX_GB = float(os.environ.get('RETENTION_MAX_GB', 0))
+RETENTION_MAX_AGE_DAYS = float(os.environ.get('RETENTION_MAX_AGE_DAYS', 0))
+RETENTION_TARGET_RATIO = float(os.environ.get('RETENTION_TARGET_RATIO', 0.9))
+RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', 300))
+RETENTION_DIRS = os.environ.get('RETENTION_DIRS', f"uploads,generated_images,{THUMBNAIL_DIR}")
+
+# Fair scheduling of Venice calls per holdjarID (see scheduler.py); 0 concurrency disables it
+SCHEDULER_CONCURRENCY = int(os.environ.get('SCHEDULER_CONCURRENCY', VENICE_POOL_SIZE))
+SCHEDULER_PER_IDENTITY = int(os.environ.get('SCHEDULER_PER_IDENTITY', 2))
+SCHEDULER_MAX_QUEUED = int(os.environ.get('SCHEDULER_MAX_QUEUED', 4))
+SCHEDULER_MAX_TOTAL_QUEUED = int(os.environ.get('SCHEDULER_MAX_TOTAL_QUEUED', 256))
+SCHEDULER_QUOTAS = os.environ.get('SCHEDULER_QUOTAS', '')  # e.g. "10/60,100/3600"
+SCHEDULER_WEIGHTS = os.environ.get('SCHEDULER_WEIGHTS', '')  # e.g. "0xabc:2"
+SCHEDULER_QUEUE_TIMEOUT = float(os.environ.get('SCHEDULER_QUEUE_TIMEOUT', 60))
+# Batch lane: reserved share of the slots, otherwise idle capacity only
+SCHEDULER_BATCH_SHARE = float(os.environ.get('SCHEDULER_BATCH_SHARE', 0.25))
+SCHEDULER_BATCH_MAX_QUEUED = int(os.environ.get('SCHEDULER_BATCH_MAX_QUEUED', 64))
+SCHEDULER_BATCH_QUEUE_TIMEOUT = float(os.environ.get('SCHEDULER_BATCH_QUEUE_TIMEOUT', 600))
+
+# Shared generation job queue (see job_queue.py)
+JOB_BROKER_URL = os.environ.get('JOB_BROKER_URL', 'sqlite:///' + os.path.join('data', 'jobs.db'))
+JOB_REDIS_PREFIX = os.environ.get('JOB_REDIS_PREFIX', 'kk:jobs')
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get('JOB_VISIBILITY_TIMEOUT', 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_RETRY_DELAY = float(os.environ.get('JOB_RETRY_DELAY', 10))
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', 7 * 86400))
+JOB_WORKER_THREADS = int(os.environ.get('JOB_WORKER_THREADS', 4))
+
+# Idempotency-Key replay for the generation and upload endpoints (see idempotency.py)
+IDEMPOTENCY_DB_PATH = os.environ.get('IDEMPOTENCY_DB_PATH', os.path.join('data', 'idempotency.db'))
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 120))
+IDEMPOTENCY_LOCK_TIMEOUT = float(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT', 300))
+
+# Shared response cache for prompt-determined generations (see prompt_cache.py); 0 TTL disables it
+PROMPT_CACHE_TTL = float(os.environ.get('PROMPT_CACHE_TTL', 0))
+PROMPT_CACHE_DB_PATH = os.environ.get('PROMPT_CACHE_DB_PATH', os.path.join('data', 'prompt_cache.db'))
+PROMPT_CACHE_MAX_ENTRIES = int(os.environ.get('PROMPT_CACHE_MAX_ENTRIES', 2000))
+PROMPT_POPULARITY_HALF_LIFE = float(os.environ.get('PROMPT_POPULARITY_HALF_LIFE', 3 * 86400))
+# Off-peak pre-warming of popular prompts; 0 budget disables it
+PREWARM_DAILY_BUDGET = int(os.environ.get('PREWARM_DAILY_BUDGET', 0))
+PREWARM_HOURS = os.environ.get('PREWARM_HOURS', '1-6')
+PREWARM_MIN_SCORE = float(os.environ.get('PREWARM_MIN_SCORE', 3))
+PREWARM_INTERVAL = float(os.environ.get('PREWARM_INTERVAL', 600))
+# Also reuse responses for near-identical descriptions ("A blue dragon!!" == "blue dragons")
+PROMPT_CACHE_SEMANTIC = env_bool('PROMPT_CACHE_SEMANTIC')
@@ -0,0 +1,117 @@
+"""
+Per-request stage timers
+
+Code anywhere in a request (app.py handlers, VeniceAPI methods, executor
+threads) wraps its work in `stage_timer.stage('name')`. The timings are
+collected on a StageTimer held in a context variable, and init_app() turns
+them into a `Server-Timing` response header - plus a `server_timing` block
+in JSON responses when the client asks for it with `?timing=1`.
+
+Outside a request there is no active timer and stage() does nothing, so
+VeniceAPI keeps working unchanged from scripts and the CLI tools.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+_current_timer = contextvars.ContextVar('stage_timer', default=None)
+
+
+class StageTimer:
+    """Accumulates wall-clock time per named stage for one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        """
+        Add a duration to a stage; repeated stages are summed
+
+        Args:
+            name (str): Stage name (a Server-Timing token, e.g. "upstream")
+            seconds (float): Duration to add
+        """
+        with self._lock:
+            self._stages[name] = self._stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started)
+
+    def total_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def as_dict(self):
+        """Return stage durations in milliseconds, in the order they first ran"""
+        with self._lock:
+            stages = {name: round(seconds * 1000, 2) for name, seconds in self._stages.items()}
+        return {'stages': stages, 'total_ms': round(self.total_ms(), 2)}
+
+    def server_timing_header(self):
+        """Format the timings as a Server-Timing header value"""
+        with self._lock:
+            entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self._stages.items()]
+        entries.append(f"total;dur={self.total_ms():.2f}")
+        return ', '.join(entries)
+
+
+def current():
+    """Return the active request's StageTimer, or None outside a request"""
+    return _current_timer.get()
+
+
+@contextmanager
+def stage(name):
+    """Time the wrapped block against the active request's timer, if any"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.stage(name):
+        yield
+
+
+def init_app(app):
+    """
+    Start a timer for every request and report it in the response
+
+    Args:
+        app (Flask): Application to instrument
+    """
+    import json
+    from flask import g, request
+
+    def _wants_timing_body():
+        return request.args.get('timing', '').lower() in ('1', 'true', 'yes')
+
+    @app.before_request
+    def _start_stage_timer():
+        g._stage_timer_token = _current_timer.set(StageTimer())
+
+    @app.after_request
+    def _report_stage_timer(response):
+        timer = _current_timer.get()
+        if timer is None:
+            return response
+
+        if _wants_timing_body() and response.is_json and not response.direct_passthrough:
+            body = response.get_json(silent=True)
+            if isinstance(body, dict):
+                body['server_timing'] = timer.as_dict()
+                response.set_data(json.dumps(body))
+
+        response.headers['Server-Timing'] = timer.server_timing_header()
+        return response
+
+    @app.teardown_request
+    def _stop_stage_timer(exc):
+        token = g.pop('_stage_timer_token', None)
+        if token is not None:
+            _current_timer.reset(token)
@@ -0,0 +1,364 @@
+"""
+Pluggable image storage
+
+Uploaded drawings and generated images are always written to local disk
+first, under keys like `generated_images/<file>` and `uploads/<file>`, so the
+request that created them never waits on a remote write. With an object
+storage backend configured, a bounded uploader pool then copies each file to
+the bucket in the background (multipart for large files), which lets several
+nodes behind a load balancer serve each other's images.
+
+    local   LocalStorage: files stay where they were written (the default)
+    s3      S3Storage: any S3-compatible service - AWS S3, MinIO, R2, or a
+            local stand-in through STORAGE_ENDPOINT_URL
+
+Reads prefer the local copy and fall back to the backend (read() and
+open_file()), so galleries and exports work for files another node wrote or
+the retention janitor evicted. A node that doesn't have the file redirects to
+url(key): a direct URL under STORAGE_PUBLIC_URL when the bucket is public,
+otherwise a presigned URL valid for STORAGE_URL_EXPIRES seconds.
+
+boto3 is only needed (and only imported) for the s3 backend.
+"""
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import settings
+
+UPLOADS = metrics.Counter('kk_storage_uploads_total', 'Object storage uploads by outcome', ['status'])
+
+
+class StorageError(RuntimeError):
+    """Raised when the storage backend can't be configured or reached"""
+
+
+class UploadQueueFull(RuntimeError):
+    """Raised by Uploader.submit() when STORAGE_MAX_PENDING uploads are already pending"""
+
+
+class LocalStorage:
+    """Files stay on this node's disk, served by the API itself"""
+
+    remote = False
+
+    def __init__(self, root='.'):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def put_file(self, key, path):
+        """Nothing to copy; the file is already where it is served from"""
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def get_bytes(self, key):
+        """Contents of a stored file; raises FileNotFoundError if it's missing"""
+        with open(self.path(key), 'rb') as f:
+            return f.read()
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key, expires=None):
+        return f"/{key}"
+
+
+class S3Storage:
+    """S3-compatible object storage through boto3"""
+
+    remote = True
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, public_url=None,
+                 url_expires=3600, multipart_threshold=8 * 1024 * 1024):
+        """
+        Args:
+            bucket (str): Bucket name
+            prefix (str): Key prefix inside the bucket
+            endpoint_url (str): Non-AWS endpoint, e.g. http://localhost:9000 for MinIO
+            region (str): Bucket region
+            public_url (str): Base URL of a public bucket or CDN; presigned URLs are used without it
+            url_expires (int): Lifetime of presigned URLs in seconds
+            multipart_threshold (int): Files at least this large are uploaded in parts of this size
+        """
+        if not bucket:
+            raise StorageError("STORAGE_BUCKET is required for the s3 storage backend")
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.endpoint_url = endpoint_url
+        self.region = region
+        self.public_url = public_url.rstrip('/') if public_url else None
+        self.url_expires = url_expires
+        self.multipart_threshold = multipart_threshold
+        self._client = None
+        self._transfer_config = None
+        self._lock = threading.Lock()
+
+    def _get_client(self):
+        # boto3 is heavy and optional; import it on the first remote operation
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    try:
+                        import boto3
+                        from boto3.s3.transfer import TransferConfig
+                    except ImportError as e:
+                        raise StorageError("The s3 storage backend needs boto3 (pip install boto3)") from e
+                    self._transfer_config = TransferConfig(
+                        multipart_threshold=self.multipart_threshold,
+                        multipart_chunksize=self.multipart_threshold
+                    )
+                    # Credentials come from the usual AWS_* variables or instance profile
+                    self._client = boto3.client('s3', endpoint_url=self.endpoint_url, region_name=self.region)
+        return self._client
+
+    def object_key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def put_file(self, key, path):
+        """Upload a local file, in parts once it crosses the multipart threshold"""
+        import mimetypes
+        client = self._get_client()
+        extra_args = {'ContentType': mimetypes.guess_type(path)[0] or 'application/octet-stream'}
+        client.upload_file(path, self.bucket, self.object_key(key),
+                           ExtraArgs=extra_args, Config=self._transfer_config)
+
+    def exists(self, key):
+        client = self._get_client()
+        try:
+            client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+            return True
+        except client.exceptions.ClientError:
+            return False
+
+    def get_bytes(self, key):
+        """Contents of a stored object"""
+        response = self._get_client().get_object(Bucket=self.bucket, Key=self.object_key(key))
+        return response['Body'].read()
+
+    def delete(self, key):
+        self._get_client().delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def url(self, key, expires=None):
+        """Direct URL for a public bucket, otherwise a presigned GET URL"""
+        if self.public_url:
+            return f"{self.public_url}/{self.object_key(key)}"
+        return self._get_client().generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': self.object_key(key)},
+            ExpiresIn=expires or self.url_expires
+        )
+
+
+class Uploader:
+    """Bounded pool that copies locally written files to the storage backend"""
+
+    def __init__(self, backend, max_workers=4, max_pending=256):
+        self.backend = backend
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created on first use so preloaded masters don't fork with live threads
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='storage-upload')
+        return self._executor
+
+    def submit(self, key, path):
+        """
+        Upload a file in the background
+
+        Raises:
+            UploadQueueFull: If STORAGE_MAX_PENDING uploads are already pending
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise UploadQueueFull(f"{self._pending} uploads already pending")
+            self._pending += 1
+            executor = self._get_executor()
+        executor.submit(self._upload, key, path)
+
+    def _upload(self, key, path):
+        try:
+            self.upload(key, path)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def upload(self, key, path):
+        """
+        Upload a file now
+
+        Returns:
+            bool: True if the file was uploaded
+        """
+        try:
+            with metrics.IMAGE_STAGE.time(stage='storage_upload'):
+                self.backend.put_file(key, path)
+        except Exception as e:
+            # The local copy is still there and served by the node that wrote it
+            print(f"Error uploading {key} to storage: {str(e)}")
+            UPLOADS.inc(status='error')
+            return False
+        UPLOADS.inc(status='ok')
+        return True
+
+    def snapshot(self):
+        """Uploader state for /api/status"""
+        with self._lock:
+            pending = self._pending
+        return {
+            'backend': settings.STORAGE_BACKEND,
+            'pending_uploads': pending,
+            'max_pending': self.max_pending,
+            'uploaded': UPLOADS.value(status='ok'),
+            'upload_errors': UPLOADS.value(status='error')
+        }
+
+    def shutdown(self, wait=True):
+        """Stop accepting uploads and, by default, finish the queued ones"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+
+def create_backend(name=None):
+    """
+    Build the configured storage backend
+
+    Args:
+        name (str): 'local' or 's3' (default: STORAGE_BACKEND)
+
+    Raises:
+        StorageError: On an unknown backend or missing configuration
+    """
+    name = (name or settings.STORAGE_BACKEND).lower()
+    if name == 'local':
+        return LocalStorage()
+    if name == 's3':
+        return S3Storage(
+            settings.STORAGE_BUCKET,
+            prefix=settings.STORAGE_PREFIX,
+            endpoint_url=settings.STORAGE_ENDPOINT_URL,
+            region=settings.STORAGE_REGION,
+            public_url=settings.STORAGE_PUBLIC_URL,
+            url_expires=settings.STORAGE_URL_EXPIRES,
+            multipart_threshold=settings.STORAGE_MULTIPART_MB * 1024 * 1024
+        )
+    raise StorageError(f"Unknown storage backend: {name}")
+
+
+BACKEND = create_backend()
+UPLOADER = Uploader(
+    BACKEND,
+    max_workers=settings.STORAGE_UPLOAD_WORKERS,
+    max_pending=settings.STORAGE_MAX_PENDING
+)
+metrics.register_status_provider('storage', UPLOADER.snapshot)
+
+
+def storage_key(*parts):
+    """Storage key for a file under a served directory, e.g. ('uploads', 'cat.png')"""
+    return '/'.join(part.strip('/') for part in parts)
+
+
+def path_key(path):
+    """Storage key of a local file path recorded in the metadata store, e.g. uploads/cat.png"""
+    return storage_key(os.path.basename(os.path.dirname(path)), os.path.basename(path))
+
+
+def offload(key, path, wait=False):
+    """
+    Hand a file that was just written locally to the storage backend
+
+    Local storage has nothing to do. Otherwise the upload runs in the
+    background; if the uploader queue is full it runs inline instead so no
+    file is left behind.
+
+    Args:
+        key (str): Storage key, see storage_key()
+        path (str): Local file
+        wait (bool): Upload inline, for callers that record the key as durable right after
+    """
+    if not BACKEND.remote:
+        return
+    if wait:
+        UPLOADER.upload(key, path)
+        return
+    try:
+        UPLOADER.submit(key, path)
+    except UploadQueueFull:
+        UPLOADS.inc(status='inline')
+        UPLOADER.upload(key, path)
+
+
+def read(key, path=None):
+    """
+    Bytes of a stored file: this node's local copy if it has one, else the backend's
+
+    Args:
+        key (str): Storage key, see storage_key()
+        path (str): Local path of the file, if it differs from the key
+
+    Returns:
+        bytes: The contents, or None if neither copy can be read
+    """
+    path = path or key
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    return _read_remote(key)
+
+
+def _read_remote(key):
+    if not BACKEND.remote:
+        return None
+    try:
+        return BACKEND.get_bytes(key)
+    except Exception as e:
+        print(f"Error reading {key} from storage: {str(e)}")
+        return None
+
+
+def open_file(key, path=None):
+    """
+    Binary file object for a stored file, like read() but without loading a local copy
+
+    The local copy is opened directly so callers can stream it in chunks;
+    a file only the backend has is fetched into memory.
+
+    Args:
+        key (str): Storage key, see storage_key()
+        path (str): Local path of the file, if it differs from the key
+
+    Raises:
+        FileNotFoundError: If neither copy can be read
+    """
+    path = path or key
+    try:
+        return open(path, 'rb')
+    except FileNotFoundError:
+        data = _read_remote(key)
+        if data is None:
+            raise
+    return io.BytesIO(data)
+
+
+def remote_url(key):
+    """URL of a stored object, or None when this node should serve the file itself"""
+    if not BACKEND.remote:
+        return None
+    try:
+        return BACKEND.url(key)
+    except Exception as e:
+        print(f"Error building storage URL for {key}: {str(e)}")
+        return None
@@ -0,0 +1,199 @@
+"""
+Background tasks that run after the response
+
+Work the client doesn't need to wait for (saving a generated image, trait
+analysis) is submitted to a bounded thread pool. Each submission gets a task
+ID that the client polls at /api/tasks/<id> for the status and result.
+
+The pool is bounded twice: BACKGROUND_WORKERS threads run tasks and at most
+BACKGROUND_MAX_PENDING tasks may be queued or running. When the queue is full
+submit() raises TaskQueueFull and callers do the work inline instead, so a
+burst can't pile up unbounded memory.
+
+Finished tasks are kept in memory for BACKGROUND_RESULT_TTL seconds. Every
+status change (queued, running, finished) is also written to
+BACKGROUND_RESULT_DIR, so a poll that lands on a different gunicorn worker
+finds the task at any point of its life, not only once it is done.
+"""
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import settings
+
+TASKS = metrics.Counter('kk_background_tasks_total', 'Background tasks by name and outcome', ['task', 'status'])
+
+# Task IDs are uuid4 hex; anything else can't name a task (or a result file)
+TASK_ID_LENGTH = 32
+
+
+class TaskQueueFull(RuntimeError):
+    """Raised by submit() when BACKGROUND_MAX_PENDING tasks are already pending"""
+
+
+class Task:
+    """Status and outcome of one background task"""
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = 'queued'
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'name': self.name,
+            'status': self.status,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished
+        }
+
+
+class TaskRunner:
+    """Bounded executor plus a registry of recent tasks"""
+
+    def __init__(self, max_workers, max_pending, result_ttl, result_dir=None):
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.result_dir = result_dir
+        self._max_workers = max_workers
+        self._executor = None
+        self._tasks = {}
+        self._pending = 0
+        self._failed = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        # Created on first use so preloaded masters don't fork with live threads
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='background')
+        return self._executor
+
+    def submit(self, name, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) in the background
+
+        Args:
+            name (str): Task name, for metrics and status
+            fn (callable): Work to run; its return value must be JSON-serializable
+
+        Returns:
+            Task: The queued task
+
+        Raises:
+            TaskQueueFull: If BACKGROUND_MAX_PENDING tasks are already pending
+        """
+        task = Task(name)
+        with self._lock:
+            self._evict_expired()
+            if self._pending >= self.max_pending:
+                raise TaskQueueFull(f"{self._pending} background tasks already pending")
+            self._pending += 1
+            self._tasks[task.id] = task
+            executor = self._get_executor()
+        self._persist(task)
+        executor.submit(self._run, task, fn, args, kwargs)
+        return task
+
+    def _run(self, task, fn, args, kwargs):
+        task.status = 'running'
+        self._persist(task)
+        try:
+            task.result = fn(*args, **kwargs)
+            task.status = 'succeeded'
+        except Exception as e:
+            print(f"Background task {task.name} ({task.id}) failed: {str(e)}")
+            traceback.print_exc()
+            task.error = str(e)
+            task.status = 'failed'
+        task.finished = time.time()
+        TASKS.inc(task=task.name, status=task.status)
+        with self._lock:
+            self._pending -= 1
+            if task.status == 'failed':
+                self._failed += 1
+        self._persist(task)
+
+    def _persist(self, task):
+        if not self.result_dir:
+            return
+        try:
+            os.makedirs(self.result_dir, exist_ok=True)
+            path = os.path.join(self.result_dir, f"{task.id}.json")
+            with open(f"{path}.tmp", 'w') as f:
+                json.dump(task.as_dict(), f)
+            os.replace(f"{path}.tmp", path)
+        except (OSError, TypeError) as e:
+            print(f"Error persisting background task {task.id}: {str(e)}")
+
+    def _evict_expired(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [task_id for task_id, task in self._tasks.items() if task.finished and task.finished < cutoff]
+        for task_id in expired:
+            del self._tasks[task_id]
+            if self.result_dir:
+                try:
+                    os.remove(os.path.join(self.result_dir, f"{task_id}.json"))
+                except OSError:
+                    pass
+
+    def get(self, task_id):
+        """
+        Look up a task by ID
+
+        Returns:
+            dict: The task's status and result, or None if it is unknown or expired
+        """
+        if len(task_id) != TASK_ID_LENGTH or any(c not in '0123456789abcdef' for c in task_id):
+            return None
+        with self._lock:
+            task = self._tasks.get(task_id)
+        if task is not None:
+            return task.as_dict()
+        if not self.result_dir:
+            return None
+        # Submitted on another worker process
+        try:
+            with open(os.path.join(self.result_dir, f"{task_id}.json")) as f:
+                document = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Unfinished after a whole TTL: its worker most likely died
+        if (document.get('finished') or document.get('created', 0)) < time.time() - self.result_ttl:
+            return None
+        return document
+
+    def snapshot(self):
+        """Queue state for /api/status"""
+        with self._lock:
+            return {
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'tracked': len(self._tasks),
+                'failed': self._failed
+            }
+
+    def shutdown(self, wait=True):
+        """Stop accepting work and, by default, finish what is queued"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+
+RUNNER = TaskRunner(
+    max_workers=settings.BACKGROUND_WORKERS,
+    max_pending=settings.BACKGROUND_MAX_PENDING,
+    result_ttl=settings.BACKGROUND_RESULT_TTL,
+    result_dir=settings.BACKGROUND_RESULT_DIR
+)
+metrics.register_status_provider('background_tasks', RUNNER.snapshot)
@@ -0,0 +1,118 @@
+"""
+Idempotency-Key handling, checked against a throwaway Flask app
+
+Covers replaying a stored response, rejecting a reused key with a different
+body, attaching a retry to an attempt still in flight, and taking over a key
+whose first attempt died. Run with pytest:
+
+    pytest test_idempotency.py
+"""
+import threading
+import time
+
+import pytest
+from flask import Flask, jsonify
+
+import idempotency
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = idempotency.IdempotencyStore(str(tmp_path / 'idempotency.db'))
+    monkeypatch.setattr(idempotency, 'STORE', store)
+    return store
+
+
+def make_app(view):
+    app = Flask(__name__)
+    app.add_url_rule('/generate', 'generate', view, methods=['POST'])
+    idempotency.init_app(app, ['generate'])
+    return app
+
+
+def counting_view(calls, is_async=False, release=None):
+    def respond(payload):
+        calls.append(payload)
+        return jsonify({'success': True, 'call': len(calls)}), 201
+
+    if is_async:
+        async def view():
+            from flask import request
+            return respond(request.get_json())
+        return view
+
+    def view():
+        from flask import request
+        if release is not None:
+            release.wait(5)
+        return respond(request.get_json())
+    return view
+
+
+@pytest.mark.parametrize('is_async', [False, True])
+def test_retry_replays_the_stored_response(store, is_async):
+    calls = []
+    client = make_app(counting_view(calls, is_async)).test_client()
+    headers = {'Idempotency-Key': 'order-1'}
+
+    first = client.post('/generate', json={'animal': 'cat'}, headers=headers)
+    again = client.post('/generate', json={'animal': 'cat'}, headers=headers)
+
+    assert len(calls) == 1
+    assert again.status_code == first.status_code == 201
+    assert again.get_json() == first.get_json() == {'success': True, 'call': 1}
+    assert again.headers['Idempotent-Replayed'] == 'true'
+    assert 'Idempotent-Replayed' not in first.headers
+
+
+def test_reused_key_with_a_different_body_is_rejected(store):
+    calls = []
+    client = make_app(counting_view(calls)).test_client()
+    headers = {'Idempotency-Key': 'order-1'}
+
+    client.post('/generate', json={'animal': 'cat'}, headers=headers)
+    response = client.post('/generate', json={'animal': 'dog'}, headers=headers)
+
+    assert response.status_code == 422
+    assert response.get_json()['success'] is False
+    assert len(calls) == 1
+
+
+def test_retry_attaches_to_the_attempt_in_flight(store):
+    calls, release = [], threading.Event()
+    app = make_app(counting_view(calls, release=release))
+    responses = []
+
+    def post():
+        response = app.test_client().post('/generate', json={'animal': 'cat'}, headers={'Idempotency-Key': 'k'})
+        responses.append((response.status_code, response.get_json()))
+
+    threads = [threading.Thread(target=post, daemon=True) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(calls) == 1
+    assert responses == [(201, {'success': True, 'call': 1})] * 3
+
+
+def test_key_of_a_dead_attempt_is_taken_over_after_the_lock_timeout(store):
+    store.lock_timeout = 0.1
+    calls = []
+    app = make_app(counting_view(calls))
+    body, headers = {'animal': 'cat'}, {'Idempotency-Key': 'k'}
+
+    # A first attempt claimed the key, then its worker died before finishing
+    with app.test_request_context('/generate', method='POST', json=body):
+        fingerprint = idempotency.request_fingerprint()
+    outcome, _ = store.begin('generate', 'k', fingerprint)
+    assert outcome == idempotency.NEW
+    assert store.begin('generate', 'k', fingerprint) == (idempotency.IN_FLIGHT, None)
+
+    time.sleep(store.lock_timeout * 2)
+    response = app.test_client().post('/generate', json=body, headers=headers)
+    assert response.status_code == 201 and len(calls) == 1
+    assert store.begin('generate', 'k', fingerprint)[0] == idempotency.REPLAY
@@ -0,0 +1,159 @@
+"""
+Retention janitor, checked against a throwaway metadata store and image files
+
+Covers the age pass, the quota pass (including files that can't be removed),
+dry runs, the pinned/minted exemption and the trigger-maintained usage
+totals. Run with pytest:
+
+    pytest test_janitor.py
+"""
+import os
+import time
+
+import pytest
+
+import janitor
+import metadata_store
+import storage
+
+DAY = 86400
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = metadata_store.MetadataStore(str(tmp_path / 'metadata.db'))
+    monkeypatch.setattr(metadata_store, 'STORE', store)
+    monkeypatch.setattr(storage, 'BACKEND', storage.LocalStorage())
+    return store
+
+
+@pytest.fixture
+def images(tmp_path):
+    directory = tmp_path / 'generated_images'
+    directory.mkdir()
+    return directory
+
+
+def make_janitor(images, **quotas):
+    # A long interval keeps the background thread out of the way; tests call run() themselves
+    return janitor.Janitor([str(images)], interval=3600, **quotas)
+
+
+def add_files(store, retention, images, sizes):
+    """Write, track and record one file per size, accessed one minute apart in order"""
+    paths = []
+    for index, size in enumerate(sizes):
+        path = str(images / f"image{index}.png")
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        retention.track(path)
+        store.record('generation', holdjar_id='0xabc', file_path=path)
+        paths.append(path)
+    retention.flush()
+    assert store.flush()
+    start = time.time() - len(paths) * 60
+    connection = store.connection()
+    with connection:
+        for index, path in enumerate(paths):
+            connection.execute('UPDATE files SET last_access = ? WHERE path = ?', (start + index * 60, path))
+    return paths
+
+
+def assert_usage_matches_files(retention):
+    """The trigger-maintained totals agree with the files table"""
+    row = metadata_store.STORE.connection().execute(
+        'SELECT COALESCE(SUM(size), 0) AS bytes, COUNT(*) AS files FROM files').fetchone()
+    assert retention.usage() == {'bytes': row['bytes'], 'files': row['files']}
+
+
+def recorded_paths(store):
+    return {item['file_path'] for item in store.recent(limit=100) if item['file_path']}
+
+
+def test_age_pass_evicts_old_files_but_not_pinned_or_minted_ones(store, images):
+    retention = make_janitor(images, max_age=DAY)
+    paths = add_files(store, retention, images, [100] * 4)
+    retention.pin(paths[0])
+    retention.mint(paths[1])
+
+    report = retention.run(now=time.time() + 2 * DAY)
+
+    assert report['age'] == {'files': 2, 'bytes': 200}
+    assert [os.path.exists(path) for path in paths] == [True, True, False, False]
+    assert retention.usage() == {'bytes': 200, 'files': 2}
+    assert_usage_matches_files(retention)
+    # Without object storage the items lose their file and drop out of galleries and exports
+    assert recorded_paths(store) == set(paths[:2])
+
+
+def test_quota_pass_evicts_least_recently_accessed_down_to_the_target(store, images):
+    retention = make_janitor(images, max_bytes=1000, target_ratio=0.5)
+    paths = add_files(store, retention, images, [200] * 6)
+    retention.mint(paths[0])
+
+    report = retention.run()
+
+    # 1200 bytes against a 500 byte target: the oldest unpinned files go until 700 are freed
+    assert report['quota'] == {'files': 4, 'bytes': 800}
+    assert [os.path.exists(path) for path in paths] == [True, False, False, False, False, True]
+    assert report['usage'] == {'bytes': 400, 'files': 2}
+    assert_usage_matches_files(retention)
+
+
+def test_quota_pass_skips_past_files_that_cannot_be_removed(store, images, monkeypatch):
+    retention = make_janitor(images, max_bytes=500, target_ratio=1.0)
+    paths = add_files(store, retention, images, [200] * 4)
+
+    remove = os.remove
+
+    def stuck_remove(path):
+        if path == paths[0]:
+            raise PermissionError(f"Permission denied: {path}")
+        remove(path)
+
+    monkeypatch.setattr(os, 'remove', stuck_remove)
+    report = retention.run()
+
+    # The stuck file keeps its row and usage; the next ones are evicted instead
+    assert report['quota'] == {'files': 2, 'bytes': 400}
+    assert [os.path.exists(path) for path in paths] == [True, False, False, True]
+    assert retention.usage() == {'bytes': 400, 'files': 2}
+    assert_usage_matches_files(retention)
+    assert paths[0] in recorded_paths(store)
+
+
+def test_dry_run_reports_the_same_evictions_without_deleting(store, images):
+    retention = make_janitor(images, max_age=DAY, max_bytes=500, target_ratio=1.0)
+    paths = add_files(store, retention, images, [200] * 5)
+    retention.pin(paths[4])
+    # Only the two oldest files are past the age limit
+    connection = store.connection()
+    with connection:
+        connection.execute('UPDATE files SET last_access = last_access - ? WHERE path IN (?, ?)',
+                           (2 * DAY, paths[0], paths[1]))
+
+    dry = retention.run(dry_run=True)
+
+    assert all(os.path.exists(path) for path in paths)
+    assert dry['usage'] == {'bytes': 1000, 'files': 5}
+    assert recorded_paths(store) == set(paths)
+
+    real = retention.run()
+    assert (dry['age'], dry['quota']) == (real['age'], real['quota'])
+    assert real['age'] == {'files': 2, 'bytes': 400}
+    assert real['quota'] == {'files': 1, 'bytes': 200}
+    assert [os.path.exists(path) for path in paths] == [False, False, False, True, True]
+    assert_usage_matches_files(retention)
+
+
+def test_minted_pin_cannot_be_removed_or_downgraded(store, images):
+    retention = make_janitor(images, max_age=DAY)
+    path = add_files(store, retention, images, [100])[0]
+    retention.mint(path)
+
+    retention.pin(path, 'pinned')
+    assert retention.pinned(path) == 'minted'
+    assert not retention.unpin(path)
+
+    retention.run(now=time.time() + 2 * DAY)
+    assert os.path.exists(path)
@@ -0,0 +1,135 @@
+"""
+Job queue semantics, checked against the in-process brokers
+
+The in-memory and SQLite brokers share the Redis broker's contract, so the
+same tests cover visibility timeouts, acknowledgements, retries,
+dead-lettering and idempotent redelivery. Run with pytest:
+
+    pytest test_job_queue.py
+"""
+import time
+
+import pytest
+
+import job_queue
+
+VISIBILITY = 0.05
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def broker(request, tmp_path):
+    if request.param == 'memory':
+        return job_queue.InMemoryBroker()
+    return job_queue.SQLiteBroker(str(tmp_path / 'jobs.db'))
+
+
+def test_enqueue_is_idempotent_per_job_id(broker):
+    """Enqueuing the same job ID twice queues it once"""
+    job_id, created = broker.enqueue('text_to_image', {'n': 1}, job_id='a' * 32)
+    assert created
+    assert broker.enqueue('text_to_image', {'n': 2}, job_id=job_id) == (job_id, False)
+    assert broker.reserve(VISIBILITY).payload == {'n': 1}
+    assert broker.reserve(VISIBILITY) is None
+
+
+def test_unacked_job_is_redelivered_after_visibility_timeout(broker):
+    """At-least-once: a job not acked in time goes to the next reserver, and the old receipt is void"""
+    job_id, _ = broker.enqueue('text_to_image', {})
+    first = broker.reserve(VISIBILITY)
+    assert broker.reserve(VISIBILITY) is None
+
+    time.sleep(VISIBILITY * 2)
+    second = broker.reserve(VISIBILITY)
+    assert second.id == job_id and second.attempts == 2
+    assert not broker.ack(first, {'late': True})
+    assert broker.ack(second, {'ok': True})
+
+    job = broker.get(job_id)
+    assert job['status'] == 'succeeded' and job['result'] == {'ok': True}
+
+
+def test_extend_keeps_job_hidden(broker):
+    broker.enqueue('text_to_image', {})
+    message = broker.reserve(VISIBILITY)
+    time.sleep(VISIBILITY / 2)
+    assert broker.extend(message, VISIBILITY * 4)
+    time.sleep(VISIBILITY)
+    assert broker.reserve(VISIBILITY) is None
+
+
+def test_failures_retry_then_dead_letter(broker):
+    job_id, _ = broker.enqueue('text_to_image', {}, max_attempts=2)
+    assert broker.fail(broker.reserve(VISIBILITY), "upstream 500") == 'retry'
+    assert broker.fail(broker.reserve(VISIBILITY), "upstream 500") == 'dead'
+    assert broker.reserve(VISIBILITY) is None
+
+    job = broker.get(job_id)
+    assert job['status'] == 'dead' and job['error'] == "upstream 500"
+    assert [dead['id'] for dead in broker.dead_letters()] == [job_id]
+
+    assert broker.requeue(job_id)
+    assert broker.reserve(VISIBILITY).attempts == 1
+
+
+def test_timeout_on_last_attempt_dead_letters(broker):
+    """A worker that dies on the final attempt doesn't leave the job looping forever"""
+    job_id, _ = broker.enqueue('text_to_image', {}, max_attempts=1)
+    broker.reserve(VISIBILITY)
+    time.sleep(VISIBILITY * 2)
+    assert broker.reserve(VISIBILITY) is None
+    assert broker.get(job_id)['status'] == 'dead'
+
+
+def test_worker_skips_checkpointed_stages_on_redelivery(broker):
+    """A job that crashes after its paid call doesn't pay again when it is retried"""
+    calls = {'venice': 0, 'record': 0}
+
+    def handler(payload, job):
+        if not job.progress.get('generated'):
+            calls['venice'] += 1
+            job.checkpoint(generated=True)
+        if job.attempts == 1:
+            raise RuntimeError("worker crashed")
+        if not job.progress.get('recorded'):
+            calls['record'] += 1
+            job.checkpoint(recorded=True)
+        return {'image_url': '/generated_images/x.png'}
+
+    worker = job_queue.JobWorker(broker, handlers={'text_to_image': handler},
+                                 visibility_timeout=VISIBILITY, retry_delay=0)
+    job_id, _ = broker.enqueue('text_to_image', {})
+    assert worker.run_once()
+    assert broker.get(job_id)['status'] == 'queued'
+    assert worker.run_once()
+    assert not worker.run_once()
+
+    assert calls == {'venice': 1, 'record': 1}
+    assert broker.get(job_id)['result'] == {'image_url': '/generated_images/x.png'}
+
+
+def test_unknown_kind_is_dead_lettered(broker):
+    worker = job_queue.JobWorker(broker, handlers={}, visibility_timeout=VISIBILITY, retry_delay=0)
+    job_id, _ = broker.enqueue('mystery', {}, max_attempts=1)
+    assert worker.run_once()
+    assert broker.get(job_id)['status'] == 'dead'
+
+
+def test_deferred_job_does_not_use_up_attempts(broker):
+    """Quota pushback puts the job back for later instead of dead-lettering it"""
+    deferrals = []
+
+    def handler(payload, job):
+        if len(deferrals) < 3:
+            deferrals.append(job.attempts)
+            raise job_queue.Defer("over quota", 0)
+        return {'attempts': job.attempts}
+
+    worker = job_queue.JobWorker(broker, handlers={'text_to_image': handler},
+                                 visibility_timeout=VISIBILITY, retry_delay=0)
+    job_id, _ = broker.enqueue('text_to_image', {}, max_attempts=1)
+    for _ in range(4):
+        assert worker.run_once()
+
+    assert deferrals == [1, 1, 1]
+    job = broker.get(job_id)
+    assert job['status'] == 'succeeded' and job['result'] == {'attempts': 1}
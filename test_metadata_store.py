@@ -0,0 +1,20 @@
+"""
+Metadata store writer, checked against a throwaway SQLite file
+
+Covers the batching writer keeping the good rows of a batch when one row
+can't be written. Run with pytest:
+
+    pytest test_metadata_store.py
+"""
+import metadata_store
+
+
+def test_bad_row_does_not_lose_the_rest_of_its_batch(tmp_path):
+    """A row SQLite can't bind is dropped on its own; its batch-mates are still committed"""
+    store = metadata_store.MetadataStore(str(tmp_path / 'metadata.db'), flush_interval=0.2)
+    for holdjar_id in ('good1', {'bad': 1}, 'good2'):
+        store.record('generation', holdjar_id=holdjar_id)
+    assert store.flush()
+
+    written = [item['holdjar_id'] for item in store.recent(kind='generation')]
+    assert sorted(written) == ['good1', 'good2']
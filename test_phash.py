@@ -0,0 +1,77 @@
+"""
+Near-duplicate index, checked against a brute-force Hamming scan
+
+Covers the multi-index radius search that decides whether /api/drawing
+treats a submission as a duplicate: hashes within the radius are found,
+hashes beyond it are not, including radii that aren't a multiple of the
+chunk count. Run with pytest:
+
+    pytest test_phash.py
+"""
+import random
+
+import pytest
+
+import phash
+
+
+def flip(value, bits):
+    for bit in bits:
+        value ^= 1 << bit
+    return value
+
+
+def spread_bits(count):
+    """`count` bit positions dealt round-robin over the four chunks, the worst case for the pigeonhole bound"""
+    return [(index % phash.CHUNKS) * phash.CHUNK_BITS + index // phash.CHUNKS for index in range(count)]
+
+
+def digest(number):
+    return f"{number:064x}"
+
+
+@pytest.mark.parametrize('radius', range(0, 11))
+def test_hash_at_the_radius_is_found_and_one_bit_further_is_not(radius):
+    query = random.Random(radius).getrandbits(phash.HASH_BITS)
+    index = phash.HashIndex()
+    index.add(flip(query, spread_bits(radius)), digest(1))
+    index.add(flip(query, spread_bits(radius + 1)), digest(2))
+
+    assert index.search(query, radius) == [(radius, digest(1))]
+    assert index.nearest(query, radius + 1) == (radius, digest(1))
+
+
+@pytest.mark.parametrize('radius', [4, 5, 6, 7, 10])
+def test_search_matches_a_brute_force_scan(radius):
+    rng = random.Random(radius)
+    index = phash.HashIndex()
+    hashes = {}
+    centres = [rng.getrandbits(phash.HASH_BITS) for _ in range(20)]
+    for number in range(2000):
+        # Most hashes sit near a centre so every radius has plenty of hits and misses
+        centre = rng.choice(centres)
+        value = flip(centre, rng.sample(range(phash.HASH_BITS), rng.randint(0, 2 * radius)))
+        hashes[digest(number)] = value
+        index.add(value, digest(number))
+
+    for centre in centres:
+        expected = sorted((phash.hamming(centre, value), name) for name, value in hashes.items()
+                          if phash.hamming(centre, value) <= radius)
+        assert index.search(centre, radius) == expected
+
+
+def test_search_leaves_out_the_excluded_image():
+    index = phash.HashIndex()
+    index.add(0, digest(1))
+    index.add(1, digest(2))
+    assert index.search(0, 3, exclude=digest(1)) == [(1, digest(2))]
+
+
+def test_records_appended_by_another_worker_are_searchable(tmp_path):
+    path = str(tmp_path / 'phash.idx')
+    mine, other_worker = phash.HashIndex(path), phash.HashIndex(path)
+    other_worker.add(0b1011, digest(1))
+    other_worker.add(0b1011, digest(1))
+
+    assert mine.search(0b1001, 1) == [(1, digest(1))]
+    assert len(mine) == 1
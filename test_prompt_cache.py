@@ -0,0 +1,78 @@
+"""
+Description normalization for the semantic prompt cache
+
+Checks which kids' descriptions share a normalized cache key and which must
+stay apart. Run with pytest:
+
+    pytest test_prompt_cache.py
+"""
+import pytest
+
+import prompt_cache
+from venice_api import VeniceAPI
+
+
+@pytest.mark.parametrize('first, second', [
+    ("A blue dragon!!", "blue dragons"),
+    ("The BIG red dragon", "a red, big dragon"),
+    ("puppies and kittens", "a kitten and a puppy"),
+    ("I want a picture of butterflies", "butterfly"),
+    ("two mice", "two mouse"),
+])
+def test_near_identical_descriptions_share_a_key(first, second):
+    assert prompt_cache.normalize_description(first) == prompt_cache.normalize_description(second)
+
+
+@pytest.mark.parametrize('first, second', [
+    ("a cat chasing a dog", "a dog chasing a cat"),
+    ("a dog riding a horse", "a horse riding a dog"),
+    ("a blue dragon", "a red dragon"),
+    ("a dragon house", "a house dragon"),
+])
+def test_different_descriptions_stay_apart(first, second):
+    assert prompt_cache.normalize_description(first) != prompt_cache.normalize_description(second)
+
+
+def test_singular_leaves_non_plurals_alone():
+    assert [prompt_cache.singular(word) for word in ('octopus', 'glass', 'bus', 'boxes', 'ponies', 'horses')] == \
+        ['octopus', 'glass', 'bus', 'box', 'pony', 'horse']
+
+
+def test_semantic_lookup_hits_the_same_generation(tmp_path, monkeypatch):
+    cache = prompt_cache.PromptCache(str(tmp_path / 'cache.db'), ttl=3600, semantic=True)
+    monkeypatch.setattr(prompt_cache, 'CACHE', cache)
+    client = VeniceAPI(api_key='test')
+
+    def semantic_key(description):
+        request = client.cache_request('text_to_image_for_kids', description=description, style='cartoon')
+        return client._semantic_key('text_to_image_for_kids', request)
+
+    client.cache_result('text_to_image_for_kids', {'images': ['abc'], 'id': 'gen-1'},
+                        child_name='Ann', description="A blue dragon!!", style='cartoon')
+
+    # The child's name isn't part of the key, so another child's near-identical wording hits too
+    for name in ('Ann', 'Bo'):
+        assert client.cached_result('text_to_image_for_kids', child_name=name, description="blue dragons",
+                                    style='cartoon') == {'images': ['abc'], 'id': 'gen-1'}
+    # The safety filter runs first, so filtered words match their replacements
+    assert semantic_key("a scary monster") == semantic_key("friendly creatures")
+    assert client.cached_result('text_to_image_for_kids', child_name='Bo', description="blue dragons",
+                                style='sketch') is None
+
+
+def test_entries_and_popularity_ignore_the_child_name(tmp_path, monkeypatch):
+    cache = prompt_cache.PromptCache(str(tmp_path / 'cache.db'), ttl=3600)
+    monkeypatch.setattr(prompt_cache, 'CACHE', cache)
+    client = VeniceAPI(api_key='test')
+
+    client.cache_result('generate_image', {'images': ['abc']}, child_name='Ann', animal='Dog', style='cartoon')
+    for name in ('Bo', 'Cy'):
+        assert client.cached_result('generate_image', child_name=name, animal='dog',
+                                    style='cartoon') == {'images': ['abc']}
+
+    # Lookups only read; their popularity bumps are written in one go
+    assert cache.popular() == []
+    cache.flush()
+    [entry] = cache.popular()
+    assert entry['score'] == pytest.approx(2, abs=0.01) and entry['cached_at'] is not None
+    assert 'Ann' not in entry['request'] and 'Bo' not in entry['request']
@@ -0,0 +1,40 @@
+"""
+Collection rarity engine, including a fresh install with no mints
+
+Run with pytest:
+
+    pytest test_rarity.py
+"""
+import rarity
+
+
+def _document(power, color='red'):
+    return {
+        'nft_traits': {'magical_power': power, 'special_ability': 'flying'},
+        'color_properties': {'brightness': 'medium', 'color_diversity': 'medium', 'dominant_colors': [color]}
+    }
+
+
+def test_empty_collection_has_empty_stats(tmp_path):
+    engine = rarity.RarityEngine(str(tmp_path / 'rarity.jsonl'))
+    stats = engine.stats()
+    assert stats['total'] == 0
+    assert stats['distinct_combinations'] == 0
+    assert stats['rarest_combinations'] == []
+    assert sum(stats['tiers'].values()) == 0
+    assert engine.rarity_of('a' * 64) is None
+
+
+def test_rare_traits_rank_first_and_mints_count_once(tmp_path):
+    path = str(tmp_path / 'rarity.jsonl')
+    engine = rarity.RarityEngine(path)
+    for i in range(9):
+        engine.record(f"common{i}", _document('fire'))
+    engine.record('rare', _document('cosmic', color='gold'))
+    engine.record('rare', _document('cosmic', color='gold'))
+
+    assert engine.total == 10
+    assert engine.rarity_of('rare')['rank'] == 1
+    assert engine.rarity_of('common0')['rank'] == 2
+    # Other processes replay the same log
+    assert rarity.RarityEngine(path).rarity_of('rare') == engine.rarity_of('rare')
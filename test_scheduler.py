@@ -0,0 +1,121 @@
+"""
+Fair scheduler behaviour: fairness, quotas, batch preemption and leases
+
+Run with pytest:
+
+    pytest test_scheduler.py
+"""
+import asyncio
+import signal
+import time
+import types
+
+import pytest
+
+import scheduler
+
+
+class Interrupted(BaseException):
+    """Stands in for KeyboardInterrupt or gevent.Timeout"""
+
+
+def idle(fair):
+    snapshot = fair.snapshot()
+    return snapshot['active'] == 0 and snapshot['queued'] == 0
+
+
+def test_light_identity_is_not_stuck_behind_a_heavy_one():
+    """A child asking for one image is served before a wallet's backlog, not after it"""
+    fair = scheduler.FairScheduler(capacity=1, per_identity=1, max_queued=10)
+    order = []
+
+    async def generate(identity):
+        async with fair.aslot(identity):
+            order.append(identity)
+            await asyncio.sleep(0)
+
+    async def main():
+        await asyncio.gather(*[generate('wallet') for _ in range(4)], generate('child'))
+
+    asyncio.run(main())
+    assert order == ['wallet', 'child', 'wallet', 'wallet', 'wallet']
+    assert idle(fair)
+
+
+def test_quota_retry_after_is_when_the_window_frees(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(scheduler, 'time', types.SimpleNamespace(time=lambda: clock[0], monotonic=time.monotonic))
+    fair = scheduler.FairScheduler(capacity=4, quotas=[(2, 60)])
+
+    for at in (1000.0, 1010.0):
+        clock[0] = at
+        with fair.slot('wallet'):
+            pass
+
+    clock[0] = 1030.0
+    with pytest.raises(scheduler.OverQuota) as error:
+        with fair.slot('wallet'):
+            pass
+    assert error.value.reason == 'quota' and error.value.status_code == 429
+    assert error.value.retry_after == pytest.approx(30)
+    assert scheduler.retry_after_header(error.value) == '30'
+
+    # Retrying after Retry-After succeeds, and the next limit comes from the 1010 admission
+    clock[0] = 1060.5
+    with fair.slot('wallet'):
+        pass
+    clock[0] = 1061.0
+    with pytest.raises(scheduler.OverQuota) as error:
+        with fair.slot('wallet'):
+            pass
+    assert error.value.retry_after == pytest.approx(9)
+
+
+def test_interactive_request_preempts_borrowed_batch_slot():
+    fair = scheduler.FairScheduler(capacity=2, per_identity=2, batch_share=0)
+
+    with fair.slot('prewarm', 'batch') as first, fair.slot('prewarm', 'batch') as second:
+        # Every slot is busy with batch work; the interactive request doesn't wait
+        with fair.slot('child') as lease:
+            assert lease.granted
+            assert second.preempted and not first.preempted
+            assert fair.snapshot()['active'] == 2
+    assert idle(fair)
+    assert fair.snapshot()['borrowed_batch_slots'] == 0
+
+
+def test_leases_are_released_on_errors_timeouts_and_interrupts():
+    fair = scheduler.FairScheduler(capacity=1, per_identity=1, queue_timeout=0.05)
+
+    with pytest.raises(RuntimeError):
+        with fair.slot('child'):
+            raise RuntimeError("Venice said no")
+    assert idle(fair)
+
+    def interrupt(signum, frame):
+        raise Interrupted()
+
+    previous = signal.signal(signal.SIGALRM, interrupt)
+    try:
+        with fair.slot('wallet'):
+            # Nobody releases in time: the waiter withdraws instead of holding a place
+            with pytest.raises(scheduler.OverQuota) as error:
+                with fair.slot('child'):
+                    pass
+            assert error.value.reason == 'timeout'
+
+            # An interrupted wait withdraws its lease too
+            fair.queue_timeout['interactive'] = 5
+            signal.setitimer(signal.ITIMER_REAL, 0.05)
+            with pytest.raises(Interrupted):
+                with fair.slot('child'):
+                    pass
+            assert fair.snapshot()['queued'] == 0
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+    # Nothing was left behind to be granted the freed slot
+    assert idle(fair)
+    with fair.slot('child') as lease:
+        assert lease.granted
@@ -0,0 +1,69 @@
+"""
+Cold-start budget for the KryptoKids API
+
+Workers are scaled on demand, so the time to import the app bounds how fast
+we absorb a traffic spike. Run with pytest or directly:
+
+    python test_startup.py
+
+Set IMPORT_BUDGET_MS to tighten or relax the budget for slower machines.
+"""
+import os
+import subprocess
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Measured at roughly 200ms on a laptop, almost all of it Flask/Werkzeug
+IMPORT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', 400))
+
+# Modules that must not be loaded until a request actually needs them
+DEFERRED_MODULES = ['requests', 'validators', 'PIL', 'httpx', 'boto3', 'redis']
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import app
+elapsed_ms = (time.perf_counter() - start) * 1000
+print(json.dumps({
+    'elapsed_ms': elapsed_ms,
+    'loaded': [name for name in %r if name in sys.modules],
+}))
+""" % (DEFERRED_MODULES,)
+
+
+def measure_import(runs=3):
+    """
+    Import the app in fresh interpreters and report the fastest run
+    
+    Returns:
+        dict: elapsed_ms and the deferred modules that were loaded anyway
+    """
+    import json
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE],
+            cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return min(results, key=lambda result: result['elapsed_ms'])
+
+
+def test_heavy_imports_are_deferred():
+    """Importing the app must not pull in request-time dependencies"""
+    result = measure_import(runs=1)
+    assert result['loaded'] == [], f"Loaded at import time: {result['loaded']}"
+
+
+def test_import_time_budget():
+    """Importing the app must fit in the cold-start budget"""
+    result = measure_import()
+    print(f"app import: {result['elapsed_ms']:.1f}ms (budget {IMPORT_BUDGET_MS:.0f}ms)")
+    assert result['elapsed_ms'] < IMPORT_BUDGET_MS
+
+
+if __name__ == "__main__":
+    result = measure_import()
+    print(f"app import: {result['elapsed_ms']:.1f}ms (budget {IMPORT_BUDGET_MS:.0f}ms)")
+    print(f"Deferred modules loaded at import: {result['loaded'] or 'none'}")
@@ -0,0 +1,128 @@
+"""
+Image storage, checked against an in-memory object storage stand-in
+
+Covers the bounded uploader and its inline fallback, and reads that prefer
+the local copy and fall back to the bucket for files another node wrote (or
+the janitor evicted). Run with pytest:
+
+    pytest test_storage.py
+"""
+import io
+import os
+import threading
+
+import pytest
+
+import gallery
+import metadata_store
+import settings
+import storage
+
+
+class FakeObjectStorage:
+    """Stands in for S3Storage: same interface, objects kept in a dict"""
+
+    remote = True
+
+    def __init__(self, gate=None):
+        self.objects = {}
+        self.gate = gate
+
+    def put_file(self, key, path):
+        if self.gate is not None:
+            self.gate.wait(5)
+        with open(path, 'rb') as f:
+            self.objects[key] = f.read()
+
+    def get_bytes(self, key):
+        return self.objects[key]
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = FakeObjectStorage()
+    monkeypatch.setattr(storage, 'BACKEND', backend)
+    monkeypatch.setattr(storage, 'UPLOADER', storage.Uploader(backend, max_workers=1, max_pending=1))
+    return backend
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_uploader_rejects_submissions_beyond_max_pending(tmp_path):
+    """Only max_pending uploads may be queued or running at once"""
+    gate = threading.Event()
+    backend = FakeObjectStorage(gate)
+    uploader = storage.Uploader(backend, max_workers=1, max_pending=2)
+    path = write(str(tmp_path / 'a.png'), b'a')
+
+    uploader.submit('generated_images/a.png', path)
+    uploader.submit('generated_images/b.png', path)
+    with pytest.raises(storage.UploadQueueFull):
+        uploader.submit('generated_images/c.png', path)
+
+    gate.set()
+    uploader.shutdown(wait=True)
+    assert sorted(backend.objects) == ['generated_images/a.png', 'generated_images/b.png']
+    assert uploader.snapshot()['pending_uploads'] == 0
+
+
+def test_offload_uploads_inline_when_the_queue_is_full(backend, tmp_path):
+    """A full uploader queue doesn't leave the file behind"""
+    gate = threading.Event()
+    backend.gate = gate
+    first = write(str(tmp_path / 'first.png'), b'first')
+    storage.offload('generated_images/first.png', first)
+
+    backend.gate = None
+    second = write(str(tmp_path / 'second.png'), b'second')
+    storage.offload('generated_images/second.png', second)
+    assert backend.objects['generated_images/second.png'] == b'second'
+
+    gate.set()
+    storage.UPLOADER.shutdown(wait=True)
+    assert backend.objects['generated_images/first.png'] == b'first'
+
+
+def test_read_prefers_the_local_copy_and_falls_back_to_the_bucket(backend, tmp_path):
+    path = write(str(tmp_path / 'generated_images' / 'cat.png'), b'local')
+    key = storage.path_key(path)
+    assert key == 'generated_images/cat.png'
+    backend.objects[key] = b'remote'
+
+    assert storage.read(key, path) == b'local'
+    with storage.open_file(key, path) as f:
+        assert f.read() == b'local'
+
+    os.remove(path)
+    assert storage.read(key, path) == b'remote'
+    with storage.open_file(key, path) as f:
+        assert f.read() == b'remote'
+
+    del backend.objects[key]
+    assert storage.read(key, path) is None
+    with pytest.raises(FileNotFoundError):
+        storage.open_file(key, path)
+
+
+def test_thumbnail_of_an_evicted_image_is_built_from_the_bucket(backend, tmp_path, monkeypatch):
+    from PIL import Image
+    image = io.BytesIO()
+    Image.new('RGB', (64, 64), 'red').save(image, 'PNG')
+    backend.objects['generated_images/cat.png'] = image.getvalue()
+
+    store = metadata_store.MetadataStore(str(tmp_path / 'metadata.db'))
+    monkeypatch.setattr(metadata_store, 'STORE', store)
+    monkeypatch.setattr(settings, 'THUMBNAIL_DIR', str(tmp_path / 'thumbnails'))
+    store.record('generation', wait=True, holdjar_id='0xabc', content_hash='c' * 64,
+                 file_path=str(tmp_path / 'generated_images' / 'cat.png'))
+    item_id = store.recent(limit=1)[0]['id']
+
+    path = gallery.thumbnail_path(item_id)
+    assert path is not None
+    with Image.open(path) as thumbnail:
+        assert thumbnail.format == 'JPEG'
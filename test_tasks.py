@@ -0,0 +1,91 @@
+"""
+Background task runner, checked against a throwaway result directory
+
+Covers the bounded queue (and the inline fallback callers take when it is
+full), failure reporting, and task status persisted for polls that land on
+another worker. Run with pytest:
+
+    pytest test_tasks.py
+"""
+import threading
+import time
+
+import pytest
+
+import tasks
+
+
+@pytest.fixture
+def runner(tmp_path):
+    runner = tasks.TaskRunner(max_workers=1, max_pending=2, result_ttl=60, result_dir=str(tmp_path / 'tasks'))
+    yield runner
+    runner.shutdown(wait=True)
+
+
+def wait_for(runner, task_id, status, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        task = runner.get(task_id)
+        if task and task['status'] == status:
+            return task
+        time.sleep(0.01)
+    raise AssertionError(f"task {task_id} never reached {status}")
+
+
+def test_submit_beyond_max_pending_raises_and_frees_up_once_tasks_finish(runner):
+    gate = threading.Event()
+    first = runner.submit('slow', gate.wait, 5)
+    runner.submit('slow', gate.wait, 5)
+    with pytest.raises(tasks.TaskQueueFull):
+        runner.submit('slow', gate.wait, 5)
+    assert runner.snapshot()['pending'] == 2
+
+    gate.set()
+    wait_for(runner, first.id, 'succeeded')
+    runner.shutdown(wait=True)
+    assert runner.snapshot()['pending'] == 0
+
+
+def test_full_queue_makes_post_processing_run_inline(runner, monkeypatch):
+    """_defer_post_processing hands back None so the view saves and analyzes the image itself"""
+    import app
+    from image_artifact import ImageArtifact
+
+    runner.max_pending = 0
+    monkeypatch.setattr(tasks, 'RUNNER', runner)
+    artifact = ImageArtifact('aGVsbG8=')
+    assert app._defer_post_processing(None, artifact, 'x.png', {}) is None
+    # Decoded up front, as it would have been for the task
+    assert artifact._data == b'hello'
+
+
+def test_failed_task_reports_its_error(runner):
+    def fail():
+        raise ValueError("no images were generated")
+
+    task = runner.submit('text_to_image_post_processing', fail)
+    status = wait_for(runner, task.id, 'failed')
+    assert status['error'] == "no images were generated"
+    assert status['result'] is None and status['finished'] is not None
+    assert runner.snapshot()['failed'] == 1
+
+
+def test_status_is_persisted_for_other_workers(runner):
+    """A poll on another worker process sees the task while it runs and after it finishes"""
+    other_worker = tasks.TaskRunner(max_workers=1, max_pending=1, result_ttl=60, result_dir=runner.result_dir)
+    gate = threading.Event()
+
+    task = runner.submit('save', lambda: gate.wait(5) and {'image_url': '/generated_images/a.png'})
+    deadline = time.monotonic() + 5
+    while (other_worker.get(task.id) or {}).get('status') != 'running':
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+    gate.set()
+    status = wait_for(other_worker, task.id, 'succeeded')
+    assert status['result'] == {'image_url': '/generated_images/a.png'}
+
+
+def test_unknown_or_malformed_ids_are_not_found(runner):
+    assert runner.get('0' * tasks.TASK_ID_LENGTH) is None
+    assert runner.get('../../etc/passwd') is None
@@ -0,0 +1,543 @@
+"""
+NFT trait computation
+
+Traits are derived from the image content: every "random" trait is drawn
+from a generator seeded with the SHA-256 of the decoded image bytes, so
+re-analyzing the same image always gives the same document. The exception is
+uniqueness_factor, which measures the perceptual distance to the closest image
+already in the collection (see phash.py) at the time the image is first
+analyzed. Rarity likewise becomes a collection-wide statistic once enough
+images have been minted (see rarity.py); only record_mint() adds an image to
+those statistics, analysis itself is read-only. The first trait document for a
+hash is stored in the metadata database and served to every later analysis,
+so the collection-dependent fields don't drift after a restart or on another
+worker; the complete document is also memoized in a bounded LRU cache keyed by
+that hash, so mint retries, metadata refreshes and gallery rebuilds cost a
+hash instead of a Pillow decode.
+
+VeniceAPI.analyze_image_for_traits delegates here; batch tools can call
+analyze_image_bytes() directly without a Venice API key.
+"""
+import base64
+import copy
+import hashlib
+import random
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import metrics
+import settings
+
+RARITY_VALUES = ["common", "uncommon", "rare", "epic", "legendary"]
+MAGICAL_POWERS = ["fire", "water", "earth", "air", "cosmic", "nature", "tech", "rainbow"]
+SPECIAL_ABILITIES = [
+    "flying", "invisibility", "super speed", "telepathy",
+    "teleportation", "shape shifting", "healing", "time control"
+]
+
+GENERATOR = "KryptoKids Magic Drawing Creator"
+VERSION = "1.0.0"
+
+
+class TraitCache:
+    """Thread-safe LRU cache of trait documents keyed by content hash"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = metrics.CacheStats('traits', size_fn=lambda: len(self._entries))
+
+    def get(self, key):
+        with self._lock:
+            traits = self._entries.get(key)
+            if traits is not None:
+                self._entries.move_to_end(key)
+        if traits is None:
+            self.stats.miss()
+            return None
+        self.stats.hit()
+        # Hand out copies so callers can't mutate the cached document
+        return copy.deepcopy(traits)
+
+    def put(self, key, traits):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = copy.deepcopy(traits)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+TRAIT_CACHE = TraitCache(settings.TRAIT_CACHE_SIZE)
+
+
+def content_hash(image_data):
+    """
+    Hash decoded image bytes
+
+    Args:
+        image_data (bytes): Raw image file bytes
+
+    Returns:
+        str: Hex SHA-256 digest
+    """
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def decode_base64_image(base64_image):
+    """Decode a base64 image, with or without a data URL prefix"""
+    # Remove data URL prefix if present
+    if ',' in base64_image:
+        base64_image = base64_image.split(',')[1]
+    with metrics.IMAGE_STAGE.time(stage='base64_decode'):
+        return base64.b64decode(base64_image)
+
+
+def _timestamp():
+    """Get current timestamp in ISO format"""
+    from datetime import datetime
+    return datetime.now().isoformat()
+
+
+def _metadata(digest):
+    return {
+        "timestamp": _timestamp(),
+        "generator": GENERATOR,
+        "version": VERSION,
+        "content_hash": digest
+    }
+
+
+def _seeded_rng(digest):
+    """Random generator seeded from the image content hash"""
+    return random.Random(int(digest[:16], 16))
+
+
+def analyze_base64_image(base64_image):
+    """
+    Compute (or fetch memoized) traits for a base64 encoded image
+
+    Args:
+        base64_image (str): Base64 encoded image, optionally a data URL
+
+    Returns:
+        dict: Dictionary containing image traits suitable for NFT metadata
+    """
+    try:
+        image_data = decode_base64_image(base64_image)
+    except Exception as e:
+        print(f"Error decoding image: {str(e)}")
+        # Still deterministic: seed from the payload we were given
+        return fallback_traits(content_hash(base64_image.encode('utf-8')))
+    return analyze_image_bytes(image_data)
+
+
+def analyze_image_bytes(image_data, digest=None):
+    """
+    Compute (or fetch memoized) traits for raw image bytes
+
+    Args:
+        image_data (bytes): Raw image file bytes
+        digest (str): Precomputed content_hash(image_data), if the caller has it
+
+    Returns:
+        dict: Dictionary containing image traits suitable for NFT metadata
+    """
+    digest = digest or content_hash(image_data)
+    cached = TRAIT_CACHE.get(digest)
+    if cached is not None:
+        return cached
+
+    traits = _stored_traits(digest)
+    if traits is None:
+        try:
+            traits = _store_traits(digest, compute_traits(image_data, digest))
+        except Exception as e:
+            print(f"Error analyzing image: {str(e)}")
+            # Return basic traits if analysis fails (not cached - the failure may be transient)
+            return fallback_traits(digest)
+
+    TRAIT_CACHE.put(digest, traits)
+    return traits
+
+
+def analyze_artifact(artifact):
+    """
+    Compute (or fetch memoized) traits for an ImageArtifact
+
+    Reuses the artifact's decoded bytes, content hash, opened image and
+    analysis view instead of decoding the image again.
+
+    Args:
+        artifact (ImageArtifact): Image to analyze
+
+    Returns:
+        dict: Dictionary containing image traits suitable for NFT metadata
+    """
+    try:
+        digest = artifact.content_hash
+    except Exception as e:
+        print(f"Error decoding image: {str(e)}")
+        # Still deterministic: seed from the payload we were given
+        return fallback_traits(content_hash(artifact.base64.encode('utf-8')))
+
+    cached = TRAIT_CACHE.get(digest)
+    if cached is not None:
+        return cached
+
+    traits = _stored_traits(digest)
+    if traits is None:
+        try:
+            traits = _store_traits(digest, compute_traits(artifact.data, digest, artifact=artifact))
+        except Exception as e:
+            print(f"Error analyzing image: {str(e)}")
+            return fallback_traits(digest)
+
+    TRAIT_CACHE.put(digest, traits)
+    return traits
+
+
+def _stored_traits(digest):
+    """The trait document persisted for a content hash, or None"""
+    try:
+        import metadata_store
+        return metadata_store.STORE.trait_document(digest)
+    except Exception as e:
+        print(f"Error reading stored traits: {str(e)}")
+        return None
+
+
+def _store_traits(digest, traits, replace=False):
+    """
+    Persist a trait document; the first one stored for a hash wins
+
+    uniqueness_factor (and rarity) depend on the collection when the image is
+    first analyzed, so later analyses, on any worker or after a restart,
+    serve the stored document instead of recomputing a different one.
+    """
+    try:
+        import metadata_store
+        return metadata_store.STORE.store_trait_document(digest, traits, replace=replace) or traits
+    except Exception as e:
+        print(f"Error storing traits: {str(e)}")
+        return traits
+
+
+def compute_traits(image_data, digest, artifact=None):
+    """
+    Analyze an image and build its trait document (no caching)
+
+    Args:
+        image_data (bytes): Raw image file bytes
+        digest (str): content_hash(image_data), used as the trait seed
+        artifact (ImageArtifact): Optional artifact whose opened image and
+            analysis view are reused
+
+    Returns:
+        dict: Dictionary containing image traits suitable for NFT metadata
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        print("PIL not installed. Image analysis functionality will be limited.")
+        raise
+
+    # Open the image - pixels are decoded later, at analysis size
+    if artifact is not None:
+        image = artifact.image
+    else:
+        with metrics.IMAGE_STAGE.time(stage='decode'):
+            image = Image.open(BytesIO(image_data))
+
+    # Extract image properties (before the analysis view, which may draft JPEGs in place)
+    width, height = image.size
+    format_type = image.format
+
+    # Calculate color statistics if possible
+    color_properties = {
+        "dominant_colors": [],
+        "brightness": "medium",
+        "color_diversity": "medium"
+    }
+
+    try:
+        with metrics.IMAGE_STAGE.time(stage='color_analysis'):
+            view = artifact.analysis_view if artifact is not None else None
+            color_properties = color_properties_for(image, view=view)
+    except Exception as e:
+        print(f"Error analyzing image colors: {str(e)}")
+
+    brightness = color_properties["brightness"]
+    color_diversity = color_properties["color_diversity"]
+
+    # Generate seeded trait values for properties that can't be directly extracted
+    rng = _seeded_rng(digest)
+    rarity_weights = [50, 30, 15, 4, 1]  # Probability weights
+
+    # Generate rarity based on color properties
+    if color_diversity == "high" and brightness == "bright":
+        rarity_weights = [30, 35, 20, 10, 5]  # Higher chance of better rarity
+    elif color_diversity == "low" and brightness == "dark":
+        rarity_weights = [60, 25, 10, 4, 1]  # Lower chance of better rarity
+
+    # Seeded rarity; replaced by the collection-wide tier once the collection is big enough
+    rarity = rng.choices(RARITY_VALUES, weights=rarity_weights, k=1)[0]
+    creativity_score = rng.randint(1, 100)
+    # Still drawn when the index is available, so the traits after it don't shift
+    seeded_uniqueness = rng.randint(1, 100)
+    uniqueness = _collection_uniqueness(image, digest)
+
+    # Compile traits
+    trait_document = {
+        "image_properties": {
+            "width": width,
+            "height": height,
+            "format": format_type,
+            "aspect_ratio": round(width / height, 2)
+        },
+        "color_properties": color_properties,
+        "nft_traits": {
+            "rarity": rarity,
+            "creativity_score": creativity_score,
+            "uniqueness_factor": seeded_uniqueness if uniqueness is None else uniqueness,
+            "magical_power": rng.choice(MAGICAL_POWERS),
+            "special_ability": rng.choice(SPECIAL_ABILITIES)
+        },
+        "metadata": _metadata(digest)
+    }
+
+    _apply_rarity(trait_document, _collection_rarity(digest))
+    return trait_document
+
+
+def _apply_rarity(trait_document, collection_rarity):
+    """Attach an image's collection-wide rarity to its trait document"""
+    if collection_rarity is None:
+        return
+    trait_document["rarity"] = collection_rarity
+    # Too few mints for percentiles to mean much; keep the seeded rarity until then
+    if collection_rarity["collection_size"] >= settings.RARITY_MIN_COLLECTION:
+        trait_document["nft_traits"]["rarity"] = collection_rarity["tier"]
+
+
+def _collection_rarity(digest):
+    """
+    Current rarity of an image if it has been minted (read-only)
+
+    Args:
+        digest (str): content_hash of the image bytes
+
+    Returns:
+        dict: score, rank, percentile, tier and collection_size, or None if the
+        image isn't minted or the lookup failed
+    """
+    try:
+        import rarity
+        return rarity.get_engine().rarity_of(digest)
+    except Exception as e:
+        print(f"Error computing collection rarity: {str(e)}")
+        return None
+
+
+def index_image(image, digest):
+    """
+    Add an image to the perceptual-hash index used for uniqueness and duplicates
+
+    Analysis only looks the index up; the write paths (drawing uploads and
+    generations) call this, so exports and library scans don't fill it.
+
+    Args:
+        image (PIL.Image.Image): Opened image
+        digest (str): content_hash of the image bytes
+    """
+    try:
+        import phash
+        with metrics.IMAGE_STAGE.time(stage='phash'):
+            phash.get_index().add(phash.dhash(image), digest)
+    except Exception as e:
+        print(f"Error indexing perceptual hash: {str(e)}")
+
+
+def record_mint(digest, trait_document, image=None):
+    """
+    Count a minted image in the collection rarity tables (and the phash index)
+
+    Analysis never changes the collection statistics; only the mint paths
+    call this, so exports and library scans of uploads don't skew rarity.
+
+    Args:
+        digest (str): content_hash of the image bytes
+        trait_document (dict): The image's trait document
+        image (PIL.Image.Image): Opened image to add to the perceptual-hash index
+
+    Returns:
+        dict: The trait document with the image's current collection rarity
+    """
+    if image is not None:
+        index_image(image, digest)
+    try:
+        import rarity
+        engine = rarity.get_engine()
+        engine.record(digest, trait_document)
+        collection_rarity = engine.rarity_of(digest)
+    except Exception as e:
+        print(f"Error recording mint for rarity: {str(e)}")
+        return trait_document
+    if "rarity" not in trait_document:
+        # The document as minted is the one every later analysis serves
+        _apply_rarity(trait_document, collection_rarity)
+        trait_document = _store_traits(digest, trait_document, replace=True)
+    TRAIT_CACHE.put(digest, trait_document)
+    return trait_document
+
+
+def _collection_uniqueness(image, digest):
+    """
+    Score how far an image is from its nearest perceptual neighbour (read-only)
+
+    Args:
+        image (PIL.Image.Image): Opened image
+        digest (str): content_hash of the image bytes (the image itself is excluded)
+
+    Returns:
+        int: 1-100 uniqueness, or None if the image couldn't be hashed or looked up
+    """
+    try:
+        import phash
+        with metrics.IMAGE_STAGE.time(stage='phash'):
+            value = phash.dhash(image)
+            match = phash.get_index().nearest(value, phash.UNIQUENESS_RADIUS, exclude=digest)
+    except Exception as e:
+        print(f"Error computing perceptual uniqueness: {str(e)}")
+        return None
+    return phash.uniqueness_factor(match[0] if match else None)
+
+
+def fallback_traits(digest):
+    """Basic seeded traits used when the image can't be analyzed"""
+    rng = _seeded_rng(digest)
+    return {
+        "nft_traits": {
+            "rarity": rng.choice(["common", "uncommon", "rare"]),
+            "creativity_score": rng.randint(1, 100),
+            "uniqueness_factor": rng.randint(1, 100),
+            "magical_power": rng.choice(["fire", "water", "earth", "air", "cosmic"]),
+            "special_ability": rng.choice(["flying", "invisibility", "super speed", "healing"])
+        },
+        "metadata": _metadata(digest)
+    }
+
+
+def color_properties_for(image, view=None):
+    """
+    Color traits for an opened (not yet loaded) image
+
+    Uses the NumPy analysis in image_analysis.py on a downsampled copy;
+    falls back to channel means from ImageStat when NumPy is missing.
+
+    Args:
+        image (PIL.Image.Image): Image to analyze
+        view (PIL.Image.Image): Precomputed analysis view, if the caller has one
+
+    Returns:
+        dict: dominant_colors, brightness and color_diversity, plus palette,
+        saturation, brightness distribution and edge density when available
+    """
+    try:
+        import image_analysis
+    except ImportError:
+        print("NumPy not installed. Falling back to basic color analysis.")
+    else:
+        return image_analysis.analyze_colors(image, view=view)["color_properties"]
+
+    from PIL import ImageStat
+
+    # Convert to RGB if not already
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    # Get image stats
+    stat = ImageStat.Stat(image)
+    r, g, b = stat.mean
+
+    # Calculate brightness
+    brightness_value = (r + g + b) / 3
+    if brightness_value < 85:
+        brightness = "dark"
+    elif brightness_value > 170:
+        brightness = "bright"
+    else:
+        brightness = "medium"
+
+    # Determine dominant color palette
+    dominant_colors = []
+    if r > g and r > b:
+        dominant_colors.append("red")
+    elif g > r and g > b:
+        dominant_colors.append("green")
+    elif b > r and b > g:
+        dominant_colors.append("blue")
+
+    if abs(r - g) < 20 and abs(r - b) < 20 and abs(g - b) < 20:
+        dominant_colors.append("balanced")
+
+    # Calculate color diversity using standard deviation
+    r_std, g_std, b_std = stat.stddev
+    color_diversity_value = (r_std + g_std + b_std) / 3
+
+    if color_diversity_value < 50:
+        color_diversity = "low"
+    elif color_diversity_value > 100:
+        color_diversity = "high"
+    else:
+        color_diversity = "medium"
+
+    return {
+        "dominant_colors": dominant_colors,
+        "brightness": brightness,
+        "color_diversity": color_diversity
+    }
+
+
+def erc721_metadata(trait_document, name, image_url, description=None):
+    """
+    Build ERC-721 style token metadata from a trait document
+
+    Args:
+        trait_document (dict): Output of analyze_image_bytes / analyze_base64_image
+        name (str): Token name
+        image_url (str): URL of the image
+        description (str): Optional token description
+
+    Returns:
+        dict: Metadata with `attributes` for marketplaces plus the full trait document
+    """
+    attributes = []
+    for trait_type, value in trait_document.get("nft_traits", {}).items():
+        attribute = {"trait_type": trait_type, "value": value}
+        if isinstance(value, (int, float)):
+            attribute["display_type"] = "number"
+            attribute["max_value"] = 100
+        attributes.append(attribute)
+
+    color_properties = trait_document.get("color_properties", {})
+    for trait_type in ("brightness", "color_diversity"):
+        if trait_type in color_properties:
+            attributes.append({"trait_type": trait_type, "value": color_properties[trait_type]})
+    for color in color_properties.get("dominant_colors", []):
+        attributes.append({"trait_type": "dominant_color", "value": color})
+
+    return {
+        "name": name,
+        "description": description or f"{name} - a {GENERATOR} original",
+        "image": image_url,
+        "attributes": attributes,
+        "properties": trait_document
+    }
@@ -1,25 +1,146 @@
 import os
-import requests
-import base64
-import random
-from io import BytesIO
-from dotenv import load_dotenv
-try:
-    from PIL import Image, ImageStat
-except ImportError:
-    print("PIL not installed. Image analysis functionality will be limited.")
+import threading
+import time
+from contextlib import contextmanager
+import metrics
+import prompt_cache
+import settings
+import stage_timer
+import storage
+import traits
+from image_artifact import ImageArtifact, as_artifact
+from settings import VENICE_API_KEY
 
-# Load environment variables
-load_dotenv()
+# requests and Pillow are imported inside the methods that use them so that
+# importing this module (and therefore starting a worker) stays cheap
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling Venice while the circuit breaker is open; retry_after is in seconds"""
+    
+    status_code = 503
+    
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stop calling Venice after repeated failures and probe again after a cooldown
+    
+    closed     calls go through; consecutive failures are counted
+    open       calls fail fast with CircuitOpenError until reset_timeout passes
+    half_open  one probe call is let through; success closes, failure re-opens.
+               A probe that never reports back is replaced after reset_timeout
+    """
+    
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+        self._lock = threading.Lock()
+    
+    def before_call(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'half_open':
+                # A probe is already in flight; everyone else keeps failing fast
+                if now - self.probe_started_at < self.reset_timeout:
+                    raise CircuitOpenError("Venice API is unavailable",
+                                           self.reset_timeout - (now - self.probe_started_at))
+            elif self.state == 'open':
+                if now - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError("Venice API is unavailable", self.reset_timeout - (now - self.opened_at))
+            else:
+                return
+            self.state = 'half_open'
+            self.probe_started_at = now
+    
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.consecutive_failures = 0
+    
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+    
+    def snapshot(self):
+        with self._lock:
+            snapshot = {'state': self.state, 'consecutive_failures': self.consecutive_failures}
+            if self.state == 'open':
+                snapshot['retry_in_seconds'] = round(
+                    max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at)), 1)
+            return snapshot
+
+
+VENICE_CIRCUIT = CircuitBreaker(settings.VENICE_CIRCUIT_FAILURES, settings.VENICE_CIRCUIT_RESET_SECONDS)
+metrics.register_status_provider('circuit', VENICE_CIRCUIT.snapshot)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Shared requests.Session so Venice calls reuse pooled keep-alive connections
+    
+    Returns:
+        requests.Session: Process-wide session with a pool of VENICE_POOL_SIZE connections
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.VENICE_POOL_SIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def connection_pool_stats():
+    """
+    Report connection usage of the shared session without touching the network
+    
+    Returns:
+        dict: Pool size plus connections checked out and idle across hosts
+    """
+    stats = {'max_size': settings.VENICE_POOL_SIZE, 'in_use': 0, 'idle': 0}
+    if _session is None:
+        return stats
+    adapter = _session.get_adapter(VeniceAPI.API_BASE_URL)
+    pools = adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is None or pool.pool is None:
+            continue
+        # The pool queue holds idle connections plus None placeholders for unused slots
+        available = pool.pool.qsize()
+        stats['in_use'] += pool.pool.maxsize - available
+        stats['idle'] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+    return stats
+
+
+metrics.register_status_provider('connection_pool', connection_pool_stats)
 
-# Get API key from environment variables
-VENICE_API_KEY = os.getenv('VENICE_API_KEY')
 
 class VeniceAPI:
     """
     Class to interact with Venice AI's image generation API
     """
     API_BASE_URL = "https://api.venice.ai/api/v1"
+    ASYNC_TIMEOUT = 120  # Seconds; generations routinely take 10+ seconds
     
     def __init__(self, api_key=None):
         """
@@ -32,22 +153,38 @@ class VeniceAPI:
         if not self.api_key:
             raise ValueError("Venice API key not found. Set the VENICE_API_KEY environment variable.")
     
-    def generate_image(self, prompt, style='photorealistic', source_image_base64=None, 
-                       negative_prompt=None, width=1024, height=1024):
+    @contextmanager
+    def _track_upstream(self, method, payload):
         """
-        Generate an image based on the provided prompt and parameters
+        Guard and instrument one Venice call: circuit breaker, metrics and stage timer
         
         Args:
-            prompt (str): Description of the image to generate
-            style (str): Style of the generated image - 'photorealistic' or 'cartoon'
-            source_image_base64 (str): Base64 encoded source image (optional)
-            negative_prompt (str): What not to include in the image (optional)
-            width (int): Width of the generated image
-            height (int): Height of the generated image
-            
-        Returns:
-            dict: Response from the Venice API containing the generated image(s)
+            method (str): Name of the calling method
+            payload (dict): Request payload (for the model label)
         """
+        VENICE_CIRCUIT.before_call()
+        with metrics.upstream_call(method, payload['model']) as call, stage_timer.stage('upstream'):
+            try:
+                yield call
+            except BaseException:
+                # Including cancellation and timeouts, so a dying probe can't leave the circuit half open
+                VENICE_CIRCUIT.record_failure()
+                raise
+        # Rate limiting and server errors mean Venice is struggling; 4xx means a bad request
+        if call.status == 429 or (isinstance(call.status, int) and call.status >= 500):
+            VENICE_CIRCUIT.record_failure()
+        else:
+            VENICE_CIRCUIT.record_success()
+    
+    def _headers(self):
+        """Request headers with authentication"""
+        return {
+            'Authorization': f'Bearer {self.api_key}',
+            'Content-Type': 'application/json'
+        }
+    
+    def _generate_payload(self, prompt, style, negative_prompt, width, height):
+        """Build the /image/generate payload used by generate_image"""
         # Set the appropriate model and style_preset based on the desired style
         if style.lower() == 'photorealistic':
             model = "fluently-xl"
@@ -79,63 +216,96 @@ class VeniceAPI:
         # Remove inpainting for now as it appears to be causing issues
         # We'll focus on getting the basic text-to-image working first
         # The source image will be used for inspiration in the prompt instead
+        return payload
+    
+    async def _apost_generate(self, method, payload):
+        """
+        Async counterpart of post_generate
         
-        # Set up the headers with authentication
-        headers = {
-            'Authorization': f'Bearer {self.api_key}',
-            'Content-Type': 'application/json'
-        }
+        Args:
+            method (str): Name of the calling method, used to label metrics
+            payload (dict): Request payload for /image/generate
+            
+        Returns:
+            dict: Response from the Venice API
+        """
+        try:
+            import httpx
+        except ImportError:
+            raise RuntimeError("httpx is required for async Venice calls. Run: pip install httpx")
+        
+        with self._track_upstream(method, payload) as call:
+            # httpx connections belong to one event loop, and under WSGI Flask gives every
+            # async view a fresh loop, so there is no pool to share: these calls don't reuse
+            # connections and don't show up in connection_pool_stats()
+            async with httpx.AsyncClient(timeout=self.ASYNC_TIMEOUT) as client:
+                response = await client.post(
+                    f"{self.API_BASE_URL}/image/generate",
+                    headers=self._headers(),
+                    json=payload
+                )
+            call.status = response.status_code
+        
+        print(f"Venice API Response Status: {response.status_code}")
+        if response.status_code != 200:
+            error_detail = response.json() if response.text else "No error details provided"
+            print(f"Error details: {error_detail}")
+        
+        response.raise_for_status()
+        result = response.json()
+        metrics.observe_venice_timing(result)
+        return result
+    
+    async def agenerate_image(self, prompt, style='photorealistic', source_image_base64=None,
+                              negative_prompt=None, width=1024, height=1024):
+        """Async version of generate_image - same arguments and return value"""
+        payload = self._generate_payload(prompt, style, negative_prompt, width, height)
+        print(f"Making async request to Venice API with payload structure: {list(payload.keys())}")
+        return await self._apost_generate('generate_image', payload)
+    
+    def generate_image(self, prompt, style='photorealistic', source_image_base64=None, 
+                       negative_prompt=None, width=1024, height=1024):
+        """
+        Generate an image based on the provided prompt and parameters
+        
+        Args:
+            prompt (str): Description of the image to generate
+            style (str): Style of the generated image - 'photorealistic' or 'cartoon'
+            source_image_base64 (str): Base64 encoded source image (optional)
+            negative_prompt (str): What not to include in the image (optional)
+            width (int): Width of the generated image
+            height (int): Height of the generated image
+            
+        Returns:
+            dict: Response from the Venice API containing the generated image(s)
+        """
+        payload = self._generate_payload(prompt, style, negative_prompt, width, height)
         
         # Make the API request
         print(f"Making request to Venice API with payload structure: {list(payload.keys())}")
-        try:
-            response = requests.post(
-                f"{self.API_BASE_URL}/image/generate",
-                headers=headers,
-                json=payload
-            )
-            
-            # Log the response for debugging
-            print(f"Venice API Response Status: {response.status_code}")
-            print(f"Full response headers: {response.headers}")
-            
-            # Print full response for debugging
-            print(f"Venice API Response: {response.text[:200]}...")
-            
-            # Raise an exception for failed requests
-            if response.status_code != 200:
-                error_detail = response.json() if response.text else "No error details provided"
-                print(f"Error details: {error_detail}")
-                
-            response.raise_for_status()
-            
-            # Return the API response as JSON
-            return response.json()
-            
-        except requests.exceptions.RequestException as e:
-            print(f"Request Exception: {str(e)}")
-            raise
+        return self.post_generate('generate_image', payload)
     
     def build_prompt(self, child_name, animal, style='photorealistic'):
         """
         Build a prompt for image generation based on child's drawing metadata
         
         Args:
-            child_name (str): Name of the child
+            child_name (str): Name of the child, or None for a prompt made for no one (pre-warming)
             animal (str): Subject of the drawing (e.g., "dog")
             style (str): 'photorealistic' or 'cartoon'
             
         Returns:
             str: Crafted prompt for image generation
         """
+        drawing = f"a child's drawing made by {child_name}" if child_name else "a child's drawing"
         if style.lower() == 'photorealistic':
             return (f"A high-resolution detailed photorealistic image of a {animal}, "
-                   f"inspired by a child's drawing made by {child_name}. "
+                   f"inspired by {drawing}. "
                    f"The {animal} should be in a natural environment, with lifelike features, "
                    f"realistic fur/skin texture, and proper anatomical proportions.")
         else:
             return (f"A cute cartoon illustration of a {animal}, "
-                   f"inspired by a child's drawing made by {child_name}. "
+                   f"inspired by {drawing}. "
                    f"The {animal} should have exaggerated features, bright colors, "
                    f"and a playful expression in a fun, cartoon-style environment.")
     
@@ -145,7 +315,7 @@ class VeniceAPI:
         with appropriate guardrails and enhancements
         
         Args:
-            child_name (str): Name of the child
+            child_name (str): Name of the child, or None for a prompt made for no one (pre-warming)
             description (str): Child's description of what they want to draw
             style (str): 'cartoon', 'watercolor', or 'sketch'
             
@@ -176,9 +346,10 @@ class VeniceAPI:
             style_suffix = "in a cute cartoon style suitable for a children's book."
         
         # Combine elements into final prompt
+        audience = f"a child named {child_name}" if child_name else "a child"
         final_prompt = (f"{safety_prefix} "
                        f"A delightful illustration of {filtered_description}, "
-                       f"created in a style that a child named {child_name} would love, "
+                       f"created in a style that {audience} would love, "
                        f"{style_suffix}")
         
         # Add negative prompt elements when returning
@@ -222,22 +393,8 @@ class VeniceAPI:
         
         return filtered
     
-    def text_to_image_for_kids(self, child_name, description, style='cartoon',
-                            width=1024, height=1024, negative_prompt=None):
-        """
-        Generate a kid-friendly image from text description
-        
-        Args:
-            child_name (str): Name of the child
-            description (str): Child's description of what they want to draw
-            style (str): 'cartoon', 'watercolor', or 'sketch'
-            width (int): Width of the generated image
-            height (int): Height of the generated image
-            negative_prompt (str): Optional negative prompt to further guide generation
-            
-        Returns:
-            dict: Response from the Venice API containing the generated image(s)
-        """
+    def _kids_payload(self, child_name, description, style, width, height, negative_prompt):
+        """Build the /image/generate payload used by text_to_image_for_kids"""
         # Set the appropriate model and style_preset based on the desired style
         model = "fluently-xl"  # Using the same model as we use for other generation
         
@@ -245,7 +402,8 @@ class VeniceAPI:
         style_preset = None
         
         # Build a kid-friendly prompt with guardrails
-        prompt = self.build_kid_friendly_prompt(child_name, description, style)
+        with stage_timer.stage('build_prompt'):
+            prompt = self.build_kid_friendly_prompt(child_name, description, style)
         
         # Default negative prompt if none provided
         if negative_prompt is None:
@@ -270,23 +428,62 @@ class VeniceAPI:
         if style_preset:
             payload["style_preset"] = style_preset
         
-        # Set up the headers with authentication
-        headers = {
-            'Authorization': f'Bearer {self.api_key}',
-            'Content-Type': 'application/json'
-        }
+        return payload
+    
+    async def atext_to_image_for_kids(self, child_name, description, style='cartoon',
+                                      width=1024, height=1024, negative_prompt=None):
+        """Async version of text_to_image_for_kids - same arguments and return value"""
+        payload = self._kids_payload(child_name, description, style, width, height, negative_prompt)
+        print(f"Making async request to Venice API for kid's text-to-image with payload structure: {list(payload.keys())}")
+        return await self._apost_generate('text_to_image_for_kids', payload)
+    
+    def text_to_image_for_kids(self, child_name, description, style='cartoon',
+                            width=1024, height=1024, negative_prompt=None):
+        """
+        Generate a kid-friendly image from text description
+        
+        Args:
+            child_name (str): Name of the child
+            description (str): Child's description of what they want to draw
+            style (str): 'cartoon', 'watercolor', or 'sketch'
+            width (int): Width of the generated image
+            height (int): Height of the generated image
+            negative_prompt (str): Optional negative prompt to further guide generation
+            
+        Returns:
+            dict: Response from the Venice API containing the generated image(s)
+        """
+        payload = self._kids_payload(child_name, description, style, width, height, negative_prompt)
         
         # Make the API request
         print(f"Making request to Venice API for kid's text-to-image with payload structure: {list(payload.keys())}")
-        print(f"Prompt: {prompt}")
-        print(f"Negative prompt: {negative_prompt}")
+        print(f"Prompt: {payload['prompt']}")
+        print(f"Negative prompt: {payload['negative_prompt']}")
+        
+        return self.post_generate('text_to_image_for_kids', payload)
+    
+    def post_generate(self, method, payload):
+        """
+        POST a prepared payload to /image/generate
+        
+        Args:
+            method (str): Name of the calling method, used to label metrics
+            payload (dict): Request payload for /image/generate
+            
+        Returns:
+            dict: Response from the Venice API
+        """
+        headers = self._headers()
+        import requests
         
         try:
-            response = requests.post(
-                f"{self.API_BASE_URL}/image/generate",
-                headers=headers,
-                json=payload
-            )
+            with self._track_upstream(method, payload) as call:
+                response = get_session().post(
+                    f"{self.API_BASE_URL}/image/generate",
+                    headers=headers,
+                    json=payload
+                )
+                call.status = response.status_code
             
             # Log the response for debugging
             print(f"Venice API Response Status: {response.status_code}")
@@ -299,30 +496,104 @@ class VeniceAPI:
             response.raise_for_status()
             
             # Return the API response as JSON
-            return response.json()
+            result = response.json()
+            metrics.observe_venice_timing(result)
+            return result
             
         except requests.exceptions.RequestException as e:
             print(f"Request Exception: {str(e)}")
             raise
-
-    def inpaint_image(self, source_image_base64, prompt, object_target, inferred_object=None, 
-                     strength=50, model="fluently-xl", width=1024, height=1024):
+    
+    def cache_request(self, method, **kwargs):
         """
-        Perform inpainting on a source image with a defined mask
+        Name-free arguments that determine a cacheable call's image (see prompt_cache.py)
+        
+        The child's name only goes into the prompt built for Venice, so it
+        isn't part of the request: every child asking for the same animal or
+        description in the same style shares one cache entry.
         
         Args:
-            source_image_base64 (str): Base64 encoded source image to inpaint
-            prompt (str): Description of the image (including the changes that will be inpainted)
-            object_target (str): Element in the image to inpaint over (used to create the mask)
-            inferred_object (str, optional): Content to add via inpainting (replacing object_target)
-            strength (int): Strength of the inpainting (0-100)
-            model (str): Model to use for inpainting
-            width (int): Width of the generated image
-            height (int): Height of the generated image
+            method (str): 'generate_image' or 'text_to_image_for_kids'
+            **kwargs: animal (generate_image) or description, plus the optional
+                style, width, height and negative_prompt; child_name is ignored
             
         Returns:
-            dict: Response from the Venice API containing the inpainted image(s)
+            dict: The request
         """
+        default_style = 'photorealistic' if method == 'generate_image' else 'cartoon'
+        request = {
+            'style': kwargs.get('style', default_style).lower(),
+            'width': kwargs.get('width', 1024),
+            'height': kwargs.get('height', 1024),
+            'negative_prompt': kwargs.get('negative_prompt')
+        }
+        if method == 'generate_image':
+            request['animal'] = kwargs['animal'].strip().lower()
+        else:
+            # After the safety filter, the same text build_kid_friendly_prompt uses
+            request['description'] = self._filter_inappropriate_content(kwargs['description']).strip()
+        return request
+    
+    def cached_result(self, method, **kwargs):
+        """
+        Cached response for a generate_image / text_to_image_for_kids call (see prompt_cache.py)
+        
+        Args:
+            method (str): 'generate_image' or 'text_to_image_for_kids'
+            **kwargs: The call's arguments, see cache_request()
+            
+        Returns:
+            dict: The cached Venice response, or None if the call has to be made
+        """
+        if not prompt_cache.CACHE.enabled:
+            return None
+        request = self.cache_request(method, **kwargs)
+        return prompt_cache.CACHE.get(method, request, self._semantic_key(method, request))
+    
+    def cache_result(self, method, result, **kwargs):
+        """Store a fresh Venice response for the calls cached_result() answers with it"""
+        if not prompt_cache.CACHE.enabled:
+            return
+        request = self.cache_request(method, **kwargs)
+        prompt_cache.CACHE.put(method, request, result, self._semantic_key(method, request))
+    
+    def _semantic_key(self, method, request):
+        """
+        Cache key for near-identical kids' descriptions ("A blue dragon!!" == "blue dragons")
+        
+        Returns:
+            str: The key, or None when semantic caching is off or doesn't apply
+        """
+        if method != 'text_to_image_for_kids' or not prompt_cache.CACHE.semantic:
+            return None
+        return prompt_cache.CACHE.semantic_key(
+            method, request, description=prompt_cache.normalize_description(request['description']))
+    
+    def generate_for_request(self, method, request):
+        """
+        Make a cacheable call from its request alone, for the pre-warmer
+        
+        There's no child to name, so the prompt is built without one.
+        
+        Args:
+            method (str): 'generate_image' or 'text_to_image_for_kids'
+            request (dict): See cache_request()
+            
+        Returns:
+            dict: Response from the Venice API
+        """
+        if method == 'generate_image':
+            prompt = self.build_prompt(None, request['animal'], request['style'])
+            payload = self._generate_payload(prompt, request['style'], request['negative_prompt'],
+                                             request['width'], request['height'])
+        else:
+            payload = self._kids_payload(None, request['description'], request['style'], request['width'],
+                                         request['height'], request['negative_prompt'])
+        return self.post_generate(method, payload)
+
+    def _inpaint_payload(self, source_image_base64, prompt, object_target, inferred_object,
+                         strength, model, width, height):
+        """Build the /image/generate payload used by inpaint_image"""
         # Validate source image
         if not source_image_base64 or not isinstance(source_image_base64, str):
             raise ValueError("Source image must be provided as a base64 string")
@@ -356,199 +627,75 @@ class VeniceAPI:
         if inferred_object:
             payload["inpaint"]["mask"]["inferred_object"] = inferred_object
         
-        # Set up the headers with authentication
-        headers = {
-            'Authorization': f'Bearer {self.api_key}',
-            'Content-Type': 'application/json'
-        }
+        return payload
+    
+    async def ainpaint_image(self, source_image_base64, prompt, object_target, inferred_object=None,
+                             strength=50, model="fluently-xl", width=1024, height=1024):
+        """Async version of inpaint_image - same arguments and return value"""
+        payload = self._inpaint_payload(source_image_base64, prompt, object_target, inferred_object,
+                                        strength, model, width, height)
+        print(f"Making async inpainting request to Venice API with payload structure: {list(payload.keys())}")
+        return await self._apost_generate('inpaint_image', payload)
+    
+    def inpaint_image(self, source_image_base64, prompt, object_target, inferred_object=None, 
+                     strength=50, model="fluently-xl", width=1024, height=1024):
+        """
+        Perform inpainting on a source image with a defined mask
+        
+        Args:
+            source_image_base64 (str): Base64 encoded source image to inpaint
+            prompt (str): Description of the image (including the changes that will be inpainted)
+            object_target (str): Element in the image to inpaint over (used to create the mask)
+            inferred_object (str, optional): Content to add via inpainting (replacing object_target)
+            strength (int): Strength of the inpainting (0-100)
+            model (str): Model to use for inpainting
+            width (int): Width of the generated image
+            height (int): Height of the generated image
+            
+        Returns:
+            dict: Response from the Venice API containing the inpainted image(s)
+        """
+        payload = self._inpaint_payload(source_image_base64, prompt, object_target, inferred_object,
+                                        strength, model, width, height)
         
         # Make the API request
         print(f"Making inpainting request to Venice API with payload structure: {list(payload.keys())}")
-        try:
-            response = requests.post(
-                f"{self.API_BASE_URL}/image/generate",
-                headers=headers,
-                json=payload
-            )
-            
-            # Log the response for debugging
-            print(f"Venice API Response Status: {response.status_code}")
-            print(f"Full response headers: {response.headers}")
-            
-            # Print partial response for debugging (to avoid large outputs)
-            print(f"Venice API Response: {response.text[:200]}...")
-            
-            # Raise an exception for failed requests
-            if response.status_code != 200:
-                error_detail = response.json() if response.text else "No error details provided"
-                print(f"Error details: {error_detail}")
-                
-            response.raise_for_status()
-            
-            # Return the API response as JSON
-            return response.json()
-            
-        except requests.exceptions.RequestException as e:
-            print(f"Request Exception: {str(e)}")
-            raise
+        return self.post_generate('inpaint_image', payload)
 
     def analyze_image_for_traits(self, base64_image):
         """
         Analyze a base64 encoded image to extract properties for NFT traits
         
+        Traits are seeded from the image's content hash and memoized, so the
+        same image always yields the same document (see traits.py).
+        
         Args:
-            base64_image (str): Base64 encoded image to analyze
+            base64_image (str or ImageArtifact): Base64 encoded image to analyze,
+                or an artifact already decoded by an earlier stage
             
         Returns:
             dict: Dictionary containing image traits suitable for NFT metadata
         """
-        try:
-            # Remove data URL prefix if present
-            if ',' in base64_image:
-                base64_image = base64_image.split(',')[1]
-                
-            # Convert base64 to image
-            image_data = base64.b64decode(base64_image)
-            image = Image.open(BytesIO(image_data))
-            
-            # Extract image properties
-            width, height = image.size
-            format_type = image.format
-            mode = image.mode
-            
-            # Calculate color statistics if possible
-            color_stats = {}
-            dominant_colors = []
-            color_diversity = "medium"
-            brightness = "medium"
-            
-            try:
-                # Convert to RGB if not already
-                if mode != 'RGB':
-                    image = image.convert('RGB')
-                
-                # Get image stats
-                stat = ImageStat.Stat(image)
-                r, g, b = stat.mean
-                
-                # Calculate brightness
-                brightness_value = (r + g + b) / 3
-                if brightness_value < 85:
-                    brightness = "dark"
-                elif brightness_value > 170:
-                    brightness = "bright"
-                else:
-                    brightness = "medium"
-                
-                # Determine dominant color palette
-                if r > g and r > b:
-                    dominant_colors.append("red")
-                elif g > r and g > b:
-                    dominant_colors.append("green")
-                elif b > r and b > g:
-                    dominant_colors.append("blue")
-                
-                if abs(r - g) < 20 and abs(r - b) < 20 and abs(g - b) < 20:
-                    dominant_colors.append("balanced")
-                
-                # Calculate color diversity using standard deviation
-                r_std, g_std, b_std = stat.stddev
-                color_diversity_value = (r_std + g_std + b_std) / 3
-                
-                if color_diversity_value < 50:
-                    color_diversity = "low"
-                elif color_diversity_value > 100:
-                    color_diversity = "high"
-                else:
-                    color_diversity = "medium"
-                
-                color_stats = {
-                    "r_mean": r,
-                    "g_mean": g,
-                    "b_mean": b,
-                    "brightness_value": brightness_value,
-                    "color_diversity_value": color_diversity_value
-                }
-                
-            except Exception as e:
-                print(f"Error analyzing image colors: {str(e)}")
-            
-            # Generate randomized trait values for properties that can't be directly extracted
-            rarity_values = ["common", "uncommon", "rare", "epic", "legendary"]
-            rarity_weights = [50, 30, 15, 4, 1]  # Probability weights
-            
-            # Generate rarity based on color properties
-            if color_diversity == "high" and brightness == "bright":
-                rarity_weights = [30, 35, 20, 10, 5]  # Higher chance of better rarity
-            elif color_diversity == "low" and brightness == "dark":
-                rarity_weights = [60, 25, 10, 4, 1]  # Lower chance of better rarity
-            
-            # Select rarity based on weighted random choice
-            rarity = random.choices(rarity_values, weights=rarity_weights, k=1)[0]
-            
-            # Compile traits
-            traits = {
-                "image_properties": {
-                    "width": width,
-                    "height": height,
-                    "format": format_type,
-                    "aspect_ratio": round(width / height, 2)
-                },
-                "color_properties": {
-                    "dominant_colors": dominant_colors,
-                    "brightness": brightness,
-                    "color_diversity": color_diversity
-                },
-                "nft_traits": {
-                    "rarity": rarity,
-                    "creativity_score": random.randint(1, 100),
-                    "uniqueness_factor": random.randint(1, 100),
-                    "magical_power": random.choice(["fire", "water", "earth", "air", "cosmic", "nature", "tech", "rainbow"]),
-                    "special_ability": random.choice([
-                        "flying", "invisibility", "super speed", "telepathy", 
-                        "teleportation", "shape shifting", "healing", "time control"
-                    ])
-                },
-                "metadata": {
-                    "timestamp": self._get_current_timestamp(),
-                    "generator": "KryptoKids Magic Drawing Creator",
-                    "version": "1.0.0"
-                }
-            }
-            
-            return traits
-            
-        except Exception as e:
-            print(f"Error analyzing image: {str(e)}")
-            # Return basic traits if analysis fails
-            return {
-                "nft_traits": {
-                    "rarity": random.choice(["common", "uncommon", "rare"]),
-                    "creativity_score": random.randint(1, 100),
-                    "uniqueness_factor": random.randint(1, 100),
-                    "magical_power": random.choice(["fire", "water", "earth", "air", "cosmic"]),
-                    "special_ability": random.choice(["flying", "invisibility", "super speed", "healing"])
-                },
-                "metadata": {
-                    "timestamp": self._get_current_timestamp(),
-                    "generator": "KryptoKids Magic Drawing Creator",
-                    "version": "1.0.0"
-                }
-            }
+        with metrics.IMAGE_STAGE.time(stage='analyze_traits'), stage_timer.stage('analyze_traits'):
+            if isinstance(base64_image, ImageArtifact):
+                return traits.analyze_artifact(base64_image)
+            return traits.analyze_base64_image(base64_image)
     
     def _get_current_timestamp(self):
         """Get current timestamp in ISO format"""
         from datetime import datetime
         return datetime.now().isoformat()
     
-    def save_image_with_metadata(self, base64_image, filename, output_dir="generated_images"):
+    def save_image_with_metadata(self, base64_image, filename, output_dir="generated_images", wait_for_upload=False):
         """
         Save a base64 encoded image to file and return a URL path
         
         Args:
-            base64_image (str): Base64 encoded image to save
+            base64_image (str or ImageArtifact): Base64 encoded image to save,
+                or an artifact whose decoded bytes can be shared with later stages
             filename (str): Filename to save the image as
             output_dir (str): Directory to save the image in
+            wait_for_upload (bool): Copy to object storage before returning instead of in the background
             
         Returns:
             str: URL path to the saved image
@@ -556,16 +703,16 @@ class VeniceAPI:
         # Create output directory if it doesn't exist
         os.makedirs(output_dir, exist_ok=True)
         
-        # Remove data URL prefix if present
-        if ',' in base64_image:
-            base64_image = base64_image.split(',')[1]
-        
-        # Save the image
-        img_data = base64.b64decode(base64_image)
+        # Decodes once; an artifact keeps the bytes for the analysis stage
+        img_data = as_artifact(base64_image).data
         filepath = os.path.join(output_dir, filename)
         
-        with open(filepath, 'wb') as f:
-            f.write(img_data)
+        with metrics.IMAGE_STAGE.time(stage='save'), stage_timer.stage('save'):
+            with open(filepath, 'wb') as f:
+                f.write(img_data)
+        
+        # Copied to object storage (in the background unless asked to wait) when one is configured
+        storage.offload(storage.storage_key(output_dir, filename), filepath, wait=wait_for_upload)
         
         # Return URL path (relative for now, would be absolute URL in production)
         return f"/{output_dir}/{filename}"